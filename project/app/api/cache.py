@@ -0,0 +1,260 @@
+'''
+Small caches for expensive upstream answers, like MapBox routes.
+
+`LRUCache` is a bounded in-memory tier with a time to live, `SQLiteCache` is
+an optional on-disk tier that survives restarts and is shared by every worker
+on the host, and `TieredCache` checks them in that order. Every tier counts
+hits, misses and evictions.
+'''
+from collections import OrderedDict
+import json
+import os
+import sqlite3
+import threading
+from time import time
+
+from app.api.coordinates import parse_coords
+
+
+class LRUCache():
+    '''
+    A least recently used cache with a time to live.
+
+    ### Params
+    - `maxsize`: the most entries kept. The least recently used entry is
+    evicted to make room
+    - `ttl`: seconds an entry stays valid, or None to keep entries until
+    they are evicted
+    '''
+    def __init__(self, maxsize = 1024, ttl = None, clock = time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default = None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > self.clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            expires = None if self.ttl is None else self.clock() + self.ttl
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last = False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+
+class SQLiteCache():
+    '''
+    A persistent cache of JSON values in a SQLite file.
+
+    ### Params
+    - `path`: the database file. It is created if it doesn't exist
+    - `maxsize`: the most rows kept. Rows used least recently are pruned
+    - `ttl`: seconds a row stays valid, or None to keep rows until pruned
+    '''
+    # prune every this many writes, instead of on every write
+    PRUNE_EVERY = 100
+
+    def __init__(self, path, maxsize = 100000, ttl = None, clock = time):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self._db = None
+        self._pid = None
+        # connections inherited from a parent process, see `_connect`
+        self._inherited = []
+
+    def _connect(self):
+        # a SQLite connection must not be used across a fork, and gunicorn
+        # forks workers after importing the app, so each process opens its
+        # own on first use
+        if self._db is not None and self._pid == os.getpid():
+            return self._db
+        if self._db is not None:
+            # kept, never closed: closing the parent's connection here could
+            # checkpoint and remove the WAL the parent is still using
+            self._inherited.append(self._db)
+        self._db = sqlite3.connect(self.path, timeout = 5.0, check_same_thread = False,
+                                   isolation_level = None)
+        self._pid = os.getpid()
+        # WAL lets other workers read while one writes
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS cache (
+                                key TEXT PRIMARY KEY,
+                                value TEXT NOT NULL,
+                                expires REAL,
+                                accessed REAL NOT NULL)''')
+        return self._db
+
+    def get(self, key, default = None):
+        with self._lock:
+            db = self._connect()
+            row = db.execute('SELECT value, expires FROM cache WHERE key = ?',
+                             (key,)).fetchone()
+            now = self.clock()
+            if row is not None:
+                value, expires = row
+                if expires is None or expires > now:
+                    db.execute('UPDATE cache SET accessed = ? WHERE key = ?',
+                               (now, key))
+                    self.hits += 1
+                    return json.loads(value)
+                db.execute('DELETE FROM cache WHERE key = ?', (key,))
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            db = self._connect()
+            now = self.clock()
+            expires = None if self.ttl is None else now + self.ttl
+            db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                       (key, json.dumps(value), expires, now))
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._prune(db, now)
+
+    def _prune(self, db, now):
+        self.expirations += db.execute(
+            'DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?',
+            (now,)).rowcount
+        self.evictions += db.execute(
+            '''DELETE FROM cache WHERE key IN (
+                   SELECT key FROM cache ORDER BY accessed DESC
+                   LIMIT -1 OFFSET ?)''', (self.maxsize,)).rowcount
+
+    def clear(self):
+        with self._lock:
+            self._connect().execute('DELETE FROM cache')
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def stats(self):
+        return {'size': len(self), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+    def close(self):
+        with self._lock:
+            if self._db is not None and self._pid == os.getpid():
+                self._db.close()
+            elif self._db is not None:
+                self._inherited.append(self._db)
+            self._db = None
+
+
+class TieredCache():
+    '''
+    Checks an in-memory cache, then an optional disk cache. Disk hits are
+    copied into memory, and writes go to both tiers.
+
+    ### Params
+    - `memory`: an LRUCache
+    - `disk`: a SQLiteCache, or None for memory only
+    '''
+    def __init__(self, memory, disk = None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key, default = None):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return default if value is None else value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        stats = {'memory': self.memory.stats()}
+        if self.disk is not None:
+            stats['disk'] = self.disk.stats()
+        return stats
+
+
+def coords_key(coords, precision):
+    '''
+    Normalizes a coordinate string into a cache key, rounding every number to
+    `precision` decimals so nearby requests share an entry.
+
+    ### Params
+    - `coords`: an (N, 2) array of (long, lat) stops, or a string with
+    long,latitude pairs separated by semicolons
+    - `precision`: decimals kept. 3 is about 100 meters
+
+    ### Returns
+    - a string like '-122.332,47.606;-116.202,43.615'
+    '''
+    pairs = []
+    for lon, lat in parse_coords(coords).tolist():
+        lon, lat = round(lon, precision), round(lat, precision)
+        # + 0.0 turns -0.0 into 0.0
+        pairs.append(f'{lon + 0.0:.{precision}f},{lat + 0.0:.{precision}f}')
+    return ';'.join(pairs)
+
+
+def tiered_cache_from_env(prefix, maxsize, ttl):
+    '''
+    Builds a TieredCache configured by `{prefix}_SIZE`, `{prefix}_TTL` and
+    `{prefix}_PATH` environment variables. The disk tier is only used when
+    `{prefix}_PATH` is set. A size of 0 turns the cache off.
+    '''
+    maxsize = int(os.environ.get(f'{prefix}_SIZE', maxsize))
+    ttl = float(os.environ.get(f'{prefix}_TTL', ttl))
+    path = os.environ.get(f'{prefix}_PATH')
+    disk = SQLiteCache(path, ttl = ttl) if path and maxsize else None
+    return TieredCache(LRUCache(maxsize, ttl), disk)
@@ -0,0 +1,120 @@
+'''
+Trip stops, parsed once into an (N, 2) array of (long, lat) pairs.
+
+Requests may send stops as the original 'long,lat;long,lat' string or as a
+JSON list of [long, lat] pairs. The `Coordinates` field type parses either
+into an array and validates every stop with array operations, and the rest
+of the api works from that array instead of splitting the string again.
+'''
+import numpy as np
+
+from app.api.regions import BORDER_TOLERANCE, get_state_index
+
+
+def parse_coords(coords):
+    '''
+    Parses stops into an array. Arrays are passed through, so functions can
+    call this on whatever they were given.
+
+    ### Params
+    - `coords`: a string with long,latitude pairs separated by semicolons, a
+    list of [long, lat] pairs, or an (N, 2) array
+
+    ### Returns
+    - an (N, 2) float array of (long, lat) pairs
+
+    ### Raises
+    - ValueError if a pair isn't exactly 2 numbers
+    '''
+    if isinstance(coords, np.ndarray) and coords.ndim == 2 and coords.shape[1] == 2:
+        return np.asarray(coords, dtype = float)
+
+    if isinstance(coords, str):
+        pairs = [pair.split(',') for pair in coords.split(';')]
+    elif isinstance(coords, (list, tuple, np.ndarray)):
+        pairs = [pair if isinstance(pair, (list, tuple, np.ndarray)) else [pair]
+                 for pair in coords]
+    else:
+        raise ValueError('Coordinates must be a string or a list of [long, lat] pairs')
+
+    for pair in pairs:
+        if len(pair) != 2:
+            raise ValueError(f'Coordinate pairs must be exactly 2 values. {tuple(pair)} '
+                             'has to many or to few values')
+    try:
+        points = np.array(pairs, dtype = float).reshape(-1, 2)
+    except (TypeError, ValueError):
+        points = None
+    if points is None or not np.isfinite(points).all():
+        for num in (num for pair in pairs for num in pair):
+            try:
+                if np.isfinite(float(num)):
+                    continue
+            except (TypeError, ValueError):
+                pass
+            raise ValueError(f'Coordinates must be numeric. {num} is not numeric')
+    return points
+
+
+def format_coords(points):
+    '''Formats an (N, 2) array of stops as a 'long,lat;long,lat' string'''
+    return ';'.join(f'{lon!r},{lat!r}' for lon, lat in np.asarray(points, dtype = float).tolist())
+
+
+def check_coords(points, tolerance = BORDER_TOLERANCE):
+    '''
+    Validates a trip's stops all at once: at least 2 stops, each a valid
+    geocoordinate within a contiguous United States state.
+
+    ### Params
+    - `points`: an (N, 2) array of (long, lat) pairs
+    - `tolerance`: same as `point_to_state`'s
+
+    ### Raises
+    - ValueError naming the first bad stop
+    '''
+    if len(points) < 2:
+        raise ValueError("Not enough coordinates passed in. Ensure coordinates "
+                         "follow the 'long,lat;long,lat' format")
+
+    lon, lat = points[:, 0], points[:, 1]
+    bad = (lon < -180) | (lon > 180) | (lat < -90) | (lat > 90)
+    if bad.any():
+        lon, lat = points[np.argmax(bad)].tolist()
+        raise ValueError('Longitude must be between -180 and 180, and latitude '
+                         f'between -90 and 90 ({lon}, {lat})')
+
+    outside = get_state_index().locate_many(points, tolerance) < 0
+    if outside.any():
+        lon, lat = points[np.argmax(outside)].tolist()
+        raise ValueError(f'Coordinates are outside the contiguous United States ({lon}, {lat})')
+
+
+class Coordinates(np.ndarray):
+    '''
+    A pydantic field type for a trip's stops. Accepts a 'long,lat;long,lat'
+    string or a list of [long, lat] pairs, and validates to a read-only
+    (N, 2) float array. An array that is already Coordinates isn't checked
+    again, so a route shared by a batch is only validated once.
+    '''
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def __modify_schema__(cls, field_schema):
+        field_schema.update(anyOf = [
+            {'type': 'string', 'pattern': r'^[^;]+,[^;]+(;[^;]+,[^;]+)+$'},
+            {'type': 'array', 'minItems': 2,
+             'items': {'type': 'array', 'items': {'type': 'number'},
+                       'minItems': 2, 'maxItems': 2}}])
+
+    @classmethod
+    def validate(cls, value):
+        if isinstance(value, cls):
+            return value
+        points = parse_coords(value)
+        check_coords(points)
+        points = points.copy().view(cls)
+        points.flags.writeable = False
+        return points
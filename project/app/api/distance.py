@@ -0,0 +1,177 @@
+'''
+Offline trip distance estimates, for when MapBox is slow or down.
+
+A trip is estimated as great circle lines between its stops, split by PADD
+region like a real route, with each region's distance stretched by a road
+circuity factor: how much longer the road is than the straight line. Nothing
+leaves the process, so an estimate takes milliseconds.
+
+Factors start at DEFAULT_ROAD_FACTOR, or the values in the JSON file at
+`ROAD_FACTORS_PATH`, and calibrate themselves as real MapBox routes come in:
+once a region has seen enough kilometers of real routes its factor is the
+measured ratio of road to straight line distance.
+'''
+import json
+import os
+import threading
+
+import numpy as np
+
+from app.api.coordinates import parse_coords
+from app.api.regions import haversine, points_to_regions, split_polyline
+
+# US road networks average about 1.2 times the straight line distance
+DEFAULT_ROAD_FACTOR = 1.2
+ROAD_FACTORS_PATH = os.environ.get('ROAD_FACTORS_PATH')
+
+# straight lines are sampled this often, in meters, so a leg that dips into
+# another region between its stops is still split
+DENSIFY_STEP = 20000.0
+# meters of real routes a region needs before its measured factor is trusted
+MIN_CALIBRATION_METERS = 500000.0
+
+
+def densify(stops, step = DENSIFY_STEP):
+    '''
+    Adds points along the straight line between each pair of stops, at most
+    `step` meters apart.
+
+    ### Params
+    - `stops`: an (N, 2) array of (long, lat) stops
+
+    ### Returns
+    - an (M, 2) array of points, starting and ending with the stops
+    '''
+    stops = np.asarray(stops, dtype = float).reshape(-1, 2)
+    if len(stops) < 2:
+        return stops
+    counts = np.maximum(np.ceil(haversine(stops[:-1], stops[1:]) / step), 1).astype(int)
+    lines = [stops[:1]]
+    for start, end, count in zip(stops[:-1], stops[1:], counts):
+        t = np.arange(1, count + 1)[:, None] / count
+        lines.append(start + t * (end - start))
+    return np.concatenate(lines)
+
+
+def fill_unplaced(labels):
+    '''
+    Gives points the local state outlines couldn't place, like the middle of
+    a lake, the label of the point before them, or after them at the start.
+    Used where there's no geocoder to ask.
+    '''
+    labels = np.asarray(labels, dtype = object)
+    placed = np.array([label is not None for label in labels], dtype = bool)
+    if not placed.any():
+        return labels.copy()
+    # the index of the last placed point at or before each point
+    previous = np.maximum.accumulate(np.where(placed, np.arange(len(labels)), -1))
+    previous[previous < 0] = np.argmax(placed)
+    return labels[previous]
+
+
+def straight_split(stops, precision = 100.0):
+    '''
+    Splits the straight lines between stops into meters per PADD region.
+
+    ### Params
+    - `stops`: an (N, 2) array of (long, lat) stops
+    - `precision`: how closely region boundaries are located, in meters
+
+    ### Returns
+    - a dictionary formatted like `split_by_region`'s
+    '''
+    points = densify(stops)
+    labels = fill_unplaced(points_to_regions(points))
+    return split_polyline(points, labels, precision = precision)
+
+
+def region_totals(split):
+    '''Sums a split's distances by region'''
+    totals = {}
+    for region, distance in zip(split['regions'], split['distances']):
+        totals[region] = totals.get(region, 0.0) + distance
+    return totals
+
+
+class RoadFactors():
+    '''
+    Road circuity factors per PADD region, calibrated from real routes.
+
+    ### Params
+    - `factors`: a dictionary of region key: factor to start from
+    - `default`: the factor of regions without one
+    - `min_meters`: meters of real routes a region needs before its measured
+    factor replaces the starting one
+    '''
+    def __init__(self, factors = None, default = DEFAULT_ROAD_FACTOR,
+                 min_meters = MIN_CALIBRATION_METERS):
+        self.factors = dict(factors or {})
+        self.default = default
+        self.min_meters = min_meters
+        self._road = {}
+        self._straight = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path = None):
+        '''Loads starting factors from a JSON object of region key: factor'''
+        if not path:
+            return cls()
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def factor(self, region):
+        with self._lock:
+            road = self._road.get(region, 0.0)
+            straight = self._straight.get(region, 0.0)
+        if road >= self.min_meters and straight > 0:
+            return road / straight
+        return self.factors.get(region, self.default)
+
+    def observe(self, straight, road):
+        '''
+        Records a trip's straight line split next to its real route split.
+        Trips whose two splits don't cross the same regions are skipped,
+        since their distances can't be lined up.
+        '''
+        straight = region_totals(straight)
+        road = region_totals(road)
+        if set(straight) != set(road) or None in road:
+            return
+        with self._lock:
+            for region, meters in road.items():
+                self._road[region] = self._road.get(region, 0.0) + meters
+                self._straight[region] = self._straight.get(region, 0.0) + straight[region]
+
+    def apply(self, split):
+        '''Stretches a straight line split into estimated road distances'''
+        return {'distances': [distance * self.factor(region) for region, distance
+                              in zip(split['regions'], split['distances'])],
+                'regions': list(split['regions'])}
+
+    def stats(self):
+        with self._lock:
+            regions = sorted(set(self._road) | set(self.factors), key = str)
+            meters = dict(self._road)
+        return {str(region): {'factor': self.factor(region),
+                              'calibration_meters': meters.get(region, 0.0)}
+                for region in regions}
+
+
+ROAD_FACTORS = RoadFactors.from_file(ROAD_FACTORS_PATH)
+
+
+def estimate_split(coords, factors = None):
+    '''
+    Estimates a trip's meters per PADD region without MapBox.
+
+    ### Params
+    - `coords`: an (N, 2) array of (long, lat) stops, or a string with
+    long,latitude pairs separated by semicolons
+    - `factors`: the RoadFactors to use. Defaults to the shared ROAD_FACTORS
+
+    ### Returns
+    - a dictionary formatted like `split_by_region`'s
+    '''
+    factors = factors or ROAD_FACTORS
+    return factors.apply(straight_split(parse_coords(coords)))
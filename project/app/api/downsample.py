@@ -0,0 +1,115 @@
+'''
+Server-side downsampling of time series for charts.
+
+A line chart a few hundred pixels wide can't show decades of points per
+series, so series are cut down to a point budget before they're sent:
+
+- `lttb`: Largest-Triangle-Three-Buckets keeps the points that best preserve
+the visual shape of the line
+- `minmax`: keeps each bucket's lowest and highest point, so no peak or
+trough is lost
+
+Both return the indexes of the points to keep, in order, and always keep the
+first and last point.
+'''
+import numpy as np
+
+METHODS = ['lttb', 'minmax']
+
+
+def _buckets(start, stop, count):
+    '''Splits the indexes start..stop into `count` contiguous buckets'''
+    return np.linspace(start, stop, count + 1).astype(int)
+
+
+def lttb(x, y, threshold):
+    '''
+    Downsamples with Largest-Triangle-Three-Buckets.
+
+    ### Params
+    - `x`: an (N,) array of increasing numbers, ie days since the epoch
+    - `y`: an (N,) array of values without NaNs
+    - `threshold`: the number of points to keep
+
+    ### Returns
+    - an array of the indexes of the kept points
+    '''
+    x = np.asarray(x, dtype = float)
+    y = np.asarray(y, dtype = float)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # the first and last points are kept, the rest are split into buckets
+    # and the point of each making the largest triangle with the point kept
+    # from the previous bucket and the average of the next one wins
+    edges = _buckets(1, n - 1, threshold - 2)
+    kept = np.empty(threshold, dtype = int)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = x[hi:edges[i + 2]].mean()
+            next_y = y[hi:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        area = np.abs((x[a] - next_x) * (y[lo:hi] - y[a])
+                      - (x[a] - x[lo:hi]) * (next_y - y[a]))
+        a = lo + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+
+def minmax(x, y, threshold):
+    '''
+    Downsamples by keeping the lowest and highest point of each bucket.
+
+    ### Params
+    - `x`: an (N,) array of increasing numbers. Unused, but kept so every
+    method takes the same arguments
+    - `y`: an (N,) array of values without NaNs
+    - `threshold`: the most points to keep
+
+    ### Returns
+    - an array of the indexes of the kept points
+    '''
+    y = np.asarray(y, dtype = float)
+    n = len(y)
+    if threshold >= n or threshold < 4:
+        return np.arange(n)
+
+    edges = _buckets(1, n - 1, (threshold - 2) // 2)
+    kept = [0]
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        bucket = y[lo:hi]
+        kept.extend(sorted({lo + int(np.argmin(bucket)), lo + int(np.argmax(bucket))}))
+    kept.append(n - 1)
+    return np.array(kept, dtype = int)
+
+
+def downsample(x, y, threshold, method = 'lttb'):
+    '''
+    Drops missing values and downsamples a series to at most `threshold`
+    points.
+
+    ### Params
+    - `x`: an (N,) array of numpy datetime64 or numbers, increasing
+    - `y`: an (N,) array of values. NaNs are dropped
+    - `threshold`: the most points to keep
+    - `method`: 'lttb' or 'minmax'
+
+    ### Returns
+    - a tuple of the kept (x, y)
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y, dtype = float)
+    present = ~np.isnan(y)
+    x, y = x[present], y[present]
+    if method == 'lttb':
+        kept = lttb(x.astype('int64') if x.dtype.kind == 'M' else x, y, threshold)
+    elif method == 'minmax':
+        kept = minmax(x, y, threshold)
+    else:
+        raise ValueError(f'Unknown downsampling method {method!r}, expected one of {METHODS}')
+    return x[kept], y[kept]
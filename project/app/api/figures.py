@@ -0,0 +1,145 @@
+'''
+Cached, precompressed response bodies with conditional request handling.
+
+Building a Plotly figure and serializing it costs far more than sending it,
+and a state's figure only changes when its series does. A `RenderedBody` is
+made once per version of the data, with its gzip (and brotli, when the
+brotli package is installed) encodings compressed up front, and
+`conditional_response` answers repeat requests with a 304 or the
+precompressed bytes.
+'''
+from email.utils import formatdate, parsedate_to_datetime
+import gzip
+import hashlib
+import os
+
+from starlette.responses import Response
+
+from app.api.cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# revalidate on every load. With an ETag that's a cheap 304
+CACHE_CONTROL = os.environ.get('FIGURE_CACHE_CONTROL', 'no-cache')
+
+
+class RenderedBody():
+    '''
+    A response body with its validators and compressed encodings.
+
+    ### Params
+    - `body`: the response bytes
+    - `last_modified`: a unix timestamp of when the underlying data changed
+    - `media_type`: the Content-Type
+    '''
+    def __init__(self, body, last_modified, media_type = 'application/json'):
+        self.body = body
+        self.media_type = media_type
+        # weak, because every encoding of the body shares it
+        self.etag = 'W/"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        self.last_modified = int(last_modified)
+        self.encodings = {'identity': body,
+                          'gzip': gzip.compress(body, compresslevel = 9, mtime = 0)}
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(body, quality = 11)
+
+    def headers(self):
+        return {'ETag': self.etag,
+                'Last-Modified': formatdate(self.last_modified, usegmt = True),
+                'Cache-Control': CACHE_CONTROL,
+                'Vary': 'Accept-Encoding'}
+
+
+def accepted_encoding(accept_encoding, available):
+    '''
+    Picks the smallest of the `available` encodings the client accepts.
+
+    ### Params
+    - `accept_encoding`: the request's Accept-Encoding header
+    - `available`: the encodings on hand, ie `RenderedBody.encodings`
+
+    ### Returns
+    - 'br', 'gzip' or 'identity'
+    '''
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in ['br', 'gzip']:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if encoding in available and quality > 0:
+            return encoding
+    return 'identity'
+
+
+def not_modified(request_headers, rendered):
+    '''Whether the client's cached copy, per its conditional headers, is current'''
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        # weak comparison, so W/ prefixes are ignored on both sides
+        tags = {tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')}
+        return rendered.etag.replace('W/', '', 1) in tags
+
+    if_modified_since = request_headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return rendered.last_modified <= since
+    return False
+
+
+def conditional_response(request, rendered):
+    '''
+    Answers a request with a cached body: a 304 if the client's copy is
+    current, otherwise the best precompressed encoding it accepts.
+    '''
+    headers = rendered.headers()
+    if not_modified(request.headers, rendered):
+        return Response(status_code = 304, headers = headers)
+
+    encoding = accepted_encoding(request.headers.get('accept-encoding'), rendered.encodings)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(rendered.encodings[encoding], media_type = rendered.media_type,
+                    headers = headers)
+
+
+class FigureCache():
+    '''
+    Rendered bodies keyed by name, each valid for one version of its data.
+
+    ### Params
+    - `maxsize`: the most bodies kept
+    '''
+    def __init__(self, maxsize = 256):
+        self._cache = LRUCache(maxsize)
+
+    def get(self, key, version):
+        '''The body rendered for `version`, or None if it's missing or stale'''
+        entry = self._cache.get(key)
+        if entry is None or entry[0] != version:
+            return None
+        return entry[1]
+
+    def set(self, key, version, rendered):
+        self._cache.set(key, (version, rendered))
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
@@ -0,0 +1,279 @@
+'''
+Local copies of the FRED series the visualizations draw.
+
+Each series is kept on disk as an append-only file of (date, value) records
+that is memory mapped for reading, so requests are served from local data
+and never wait on FRED. Refreshing only asks FRED for observations after the
+last one stored and appends them. Appends hold an exclusive flock, so every
+worker on a host can share one data directory.
+
+Configured with environment variables:
+
+- `FRED_DATA_DIR`: where the series files live. Defaults to a directory in
+the system temp directory
+- `FRED_FIXTURE_DIR`: read `<series id>.csv` files from this directory
+instead of FRED, for tests and working offline
+- `FRED_REFRESH_INTERVAL`: seconds between background refreshes, default 6
+hours. 0 turns the background refresh off
+'''
+import asyncio
+import datetime
+import fcntl
+import io
+import logging
+import os
+import re
+import tempfile
+import threading
+
+import httpx
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+FRED_URL = 'https://fred.stlouisfed.org'
+
+# one record per observation. Missing observations are NaN
+RECORD = np.dtype([('date', 'M8[D]'), ('value', '<f8')])
+
+
+def parse_csv(text, start = None):
+    '''
+    Parses a FRED graph CSV, whose first column is the observation date and
+    second the value, with '.' for a missing value.
+
+    ### Params
+    - `text`: the CSV as a string
+    - `start`: an optional numpy datetime64. Only observations on or after it
+    are kept
+
+    ### Returns
+    - a record array of (date, value) sorted by date
+    '''
+    df = pd.read_csv(io.StringIO(text), na_values = '.')
+    records = np.empty(len(df), dtype = RECORD)
+    records['date'] = pd.to_datetime(df.iloc[:, 0]).to_numpy().astype('M8[D]')
+    records['value'] = pd.to_numeric(df.iloc[:, 1], errors = 'coerce').to_numpy(dtype = float)
+    records = records[np.argsort(records['date'], kind = 'stable')]
+    if start is not None:
+        records = records[records['date'] >= start]
+    return records
+
+
+class FredSource():
+    '''
+    Downloads series from FRED's graph CSV endpoint.
+
+    ### Params
+    - `base_url`: the FRED root url. Defaults to the `FRED_URL` environment
+    variable
+    - `timeout`: seconds before a download times out
+    '''
+    def __init__(self, base_url = None, timeout = 30.0):
+        self.base_url = base_url or os.environ.get('FRED_URL', FRED_URL)
+        self.timeout = timeout
+
+    async def fetch(self, series_id, start = None):
+        '''Downloads a series' observations from `start` on, or all of them'''
+        params = {'id': series_id}
+        if start is not None:
+            params['cosd'] = str(start)
+        async with httpx.AsyncClient(base_url = self.base_url, timeout = self.timeout) as client:
+            resp = await client.get('/graph/fredgraph.csv', params = params)
+            resp.raise_for_status()
+        return parse_csv(resp.text, start)
+
+
+class FixtureSource():
+    '''
+    Reads series from `<series id>.csv` files in a directory, in the same
+    format FRED serves them.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    async def fetch(self, series_id, start = None):
+        with open(os.path.join(self.directory, f'{series_id}.csv')) as f:
+            return parse_csv(f.read(), start)
+
+
+def default_source():
+    '''A FixtureSource when `FRED_FIXTURE_DIR` is set, otherwise a FredSource'''
+    directory = os.environ.get('FRED_FIXTURE_DIR')
+    return FixtureSource(directory) if directory else FredSource()
+
+
+class SeriesStore():
+    '''
+    Keeps local copies of FRED series and refreshes them incrementally.
+
+    ### Params
+    - `directory`: where the series files live. Defaults to the
+    `FRED_DATA_DIR` environment variable, or the system temp directory
+    - `source`: what new observations are fetched from. Defaults to
+    `default_source()`
+    '''
+    def __init__(self, directory = None, source = None):
+        self.directory = directory or os.environ.get(
+            'FRED_DATA_DIR', os.path.join(tempfile.gettempdir(), 'resfeber-fred'))
+        os.makedirs(self.directory, exist_ok = True)
+        self.source = source or default_source()
+        self._maps = {}
+        self._maps_lock = threading.Lock()
+        self._refreshing = {}
+
+    def path(self, series_id):
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', series_id) + '.series')
+
+    def read(self, series_id):
+        '''
+        The series' stored observations.
+
+        ### Returns
+        - a read-only record array of (date, value), empty if nothing is
+        stored yet
+        '''
+        path = self.path(series_id)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return np.zeros(0, dtype = RECORD)
+        # a record appended by another process may still be half written
+        size -= size % RECORD.itemsize
+        if size == 0:
+            return np.zeros(0, dtype = RECORD)
+
+        # the file only grows, so a mapping stays valid until its size changes
+        with self._maps_lock:
+            cached = self._maps.get(series_id)
+            if cached is None or cached[0] != size:
+                cached = (size, np.memmap(path, dtype = RECORD, mode = 'r',
+                                          shape = (size // RECORD.itemsize,)))
+                self._maps[series_id] = cached
+        return cached[1]
+
+    def version(self, series_id):
+        '''
+        Identifies the stored data of a series. It changes whenever
+        observations are appended.
+
+        ### Returns
+        - a tuple of the file's (size, modification time in nanoseconds), or
+        None if nothing is stored yet
+        '''
+        try:
+            stat = os.stat(self.path(series_id))
+        except FileNotFoundError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns) if stat.st_size else None
+
+    def last_date(self, series_id):
+        '''The date of the last stored observation, or None'''
+        records = self.read(series_id)
+        return records['date'][-1] if len(records) else None
+
+    def _append(self, series_id, records):
+        '''Appends the records newer than the stored ones, under a file lock'''
+        fd = os.open(self.path(series_id), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # another worker may have appended while we were fetching
+            size = os.fstat(fd).st_size
+            if size % RECORD.itemsize:
+                # a crashed append left part of a record behind
+                size -= size % RECORD.itemsize
+                os.ftruncate(fd, size)
+            if size:
+                last = np.frombuffer(os.pread(fd, RECORD.itemsize, size - RECORD.itemsize),
+                                     dtype = RECORD)['date'][0]
+                records = records[records['date'] > last]
+            if len(records):
+                os.write(fd, records.tobytes())
+            return len(records)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    async def refresh(self, series_id):
+        '''
+        Fetches the observations after the last stored one and appends them.
+        Concurrent refreshes of one series share a single fetch.
+
+        ### Returns
+        - the number of observations appended
+        '''
+        task = self._refreshing.get(series_id)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(series_id))
+            self._refreshing[series_id] = task
+            task.add_done_callback(lambda _: self._refreshing.pop(series_id, None))
+        return await asyncio.shield(task)
+
+    async def _refresh(self, series_id):
+        last = self.last_date(series_id)
+        start = None if last is None else last + np.timedelta64(1, 'D')
+        records = await self.source.fetch(series_id, start)
+        added = self._append(series_id, records)
+        if added:
+            log.info(f'Appended {added} observations to {series_id}')
+        return added
+
+    async def refresh_all(self, series_ids):
+        '''
+        Refreshes several series one after another, logging failures.
+
+        ### Returns
+        - a dictionary of series id: observations appended, or None if the
+        refresh failed
+        '''
+        added = {}
+        for series_id in series_ids:
+            try:
+                added[series_id] = await self.refresh(series_id)
+            except Exception:
+                log.warning(f'Could not refresh {series_id}', exc_info = True)
+                added[series_id] = None
+        return added
+
+    async def load(self, series_id):
+        '''
+        The series' stored observations, like `read`. Only a series that has
+        never been stored is fetched first.
+        '''
+        records = self.read(series_id)
+        if not len(records):
+            await self.refresh(series_id)
+            records = self.read(series_id)
+        return records
+
+    async def frame(self, series_id):
+        '''The series as a DataFrame with `Date` and `Value` columns'''
+        records = await self.load(series_id)
+        return pd.DataFrame({'Date': np.asarray(records['date']).astype('M8[ns]'),
+                             'Value': np.asarray(records['value'])})
+
+
+def slice_dates(records, start = None, end = None):
+    '''
+    The records dated from `start` through `end`, both optional numpy
+    datetime64s. Stored records are sorted, so this is two binary searches.
+    '''
+    dates = records['date']
+    lo = 0 if start is None else np.searchsorted(dates, start, side = 'left')
+    hi = len(dates) if end is None else np.searchsorted(dates, end, side = 'right')
+    return records[lo:hi]
+
+
+async def refresh_forever(store, series_ids, interval):
+    '''
+    Refreshes the series every `interval` seconds until cancelled. Meant to
+    run as a background task.
+    '''
+    while True:
+        started = datetime.datetime.now()
+        added = await store.refresh_all(series_ids)
+        failed = [series_id for series_id, n in added.items() if n is None]
+        log.info(f'Refreshed {len(added) - len(failed)} FRED series in '
+                 f'{datetime.datetime.now() - started}, {len(failed)} failed')
+        await asyncio.sleep(interval)
@@ -0,0 +1,246 @@
+'''
+Gas price predictions for every PADD region from one coefficient matrix.
+
+The PADD gas models are scikit-learn LinearRegressions over
+[month, day, year]. Calling `predict` on each one pays sklearn's input
+validation for three multiplications, so their coefficients are stacked
+into a (regions, 3) matrix and a trip's prices become one matrix product.
+app/api/registry.py ships the matrix as a coefficient file, exported only
+once `verify` checks it reproduces the models bit for bit.
+
+`GasPriceCurves` goes one step further: every region's price on every day of
+a rolling horizon, computed once, so pricing a trip is array indexing.
+`GasCurveStore` keeps the current curves, rebuilt when the window rolls over
+to a new day or the models are reloaded.
+'''
+import datetime
+import threading
+
+import numpy as np
+
+
+class GasPriceTable():
+    '''
+    Every PADD region's linear gas price model in one coefficient matrix.
+
+    ### Params
+    - `regions`: a list of PADD region keys
+    - `coef`: a (regions, 3) array of [month, day, year] coefficients
+    - `intercept`: a (regions,) array of intercepts
+    '''
+    def __init__(self, regions, coef, intercept):
+        self.regions = list(regions)
+        self.coef = np.asarray(coef, dtype = float).reshape(len(self.regions), 3)
+        self.intercept = np.asarray(intercept, dtype = float).reshape(len(self.regions))
+        self._index = {region: i for i, region in enumerate(self.regions)}
+
+    @classmethod
+    def from_models(cls, models):
+        '''Builds the table from a dictionary of region key: LinearRegression'''
+        regions = list(models)
+        coef = np.vstack([np.ravel(models[region].coef_) for region in regions])
+        intercept = np.array([float(models[region].intercept_) for region in regions])
+        return cls(regions, coef, intercept)
+
+    def index(self, regions, strict = True):
+        '''
+        Converts region keys into row indexes of the table. Regions without a
+        model raise a KeyError, or are -1 when `strict` is False.
+        '''
+        if strict:
+            return np.array([self._index[region] for region in regions], dtype = int)
+        return np.array([self._index.get(region, -1) for region in regions], dtype = int)
+
+    def all_prices(self, dates):
+        '''
+        Predicts the price per gallon in every region on every date.
+
+        ### Params
+        - `dates`: an (N, 3) array of [month, day, year] rows
+
+        ### Returns
+        - an (N, regions) array of prices
+        '''
+        X = np.asarray(dates, dtype = float).reshape(-1, 3)
+        # the same product and sum sklearn's predict does, row by row, so the
+        # results match it exactly
+        return X @ self.coef.T + self.intercept
+
+    def predict(self, regions, month, day, year):
+        '''
+        Predicts the price per gallon for several regions on one date.
+
+        ### Params
+        - `regions`: a list of PADD region keys, repeats allowed
+        - `month`, `day`, `year`: integers with the date
+
+        ### Returns
+        - an array with a price for each region
+        '''
+        prices = self.all_prices([[month, day, year]])[0]
+        return prices[self.index(regions)]
+
+
+def date_grid(start, end, step = 1):
+    '''
+    Builds an (N, 3) array of [month, day, year] rows for every `step` days
+    from `start` up to, but not including, `end`.
+    '''
+    days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D'),
+                     np.timedelta64(step, 'D'))
+    return date_rows(days)
+
+
+def date_rows(days):
+    '''Converts an array of datetime64 days into (N, 3) [month, day, year] rows'''
+    days = np.asarray(days, dtype = 'M8[D]')
+    months = days.astype('M8[M]')
+    years = days.astype('M8[Y]')
+    return np.column_stack([months.astype(int) % 12 + 1,
+                            (days - months).astype(int) + 1,
+                            years.astype(int) + 1970]).astype(int).reshape(-1, 3)
+
+
+class GasPriceCurves():
+    '''
+    Every region's predicted price on every day of a window, precomputed.
+
+    ### Params
+    - `table`: the GasPriceTable the curves come from
+    - `start`: the window's first day, a date or datetime64
+    - `days`: how many days the window covers
+    '''
+    def __init__(self, table, start, days):
+        self.table = table
+        self.start = np.datetime64(start, 'D')
+        self.days = int(days)
+        # (days, regions), the same prices `table.all_prices` gives
+        self.prices = table.all_prices(date_rows(self.start + np.arange(self.days)))
+        self.prices.flags.writeable = False
+
+    @property
+    def end(self):
+        '''The day after the window's last day'''
+        return self.start + np.timedelta64(self.days, 'D')
+
+    def lookup(self, days, regions):
+        '''
+        The price per gallon in each region on each day. Days inside the
+        window are read from the curves, days outside it are predicted.
+
+        ### Params
+        - `days`: an (N,) array of datetime64 days
+        - `regions`: an (N,) array of the table's region indexes
+
+        ### Returns
+        - an (N,) array of prices
+        '''
+        offsets = (np.asarray(days, dtype = 'M8[D]') - self.start).astype(int)
+        regions = np.asarray(regions, dtype = int)
+        inside = (offsets >= 0) & (offsets < self.days)
+        if inside.all():
+            return self.prices[offsets, regions]
+
+        prices = np.empty(len(offsets))
+        prices[inside] = self.prices[offsets[inside], regions[inside]]
+        outside = ~inside
+        unique_days, day_index = np.unique(offsets[outside], return_inverse = True)
+        predicted = self.table.all_prices(date_rows(self.start + unique_days))
+        prices[outside] = predicted[day_index.reshape(-1), regions[outside]]
+        return prices
+
+    def daily(self, regions, start, end):
+        '''
+        Every listed region's daily prices from `start` through `end`.
+
+        ### Params
+        - `regions`: a list of the table's region keys
+        - `start`, `end`: dates bounding the range, inclusive
+
+        ### Returns
+        - a (days, regions) array of prices
+        '''
+        days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)
+        columns = self.table.index(regions)
+        return self.lookup(np.repeat(days, len(columns)),
+                           np.tile(columns, len(days))).reshape(len(days), len(columns))
+
+
+class GasCurveStore():
+    '''
+    Keeps the GasPriceCurves of the current gas models, starting today.
+
+    ### Params
+    - `tables`: a function returning the current GasPriceTable, ie
+    `lambda: REGISTRY.gas_prices`
+    - `days`: how many days ahead the curves cover
+    - `today`: a function returning today's date
+    '''
+    def __init__(self, tables, days = 731, today = datetime.date.today):
+        self.tables = tables
+        self.days = days
+        self.today = today
+        self.builds = 0
+        self._curves = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        '''
+        Rebuilds the curves if the models were reloaded or the day changed.
+
+        ### Returns
+        - whether the curves were rebuilt
+        '''
+        table = self.tables()
+        start = np.datetime64(self.today(), 'D')
+        with self._lock:
+            curves = self._curves
+            if curves is not None and curves.table is table and curves.start == start:
+                return False
+            self._curves = GasPriceCurves(table, start, self.days)
+            self.builds += 1
+            return True
+
+    def current(self):
+        '''
+        The curves of the current models. They're built here the first time,
+        and after a reload, and otherwise left to `refresh` to roll forward;
+        days before the window are still priced, just not from memory.
+        '''
+        curves = self._curves
+        if curves is None or curves.table is not self.tables():
+            self.refresh()
+            curves = self._curves
+        return curves
+
+    def stats(self):
+        curves = self._curves
+        if curves is None:
+            return {'built': False, 'builds': self.builds}
+        return {'built': True, 'builds': self.builds,
+                'start': str(curves.start), 'days': curves.days,
+                'regions': curves.table.regions}
+
+
+def verify(table, models, dates):
+    '''
+    Checks the table gives bit-identical prices to each model's own
+    `predict`, called one date at a time like the api used to.
+
+    ### Params
+    - `table`: a GasPriceTable
+    - `models`: the dictionary of region key: LinearRegression it came from
+    - `dates`: an (N, 3) array of [month, day, year] rows to check
+
+    ### Returns
+    - a list of (region, [month, day, year]) where the two disagree
+    '''
+    prices = table.all_prices(dates)
+    mismatches = []
+    for row, date in enumerate(np.asarray(dates).tolist()):
+        for region, model in models.items():
+            expected = model.predict([date])[0]
+            if prices[row, table.index([region])[0]] != expected:
+                mismatches.append((region, date))
+    return mismatches
+
@@ -0,0 +1,217 @@
+'''
+A cache of MapBox reverse geocoding answers, keyed by grid cell.
+
+Points the local state outlines can't place come in runs, a few hundred
+meters apart along the same bridge or shoreline, so answers are kept per
+cell of a lat/long grid instead of per point:
+
+- a cell holding one state answers for every point in it
+- a cell that has seen two different states straddles a border, and always
+calls out
+- an unseen cell whose 8 neighbors all hold the same state is inferred to be
+in that state, without calling out
+- an answer without a state isn't kept, so a miss at a coast or a transient
+one isn't repeated or spread to the cells around it
+
+Cells live in a `TieredCache`, configured by the `GEOCODE_CACHE_SIZE`,
+`GEOCODE_CACHE_TTL` and `GEOCODE_CACHE_PATH` environment variables like the
+route cache, so memory is bounded and, with a path, answers survive restarts.
+`GEOCODE_CELL_SIZE` is the cell size in degrees, default 0.01 (about 1 km).
+
+To pre-seed the disk cache along the major interstates, with a MapBox token:
+
+    GEOCODE_CACHE_PATH=/data/geocode.sqlite python -m app.api.geocache warm
+'''
+import argparse
+import asyncio
+import math
+import os
+
+import numpy as np
+
+from app.api.cache import tiered_cache_from_env
+from app.api.coordinates import format_coords
+from app.api.mapbox import close_client, get_client
+from app.api.regions import get_state_index
+
+GEOCODE_CELL_SIZE = float(os.environ.get('GEOCODE_CELL_SIZE', 0.01))
+
+# stored for a cell that has answered with more than one state
+MIXED = '<mixed>'
+# the answer for a point MapBox places in no state
+NOT_FOUND = 'state not found'
+
+# waypoints, in (long, lat), that MapBox routes each interstate through
+INTERSTATES = {
+    'I-5': [(-117.1611, 32.7157), (-121.4944, 38.5816), (-122.6765, 45.5231),
+            (-122.3321, 47.6062), (-122.4787, 48.7519)],
+    'I-10': [(-118.2437, 34.0522), (-112.0740, 33.4484), (-106.4850, 31.7619),
+             (-98.4936, 29.4241), (-95.3698, 29.7604), (-90.0715, 29.9511),
+             (-81.6557, 30.3322)],
+    'I-40': [(-117.0173, 34.8958), (-106.6504, 35.0844), (-97.5164, 35.4676),
+             (-90.0490, 35.1495), (-86.7816, 36.1627), (-78.6382, 35.7796)],
+    'I-70': [(-112.1000, 38.5733), (-104.9903, 39.7392), (-94.5786, 39.0997),
+             (-90.1994, 38.6270), (-82.9988, 39.9612), (-76.6122, 39.2904)],
+    'I-80': [(-122.4194, 37.7749), (-119.8138, 39.5296), (-111.8910, 40.7608),
+             (-95.9345, 41.2565), (-87.6298, 41.8781), (-81.6944, 41.4993),
+             (-74.1724, 40.7357)],
+    'I-90': [(-122.3321, 47.6062), (-117.4260, 47.6588), (-108.5007, 45.7833),
+             (-96.7311, 43.5446), (-87.6298, 41.8781), (-78.8784, 42.8864),
+             (-71.0589, 42.3601)],
+    'I-95': [(-80.1918, 25.7617), (-81.6557, 30.3322), (-77.4360, 37.5407),
+             (-75.1652, 39.9526), (-73.9352, 40.7306), (-71.0589, 42.3601),
+             (-70.2553, 43.6591)],
+    'I-35': [(-98.4936, 29.4241), (-97.3308, 32.7555), (-97.5164, 35.4676),
+             (-94.5786, 39.0997), (-93.6091, 41.6005), (-93.2650, 44.9778),
+             (-92.1005, 46.7867)],
+    'I-75': [(-80.1918, 25.7617), (-82.4572, 27.9506), (-84.3880, 33.7490),
+             (-84.5120, 39.1031), (-83.0458, 42.3314), (-84.3453, 46.4953)],
+}
+
+
+def cell_of(coord, cell_size = GEOCODE_CELL_SIZE):
+    '''The (column, row) of the grid cell a (long, lat) pair falls in'''
+    return (math.floor(coord[0] / cell_size), math.floor(coord[1] / cell_size))
+
+
+class GeocodeCache():
+    '''
+    States looked up by reverse geocoding, per grid cell.
+
+    ### Params
+    - `cache`: where cells are kept. Defaults to a TieredCache configured by
+    the `GEOCODE_CACHE_*` environment variables
+    - `cell_size`: the cell size in degrees
+    '''
+    def __init__(self, cache = None, cell_size = GEOCODE_CELL_SIZE):
+        self.cache = cache or tiered_cache_from_env('GEOCODE_CACHE', maxsize = 100000,
+                                                    ttl = 365 * 86400)
+        self.cell_size = cell_size
+        self.inferred = 0
+
+    def _key(self, col, row):
+        # the cell size is part of the key, so a persisted cache survives
+        # changing it
+        return f'{self.cell_size}:{col}:{row}'
+
+    def lookup(self, coord):
+        '''
+        The state of a (long, lat) pair, if its cell or the cells around it
+        know it.
+
+        ### Returns
+        - a string with the state name, or None when MapBox has to be asked
+        '''
+        col, row = cell_of(coord, self.cell_size)
+        state = self.cache.get(self._key(col, row))
+        # NOT_FOUND may be left in caches persisted before it stopped being
+        # stored
+        if state is not None and state != NOT_FOUND:
+            return None if state == MIXED else state
+
+        neighbors = set()
+        for dc in (-1, 0, 1):
+            for dr in (-1, 0, 1):
+                if dc or dr:
+                    neighbors.add(self.cache.get(self._key(col + dc, row + dr)))
+                    if len(neighbors) > 1:
+                        return None
+        state = neighbors.pop()
+        if state is None or state in (MIXED, NOT_FOUND):
+            return None
+        self.inferred += 1
+        return state
+
+    def store(self, coord, state):
+        '''
+        Records a geocoded state for the cell a (long, lat) pair is in.
+        NOT_FOUND isn't recorded.
+        '''
+        if state == NOT_FOUND:
+            return
+        key = self._key(*cell_of(coord, self.cell_size))
+        known = self.cache.get(key)
+        if known is not None and known != state:
+            state = MIXED
+        self.cache.set(key, state)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return dict(self.cache.stats(), inferred = self.inferred)
+
+
+GEOCODE_CACHE = GeocodeCache()
+
+
+async def warm(geocode, interstates = INTERSTATES, limit = None, cache = None):
+    '''
+    Seeds the cache along interstates: each interstate is routed once, and
+    the route's points the local state outlines can't place are geocoded,
+    one per cell.
+
+    ### Params
+    - `geocode`: an async function taking a (long, lat) tuple, that looks up
+    and caches its state, ie `predict.coord_to_state`
+    - `interstates`: a dictionary of name: list of (long, lat) waypoints
+    - `limit`: the most geocoding calls made
+    - `cache`: the GeocodeCache checked for cells already known. Defaults to
+    GEOCODE_CACHE
+
+    ### Returns
+    - a dictionary of interstate name: geocoding calls made for it
+    '''
+    cache = cache or GEOCODE_CACHE
+    calls = {}
+    for name, waypoints in interstates.items():
+        trip = await get_client().directions(format_coords(waypoints), overview = 'full',
+                                             geometries = 'geojson')
+        points = np.asarray(trip['routes'][0]['geometry']['coordinates'],
+                            dtype = float).reshape(-1, 2)
+        unplaced = points[get_state_index().locate_many(points) < 0]
+
+        calls[name] = 0
+        seen = set()
+        for point in unplaced.tolist():
+            cell = cell_of(point, cache.cell_size)
+            if cell in seen or cache.lookup(point) is not None:
+                continue
+            if limit is not None and sum(calls.values()) >= limit:
+                return calls
+            seen.add(cell)
+            await geocode(tuple(point))
+            calls[name] += 1
+    return calls
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    command = commands.add_parser('warm', help = 'geocode the points along the major '
+                                  'interstates the state outlines can\'t place')
+    command.add_argument('--limit', type = int, help = 'the most geocoding calls to make')
+    command.add_argument('--interstates', nargs = '+', choices = sorted(INTERSTATES),
+                         default = sorted(INTERSTATES))
+    args = parser.parse_args(argv)
+    if not os.environ.get('GEOCODE_CACHE_PATH'):
+        parser.error('set GEOCODE_CACHE_PATH, or the warmed cache is thrown away on exit')
+
+    # predict uses the cache, so it's imported here
+    from app.api.predict import coord_to_state
+
+    async def run():
+        try:
+            return await warm(coord_to_state, {name: INTERSTATES[name] for name in args.interstates},
+                              args.limit)
+        finally:
+            await close_client()
+
+    calls = asyncio.run(run())
+    for name, count in calls.items():
+        print(f'{name}: {count} geocoded')
+    print(GEOCODE_CACHE.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+'''
+Async client for the MapBox directions and geocoding apis.
+
+All requests share one pooled httpx client, so trips reuse keep-alive
+connections instead of opening a new TLS connection for every call, and
+waiting on a rate limit or a retry never blocks the event loop.
+'''
+import asyncio
+import logging
+import os
+import random
+
+import httpx
+
+from app.api.metrics import UPSTREAM_SECONDS, timed
+from app.api.ratelimit import DIRECTIONS_API_LIMITER, GEOCODE_API_LIMITER
+
+log = logging.getLogger(__name__)
+
+MAPBOX_URL = 'https://api.mapbox.com'
+
+# statuses worth retrying, no custom mapbox errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class MapboxError(Exception):
+    '''Raised when MapBox can't answer a request, even after retrying'''
+
+
+class MapboxClient():
+    '''
+    A small async client for the MapBox endpoints the api uses.
+
+    ### Params
+    - `base_url`: the MapBox api root url. Defaults to the `MAPBOX_URL`
+    environment variable so tests and benchmarks can point at a local stub
+    server
+    - `token`: a MapBox access token. Defaults to the `MAPBOX_TOKEN`
+    environment variable
+    - `tries`: how many times a request is attempted before giving up
+    - `backoff_factor`: the base of the exponential backoff in seconds. The
+    nth retry waits a random time up to `backoff_factor * 2 ** n`
+    - `max_connections`: the size of the shared connection pool
+    - `timeout`: seconds before a single attempt times out
+    '''
+    def __init__(self, base_url = None, token = None, tries = 5,
+                 backoff_factor = .3, max_connections = 20, timeout = 10.0):
+        base_url = base_url or os.environ.get('MAPBOX_URL', MAPBOX_URL)
+        self.base_url = base_url
+        self.token = token
+        self.tries = tries
+        self.backoff_factor = backoff_factor
+        self._client = httpx.AsyncClient(
+            base_url = base_url,
+            timeout = timeout,
+            limits = httpx.Limits(max_connections = max_connections,
+                                  max_keepalive_connections = max_connections),
+        )
+
+    def _params(self, params = None):
+        params = dict(params or {})
+        params['access_token'] = self.token or os.environ.get('MAPBOX_TOKEN', '')
+        return params
+
+    async def _request(self, limiter, method, path, **kwargs):
+        '''
+        Makes a rate limited request, retrying server errors with jittered
+        exponential backoff.
+        '''
+        for attempt in range(self.tries):
+            await limiter.acquire()
+            try:
+                resp = await self._client.request(method, path, **kwargs)
+            except httpx.TransportError as e:
+                log.warning(f'{limiter.endpoint} request failed ({e!r}) retry #{attempt}')
+            else:
+                if resp.status_code not in RETRY_STATUSES:
+                    if resp.status_code >= 400:
+                        raise MapboxError(f'{limiter.endpoint} returned {resp.status_code}: {resp.text}')
+                    return resp.json()
+                log.warning(f'{limiter.endpoint} returned {resp.status_code} retry #{attempt}')
+
+            if attempt < self.tries - 1:
+                await asyncio.sleep(random.uniform(0, self.backoff_factor * 2 ** attempt))
+
+        raise MapboxError(f'{limiter.endpoint} unavailable after {self.tries} tries')
+
+    async def directions(self, coords, **params):
+        '''
+        Gets a driving route between coordinates.
+
+        ### Params
+        - `coords`: a string with long,latitude pairs separated by semicolons
+        - any other keyword arguments are passed to MapBox as request options,
+        ie `steps='true'`
+
+        ### Returns
+        - the decoded directions response
+        '''
+        data = dict(params, coordinates = coords)
+        with timed('directions', UPSTREAM_SECONDS, endpoint = 'directions'):
+            return await self._request(DIRECTIONS_API_LIMITER, 'POST',
+                                       '/directions/v5/mapbox/driving',
+                                       params = self._params(), data = data)
+
+    async def reverse_geocode(self, coord, **params):
+        '''
+        Looks up the places at a (long, lat) pair.
+
+        ### Returns
+        - the list of features in the geocoding response
+        '''
+        path = f'/geocoding/v5/mapbox.places/{coord[0]},{coord[1]}.json'
+        with timed('geocode', UPSTREAM_SECONDS, endpoint = 'geocoding'):
+            resp = await self._request(GEOCODE_API_LIMITER, 'GET', path,
+                                       params = self._params(params))
+        return resp['features']
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+_CLIENT = None
+_CLIENT_LOOP = None
+
+
+def get_client():
+    '''
+    Returns the shared MapboxClient, creating it on first use. A client's
+    connections belong to one event loop, so a new loop gets a new client.
+    '''
+    global _CLIENT, _CLIENT_LOOP
+    loop = asyncio.get_running_loop()
+    if _CLIENT is None or _CLIENT_LOOP is not loop:
+        _CLIENT = MapboxClient()
+        _CLIENT_LOOP = loop
+    return _CLIENT
+
+
+async def close_client():
+    '''Closes the shared client's connections'''
+    global _CLIENT, _CLIENT_LOOP
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+    _CLIENT = None
+    _CLIENT_LOOP = None
@@ -0,0 +1,394 @@
+'''
+Latency histograms, counters and per-request timing.
+
+Metrics are kept in this process and rendered in the Prometheus text format
+by `/metrics`, so each worker is scraped on its own. Code on the hot path
+wraps the work it wants measured in `timed`:
+
+    with timed('directions', UPSTREAM_SECONDS, endpoint = 'directions'):
+        ...
+
+which records the duration into the histogram and, while a request is being
+handled, into that request's Server-Timing breakdown.
+
+Configured with environment variables:
+
+- `SERVER_TIMING`: 1 adds a `Server-Timing` header to every response
+- `PROFILE_SAMPLE_RATE`: the fraction of requests run under cProfile,
+default 0
+- `PROFILE_SLOW_SECONDS`: profiled requests slower than this are logged and
+saved, default 1
+- `PROFILE_DIR`: where slow request profiles are saved as `.prof` files, for
+`python -m pstats` or snakeviz. Defaults to the system temp directory
+'''
+import bisect
+import contextvars
+import cProfile
+import io
+import logging
+import math
+import os
+import pstats
+import random
+import re
+import tempfile
+import threading
+from time import perf_counter, time
+
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Match
+
+log = logging.getLogger(__name__)
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING') == '1'
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_SECONDS = float(os.environ.get('PROFILE_SLOW_SECONDS', 1.0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'resfeber-profiles'))
+
+# seconds, from a cache hit to a slow MapBox route
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRICS = []
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter():
+    '''
+    A monotonically increasing count.
+
+    ### Params
+    - `name`: the metric name, ie `http_requests_total`
+    - `help`: what the metric counts
+    - `labelnames`: the names of the labels each sample is split by
+    '''
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, amount = 1.0, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels):
+        '''The count with these labels'''
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0.0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name, _labels(self.labelnames, key), value)
+                for key, value in sorted(values.items())]
+
+
+class Histogram():
+    '''
+    Counts observations, usually durations in seconds, into cumulative
+    buckets.
+
+    ### Params
+    - `name`: the metric name, ie `upstream_request_seconds`
+    - `help`: what the metric measures
+    - `labelnames`: the names of the labels each observation is split by
+    - `buckets`: the upper bounds of the buckets
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames = (), buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values: [bucket counts, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def snapshot(self, **labels):
+        '''The (count, sum) observed with these labels'''
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts, total = self._series.get(key, [[0], 0.0])
+            return sum(counts), total
+
+    def samples(self):
+        with self._lock:
+            series = {key: (list(counts), total)
+                      for key, (counts, total) in self._series.items()}
+        samples = []
+        for key, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket',
+                                _labels(self.labelnames, key, [('le', _number(bound))]),
+                                cumulative))
+            samples.append((f'{self.name}_sum', _labels(self.labelnames, key), total))
+            samples.append((f'{self.name}_count', _labels(self.labelnames, key), cumulative))
+        return samples
+
+
+class Gauge():
+    '''
+    A value read when metrics are rendered.
+
+    ### Params
+    - `name`, `help`, `labelnames`: as for Counter
+    - `callback`: a function returning a dictionary of label values tuple:
+    value
+    '''
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames, callback):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        METRICS.append(self)
+
+    def samples(self):
+        try:
+            values = self.callback()
+        except Exception:
+            log.exception(f'Could not read {self.name}')
+            return []
+        return [(self.name, _labels(self.labelnames, key), value)
+                for key, value in sorted(values.items())]
+
+
+def render_metrics():
+    '''Renders every metric in the Prometheus text exposition format'''
+    lines = []
+    for metric in METRICS:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{labels} {_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+######################################Hot path metrics##########################
+REQUEST_SECONDS = Histogram('http_request_seconds', 'Time to handle a request',
+                            ['method', 'route', 'status'])
+UPSTREAM_SECONDS = Histogram('upstream_request_seconds',
+                             'Time a MapBox call took, including retries and rate limit waits',
+                             ['endpoint'])
+RATE_LIMIT_WAIT_SECONDS = Histogram('rate_limit_wait_seconds',
+                                    'Time spent waiting on a rate limiter token',
+                                    ['endpoint'])
+RATE_LIMIT_CALLS = Counter('rate_limit_calls_total',
+                           'Calls through a rate limiter, by whether they got a token '
+                           'right away (immediate), after a wait (delayed) or not at all (rejected)',
+                           ['endpoint', 'outcome'])
+ROUTE_SECONDS = Histogram('route_split_seconds', 'Time to split a trip by PADD region',
+                          ['mode'])
+PREDICT_SECONDS = Histogram('model_predict_seconds', 'Time a model prediction took',
+                            ['model'])
+SERIALIZE_SECONDS = Histogram('response_serialize_seconds',
+                              'Time to render a response body', ['media_type'])
+SLOW_REQUESTS = Counter('slow_requests_profiled_total',
+                        'Profiled requests slower than PROFILE_SLOW_SECONDS', ['route'])
+###############################################################################
+
+# (name, seconds) spans of the request being handled, for Server-Timing
+_SPANS = contextvars.ContextVar('spans', default = None)
+
+
+class timed():
+    '''
+    Times a block into a histogram and the current request's Server-Timing.
+
+    ### Params
+    - `span`: the Server-Timing name, ie 'directions'
+    - `histogram`: an optional Histogram to observe the duration in
+    - any other keyword arguments are the histogram's labels
+    '''
+    def __init__(self, span, histogram = None, **labels):
+        self.span = span
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = perf_counter() - self.started
+        record(self.span, self.seconds, self.histogram, **self.labels)
+
+
+def record(span, seconds, histogram = None, **labels):
+    '''Records a duration measured elsewhere, like `timed` does'''
+    if histogram is not None:
+        histogram.observe(seconds, **labels)
+    spans = _SPANS.get()
+    if spans is not None:
+        spans.append((span, seconds))
+
+
+def start_request():
+    '''Starts collecting spans for a request. Returns the list they go in'''
+    spans = []
+    _SPANS.set(spans)
+    return spans
+
+
+def server_timing(spans, total):
+    '''
+    Formats spans as a Server-Timing header value. Repeated spans, like
+    several geocoding calls, are added together.
+    '''
+    durations = {}
+    counts = {}
+    for name, seconds in spans:
+        durations[name] = durations.get(name, 0.0) + seconds
+        counts[name] = counts.get(name, 0) + 1
+    entries = [f'{name};dur={seconds * 1000:.1f}' + (f';desc="x{counts[name]}"' if counts[name] > 1 else '')
+               for name, seconds in durations.items()]
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
+
+
+class RequestProfiler():
+    '''
+    Runs a sample of requests under cProfile and keeps the profiles of slow
+    ones. cProfile sees the whole thread, so a profile also holds whatever
+    else the event loop ran meanwhile. Only one request is profiled at a
+    time.
+
+    ### Params
+    - `sample_rate`: the fraction of requests profiled
+    - `slow_seconds`: profiles of requests slower than this are saved
+    - `directory`: where profiles are saved
+    '''
+    def __init__(self, sample_rate = PROFILE_SAMPLE_RATE,
+                 slow_seconds = PROFILE_SLOW_SECONDS, directory = PROFILE_DIR):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.directory = directory
+        self._busy = threading.Lock()
+
+    def start(self):
+        '''Returns a running profile for this request, or None'''
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        if not self._busy.acquire(blocking = False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler, like a debugger's, is already running
+            self._busy.release()
+            return None
+        return profile
+
+    def stop(self, profile, route, seconds):
+        '''
+        Stops a profile, saving it if the request was slow.
+
+        ### Returns
+        - the saved file's path, or None
+        '''
+        profile.disable()
+        self._busy.release()
+        if seconds < self.slow_seconds:
+            return None
+
+        SLOW_REQUESTS.inc(route = route)
+        os.makedirs(self.directory, exist_ok = True)
+        name = re.sub(r'[^\w.-]+', '_', route).strip('_') or 'root'
+        path = os.path.join(self.directory, f'{int(time() * 1000)}-{name}.prof')
+        profile.dump_stats(path)
+
+        summary = io.StringIO()
+        pstats.Stats(profile, stream = summary).sort_stats('cumulative').print_stats(15)
+        log.warning(f'{route} took {seconds:.2f}s, profile saved to {path}\n{summary.getvalue()}')
+        return path
+
+
+PROFILER = RequestProfiler()
+
+
+def route_name(scope):
+    '''The path template of the route a request matched, ie /viz/{statecode}'''
+    app = scope.get('app')
+    for route in getattr(getattr(app, 'router', None), 'routes', []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+class MetricsMiddleware():
+    '''
+    ASGI middleware timing every request into REQUEST_SECONDS, adding the
+    Server-Timing header when SERVER_TIMING is on, and profiling a sample of
+    requests with PROFILER.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        spans = start_request()
+        profile = PROFILER.start()
+        started = perf_counter()
+        status = 500
+
+        async def send_timed(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if SERVER_TIMING:
+                    headers = MutableHeaders(scope = message)
+                    headers.append('Server-Timing', server_timing(spans, perf_counter() - started))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            seconds = perf_counter() - started
+            route = route_name(scope)
+            REQUEST_SECONDS.observe(seconds, method = scope['method'], route = route,
+                                    status = status)
+            if profile is not None:
+                PROFILER.stop(profile, route, seconds)
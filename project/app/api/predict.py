@@ -1,44 +1,88 @@
+import asyncio
+import contextvars
+import functools
 import logging
 import random
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
 import pandas as pd
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field, ValidationError, root_validator, validator
 ####################For Gas Models##############################################
-from typing import Optional
-import pickle
+from typing import List, Optional, Union
 import os
-from sklearn.linear_model import LinearRegression
-import requests
 import datetime
-from time import sleep, time
+from time import perf_counter
+import numpy as np
 ################################################################################
+from app.api.cache import coords_key, tiered_cache_from_env
+from app.api.coordinates import Coordinates, format_coords, parse_coords
+from app.api.distance import (ROAD_FACTORS, estimate_split, fill_unplaced,
+                              straight_split)
+from app.api.gasprices import GasCurveStore
+from app.api.geocache import GEOCODE_CACHE, NOT_FOUND, cell_of
+from app.api.mapbox import MapboxError, close_client, get_client
+from app.api.metrics import PREDICT_SECONDS, ROUTE_SECONDS, record, timed
+from app.api.ratelimit import RateLimitExceeded
+from app.api.regions import (PADDS, haversine, label_segments,
+                             point_to_state, points_to_regions,
+                             simplify, split_polyline, split_segments,
+                             unplaced_runs)
+from app.api.registry import REGISTRY
+from app.api.responses import FastJSONResponse, dumps
 
 log = logging.getLogger(__name__)
 router = APIRouter()
 
-GAS_MODELS = {}
-PADDS = {'1a': 
-             ['Maine', 'New Hampshire', 'Vermont', 'Massachusetts', 
-             'Connecticut', 'Rhode Island'],
-         '1b':
-             ['New York', 'New Jersey', 'Pennsylvania', 'Deleware', 'Maryland'],
-         '1c':
-             ['West Virginia', 'Virginia', 'North Carolina', 'South Carolina',
-             'Georgia', 'Florida'],
-         '2':
-             ['North Dakota', 'South Dakota', 'Nebraska', 'Kansas', 'Oklahoma',
-             'Minnesota', 'Iowa', 'Missouri', 'Wisconsin', 'Illinois', 
-             'Tennessee', 'Kentucky', 'Indiana', 'Ohio', 'Michigan'],
-         '3':
-             ['New Mexico', 'Texas', 'Arkansas', 'Louisiana', 'Mississippi', 
-             'Alabama'],
-         '4':
-             ['Idaho', 'Utah', 'Montana', 'Wyoming', 'Colorado'],
-         '5':
-             ['Washington', 'Oregon', 'California', 'Nevada', 'Arizona', 
-             'Alaska', 'Hawaii']
-        }
+METER_TO_MILE = 0.00062137119224
+
+# how many distinct routes a batch request fetches at once
+BATCH_ROUTE_CONCURRENCY = int(os.environ.get('BATCH_ROUTE_CONCURRENCY', 8))
+MAX_BATCH_SIZE = 100
+MAX_AIRBNB_BATCH_SIZE = 100000
+# stays per line of a streamed airbnb batch
+AIRBNB_STREAM_CHUNK = 1000
+
+# Per region distance splits of routes we've already fetched, keyed by their
+# coordinates rounded to ROUTE_CACHE_PRECISION decimals. Configured with the
+# ROUTE_CACHE_SIZE, ROUTE_CACHE_TTL (seconds) and ROUTE_CACHE_PATH (SQLite
+# file for a disk tier) environment variables.
+ROUTE_CACHE = tiered_cache_from_env('ROUTE_CACHE', maxsize = 1024, ttl = 86400)
+ROUTE_CACHE_PRECISION = int(os.environ.get('ROUTE_CACHE_PRECISION', 4))
+
+# Which MapBox geometry routes are split by. 'steps' labels every segment of
+# every turn-by-turn step. 'overview' fetches only the route's polyline,
+# simplifies it by ROUTE_SIMPLIFY_TOLERANCE degrees (Douglas-Peucker, 0.0005
+# is about 50 meters) and bisects the segments that cross a region boundary
+# to within BOUNDARY_PRECISION meters.
+ROUTE_GEOMETRY = os.environ.get('ROUTE_GEOMETRY', 'steps')
+ROUTE_SIMPLIFY_TOLERANCE = float(os.environ.get('ROUTE_SIMPLIFY_TOLERANCE', 0.0005))
+BOUNDARY_PRECISION = float(os.environ.get('BOUNDARY_PRECISION', 10.0))
+
+# Seconds an exact trip waits on MapBox before it's estimated offline
+# instead, see app/api/distance.py. 0 waits as long as MapBox takes.
+ROUTE_LATENCY_BUDGET = float(os.environ.get('ROUTE_LATENCY_BUDGET', 3.0))
+
+# Geocoding calls a route makes at once for the points the state outlines
+# can't place, and seconds it waits on them. Points still unresolved at the
+# deadline take the region of the points before them. 0 waits as long as
+# the geocoder takes.
+GEOCODE_CONCURRENCY = int(os.environ.get('GEOCODE_CONCURRENCY', 8))
+GEOCODE_DEADLINE = float(os.environ.get('GEOCODE_DEADLINE', 1.5))
+
+# Every PADD region's predicted daily gas price for GAS_CURVE_DAYS days from
+# today, kept in memory so trips are priced by array indexing. A background
+# task rolls the window forward and picks up reloaded models every
+# GAS_CURVE_REFRESH_INTERVAL seconds, 0 turns it off.
+GAS_CURVE_DAYS = int(os.environ.get('GAS_CURVE_DAYS', 731))
+GAS_CURVE_REFRESH_INTERVAL = float(os.environ.get('GAS_CURVE_REFRESH_INTERVAL', 3600))
+GAS_CURVES = GasCurveStore(lambda: REGISTRY.gas_prices, GAS_CURVE_DAYS)
+_CURVE_TASK = None
+# the longest span /gas/prices answers with
+MAX_GAS_PRICE_DAYS = 366
+# the slowest pace a trip may be priced at, in miles per day. Trips are
+# limited to GAS_CURVE_DAYS days
+MIN_MILES_PER_DAY = 50.0
 
 class GasItem(BaseModel):
     '''
@@ -46,72 +90,16 @@ class GasItem(BaseModel):
     '''
     # ref https://pydantic-docs.helpmanual.io/usage/types/
     # & https://github.com/samuelcolvin/pydantic/blob/master/pydantic/fields.py
-    coords: str = Field(..., example = '-122.3321,47.6062;-116.2023,43.6150;-115.1398,36.1699')
+    # parsed once into an (N, 2) array, see app/api/coordinates.py
+    coords: Coordinates = Field(..., example = '-122.3321,47.6062;-116.2023,43.6150;-115.1398,36.1699')
     year: int = Field(..., example = 2021)
     month: int = Field(..., gt = 0, le = 12, example = 7)
     day: int = Field(..., gt = 0, le = 31, example = 13)
-    mpg: Optional[float] = Field(27.0, gt = 0.0, example = 27.0)
+    mpg: float = Field(27.0, gt = 0.0, example = 27.0)
+    mode: Optional[str] = Field('exact', regex = '^(fast|exact)$', example = 'exact')
+    miles_per_day: Optional[float] = Field(None, ge = MIN_MILES_PER_DAY, example = 500.0)
 
     # ref https://pydantic-docs.helpmanual.io/usage/validators/
-    @validator('coords')
-    def coords_greater_than_one(cls, v):
-        '''Validate there are more than one coordinate passed in'''
-        split = v.split(';')
-        assert len(split) >= 2, "Not enough coordinates passed in. Ensure coordinates follow the 'long,lat:long,lat' format"
-        return v
-
-    @validator('coords')
-    def coords_are_paired(cls, v):
-        '''Validate coordinates pairs are two values exactly'''
-        split = v.split(';')
-
-        split = [tuple(i.split(',')) for i in split]
-        
-        for pair in split:
-            assert len(pair) == 2, f'Coordinate pairs must be exactly 2 values. {pair} has to many or to few values'
-        return v
-
-    @validator('coords')
-    def coords_are_numeric(cls, v):
-        '''Validates that coordinate strings are numeric'''
-        split = v.replace(';', ',').split(',')
-        for num in split:
-            msg = f'Coordinates must be numeric. {num} is not numeric'
-            clean_num = num.strip().lstrip('-').replace('.', '')
-            assert clean_num.isdecimal(), msg
-        return v
-
-    @validator('coords')
-    def coords_in_range(cls, v):
-        '''Validates coordinates are within -180 and 180 long, -90 and 90 lat'''
-        split = v.split(';')
-        split = [i.split(',') for i in split]
-
-        for pair in split:
-            # coords_are_paired has already run. Pairs are exactly 2
-            assert float(pair[0]) >= -180, f'Longitude must be greater than -180 ({pair[0]}, {pair[1]})'
-            assert float(pair[0]) <= 180, f'Longitude must be less than 180 ({pair[0]}, {pair[1]})'
-            assert float(pair[1]) >= -90, f'Latitude must be greater than -90 ({pair[0]}, {pair[1]})'
-            assert float(pair[1]) <= 90, f'Latitude must be less than 90 ({pair[0]}, {pair[1]})'
-        return v
-
-    @validator('coords')
-    def coords_in_usa(cls, v):
-        '''Validates coordinate pairs are roughly within the continental
-        United States'''
-        lon = [-124.785, -66.947028]
-        lat = [24.446667, 49.384472]
-        split = v.split(';')
-        split = [i.split(',') for i in split]
-        
-        for pair in split:
-            # coords_are_paired has already run. Pairs are exactly 2
-            assert float(pair[0]) > lon[0], f'Longitude is west of the contiguous United States ({pair[0]}, {pair[1]})'
-            assert float(pair[0]) < lon[1], f'Longitude is east of the contiguous United States ({pair[0]}, {pair[1]})'
-            assert float(pair[1]) > lat[0], f'Latitude is south of the contiguous United States ({pair[0]}, {pair[1]})'
-            assert float(pair[1]) < lat[1], f'Latitude is north of the contiguous United States ({pair[0]}, {pair[1]})'
-        return v
-
     @validator('day')
     def day_must_be_in_month(cls, v, values, **kwargs):
         '''Validate that the day is valid for the month''' 
@@ -124,6 +112,85 @@ class GasItem(BaseModel):
             raise ValueError(f'{v} is too many days for the month: {m}')
         return v
 
+class GasBatchItem(BaseModel):
+    '''
+    Use this data model to parse the request body JSON for batch gas
+    predictions. Entries are kept as plain objects here and validated as
+    GasItems one by one, so a bad entry only fails itself.
+    '''
+    items: Optional[List[dict]] = Field(None, example = [
+        {'coords': '-122.3321,47.6062;-116.2023,43.6150', 'year': 2021,
+         'month': 7, 'day': 13, 'mpg': 27.0}])
+    coords: Optional[Union[str, List[List[float]]]] = Field(None, example = '-122.3321,47.6062;-116.2023,43.6150;-115.1398,36.1699')
+    options: Optional[List[dict]] = Field(None, example = [
+        {'year': 2021, 'month': 7, 'day': 13},
+        {'year': 2021, 'month': 7, 'day': 20, 'mpg': 35.0}])
+
+    @root_validator(skip_on_failure = True)
+    def items_or_route(cls, values):
+        '''Validate the batch is either a list of items or a route with options'''
+        items = values.get('items')
+        route = values.get('coords') is not None or values.get('options') is not None
+        assert (items is None) == route, "Pass either 'items', or 'coords' with 'options'"
+        if route:
+            assert values.get('coords') and values.get('options'), "'coords' and 'options' go together"
+        entries = items if items is not None else values['options']
+        assert 0 < len(entries) <= MAX_BATCH_SIZE, f'A batch holds 1 to {MAX_BATCH_SIZE} entries'
+        return values
+
+    def entries(self):
+        '''
+        Returns every entry as a GasItem-style dictionary. A shared route is
+        parsed and validated once for all of its options.
+        '''
+        if self.items is not None:
+            return self.items
+        try:
+            coords = Coordinates.validate(self.coords)
+        except ValueError:
+            # left as sent, so every option fails with the route's error
+            coords = self.coords
+        return [dict(option, coords = coords) for option in self.options]
+
+class TripItem(GasItem):
+    '''
+    Use this data model to parse the request body JSON for full trip
+    predictions: a GasItem with the nights spent at every stop.
+    '''
+    nights: List[int] = Field(..., example = [0, 2, 3])
+
+    @validator('nights', each_item = True)
+    def nights_not_negative(cls, v):
+        '''Validate no stop has a negative number of nights'''
+        assert v >= 0, 'Nights must be 0 or more'
+        return v
+
+    @root_validator(skip_on_failure = True)
+    def nights_per_stop(cls, values):
+        '''Validate there are nights for every stop'''
+        assert len(values['nights']) == len(values['coords']), 'Pass the nights spent at every stop, 0 for none'
+        assert sum(values['nights']) < GAS_CURVE_DAYS, f'Trips are limited to {GAS_CURVE_DAYS} days'
+        return values
+
+class AirbnbBatchItem(BaseModel):
+    '''
+    Use this data model to parse the request body JSON for batch airbnb
+    predictions. Each list holds one AirbnbItem field for every stay.
+    '''
+    Airbnb_lat: List[int] = Field(..., example = [-122, -116])
+    Airbnb_long: List[int] = Field(..., example = [47, 43])
+    Airbnb_nights: List[int] = Field(..., example = [4, 2])
+    stream: Optional[bool] = Field(False, example = False)
+
+    @root_validator(skip_on_failure = True)
+    def lists_are_paired(cls, values):
+        '''Validate every stay has a lat, a long and a number of nights'''
+        lengths = {len(values[field]) for field in
+                   ['Airbnb_lat', 'Airbnb_long', 'Airbnb_nights']}
+        assert len(lengths) == 1, 'Airbnb_lat, Airbnb_long and Airbnb_nights must be the same length'
+        assert 0 < lengths.pop() <= MAX_AIRBNB_BATCH_SIZE, f'A batch holds 1 to {MAX_AIRBNB_BATCH_SIZE} stays'
+        return values
+
 class AirbnbItem(BaseModel):
     """
     Use this data model to parse the request body JSON for airbnb predictions.
@@ -136,32 +203,50 @@ class AirbnbItem(BaseModel):
 @router.on_event('startup')
 async def load_models():
     '''
-    Loading all the gas models into the global space on startup.
-    '''
-    global GAS_MODELS
-
-    # os safe file paths
-    # docker-compose pwd is /usr/src/app. then our app is another directory up
-    # for the less than intuitive file path /usr/src/app/app/gas_models/
-    newengland = os.path.join(os.getcwd(),'app', 'gas_models', 'new_england_gas_model.pckl')
-    centralatlantic = os.path.join(os.getcwd(),'app', 'gas_models', 'central_atlantic_gas_model.pckl')
-    loweratlantic = os.path.join(os.getcwd(),'app', 'gas_models', 'lower_atlantic_gas_model.pckl')
-    midwest = os.path.join(os.getcwd(),'app', 'gas_models', 'midwest_gas_model.pckl')
-    gulfcoast = os.path.join(os.getcwd(),'app', 'gas_models', 'gulf_coast_gas_model.pckl')
-    rockymnt = os.path.join(os.getcwd(),'app', 'gas_models', 'rocky_mountain_gas_model.pckl')
-    westcoast = os.path.join(os.getcwd(),'app', 'gas_models', 'west_coast_gas_model.pckl')
-
-    GAS_MODELS['1a'] = pickle.load(open(newengland, 'rb'))
-    GAS_MODELS['1b'] = pickle.load(open(centralatlantic, 'rb'))
-    GAS_MODELS['1c'] = pickle.load(open(loweratlantic, 'rb'))
-    GAS_MODELS['2'] = pickle.load(open(midwest, 'rb'))
-    GAS_MODELS['3'] = pickle.load(open(gulfcoast, 'rb'))
-    GAS_MODELS['4'] = pickle.load(open(rockymnt, 'rb'))
-    GAS_MODELS['5'] = pickle.load(open(westcoast, 'rb'))
-
-    global AIRBNB_MODEL
-    Airbnb_pred_model = os.path.join(os.getcwd(), 'app', 'airbnb_models', 'airbnb_model1.pckl')
-    AIRBNB_MODEL = pickle.load(open(Airbnb_pred_model, 'rb'))
+    Loading the gas models listed in app/models.json on startup. The airbnb
+    model is loaded the first time it's used. Models already loaded before
+    the worker was forked (see gunicorn.conf.py) are kept, so every worker
+    shares them.
+    '''
+    if not REGISTRY.loaded:
+        REGISTRY.load(preload = os.environ.get('PRELOAD_AIRBNB_MODEL') == '1')
+
+@router.on_event('startup')
+async def start_curve_refresh():
+    '''
+    Building the daily gas price curves, and keeping them current in the
+    background.
+    '''
+    global _CURVE_TASK
+    GAS_CURVES.refresh()
+    if GAS_CURVE_REFRESH_INTERVAL > 0:
+        _CURVE_TASK = asyncio.ensure_future(refresh_curves_forever(GAS_CURVES, GAS_CURVE_REFRESH_INTERVAL))
+
+@router.on_event('shutdown')
+async def close_connections():
+    '''
+    Closing the pooled MapBox connections and stopping the gas price curve
+    refresh on shutdown.
+    '''
+    global _CURVE_TASK
+    if _CURVE_TASK is not None:
+        _CURVE_TASK.cancel()
+    _CURVE_TASK = None
+    await close_client()
+
+async def refresh_curves_forever(store, interval):
+    '''
+    A helper function that rebuilds the gas price curves whenever the day
+    changes or the models are reloaded, checking every `interval` seconds. A
+    failed rebuild keeps the curves already built.
+    '''
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if store.refresh():
+                log.info(f'Rebuilt the gas price curves: {store.stats()}')
+        except Exception:
+            log.exception('Rebuilding the gas price curves failed, keeping the built ones')
 
 @router.post('/predict/gas', tags = ['Predictions'])
 async def predict_gas(item: GasItem):
@@ -171,50 +256,296 @@ async def predict_gas(item: GasItem):
 
     ### Request Body
     - `coords`: a string of semicolon separated coordinate pairs formated as 
-    'long,lat;long,lat;long,lat'. Each coordinate pair represents a stop on the 
-    user's road trip.
+    'long,lat;long,lat;long,lat', or a list of [long, lat] pairs like
+    [[-122.3321, 47.6062], [-116.2023, 43.615]]. Each coordinate pair
+    represents a stop on the user's road trip.
     - `month`: an integer containing the month of the road trip
     - `day`: an integer containing the day of the road trip
     - `year`: an integer containing the year of the road trip
     - `mpg`: an __optional__ float for the miles per gallon of the vehicle
     being used on the road trip. If no value is passed, 27 mpg will be used as
     a default value
+    - `mode`: an __optional__ string. `exact` (default) prices the MapBox
+    driving route. `fast` estimates the route offline in milliseconds from
+    straight lines between the stops and each region's road circuity
+    - `miles_per_day`: an __optional__ float, at least 50. Long trips driven
+    over several days have each day's miles priced on that day, instead of
+    all on the trip's date. Trips are limited to GAS_CURVE_DAYS days
 
     ### Response
     - `total`: a float with the total cost of of gas predicted for the entire 
     length of the trip.
+    - `mode`: the mode the trip was priced with. An `exact` trip falls back
+    to `fast` when MapBox fails or takes longer than ROUTE_LATENCY_BUDGET
+    seconds
     '''
-    month = item.month
-    day = item.day
-    year = item.year
-    meter_to_mile = 0.00062137119224
-    mpg = item.mpg
-    total = 0
-    distance_in_region = split_by_region(item.coords)
+    distance_in_region, mode = await route_split(item.coords, item.mode)
+    detail = trip_days_error(datetime.date(item.year, item.month, item.day),
+                             driving_days(distance_in_region, item.miles_per_day) - 1)
+    if detail is not None:
+        raise HTTPException(status_code = 422, detail = detail)
 
     resp = {}
 
-    for i, distance in enumerate(distance_in_region['distances']):
-        region = distance_in_region['regions'][i]
-        miles = distance * meter_to_mile
+    total = price_trips([distance_in_region], [(item.month, item.day, item.year)],
+                        [item.mpg], [item.miles_per_day])[0]
+    if total is None:
+        # Stops are validated against the state outlines, but a route can
+        # still leave the country between them, e.g. Detroit to Buffalo
+        # through Ontario. Those steps have no PADD region.
+        detail = 'At least one coordinate lays outside the contiguous USA'
+        raise HTTPException(status_code = 422, detail = detail)
+
+    resp['total'] = round(total, 2)
+    resp['mode'] = mode
+    return resp
+
+@router.post('/predict/gas/batch', tags = ['Predictions'])
+async def predict_gas_batch(batch: GasBatchItem):
+    '''
+    Predicts the total cost of gas for many road trips at once, like every
+    candidate date of a flexible date search.
 
+    ### Request Body
+    Either
+    - `items`: a list of `/predict/gas` request bodies
+
+    or
+    - `coords`: one route, formatted like `/predict/gas`'s `coords`
+    - `options`: a list of objects with the `year`, `month`, `day` and
+    optional `mpg` and `miles_per_day` to price that route with
+
+    ### Response
+    - `results`: a list with one object per request, in order. Each has either
+    a `total` and `mode`, or an `error` with the `status_code` and `detail`
+    that `/predict/gas` would have answered with.
+
+    Identical routes are only fetched once, distinct routes are fetched
+    concurrently, and every trip is priced in a single vectorized pass.
+    '''
+    entries = batch.entries()
+    results = [None] * len(entries)
+    items = {}
+    for i, entry in enumerate(entries):
         try:
-            # This try catch is here because I validated coordinates are in the
-            # contiguous USA by a simple bounding rectangle. It is possible to
-            # put locations within this bounding box, but outside of the USA
-            # proper. Like coordinates in the ocean, or just barely over the
-            # border. With more time, I'd hone my input validators to be more
-            # precise, but this works too.
-            # Example: Ottawa CA (-75.995000, 45.424721)
-            regional_rate = region_gas_predictions(region, month, day, year)
-        except:
+            items[i] = GasItem(**entry)
+        except ValidationError as e:
+            results[i] = {'error': {'status_code': 422, 'detail': e.errors()}}
+
+    # one directions call per distinct route
+    def route_key(item):
+        return (item.mode, coords_key(item.coords, ROUTE_CACHE_PRECISION))
+
+    routes = {}
+    for item in items.values():
+        routes.setdefault(route_key(item), item)
+    limit = asyncio.Semaphore(BATCH_ROUTE_CONCURRENCY)
+
+    async def fetch(item):
+        async with limit:
+            return await route_split(item.coords, item.mode)
+
+    fetched = await asyncio.gather(*(fetch(item) for item in routes.values()),
+                                   return_exceptions = True)
+    splits = dict(zip(routes, fetched))
+
+    priced = []
+    for i, item in items.items():
+        split = splits[route_key(item)]
+        if isinstance(split, Exception):
+            log.error(f'Could not route {format_coords(item.coords)}', exc_info = split)
+            results[i] = {'error': {'status_code': 500, 'detail': 'Could not route trip'}}
+        else:
+            split, mode = split
+            detail = trip_days_error(datetime.date(item.year, item.month, item.day),
+                                     driving_days(split, item.miles_per_day) - 1)
+            if detail is not None:
+                results[i] = {'error': {'status_code': 422, 'detail': detail}}
+            else:
+                priced.append((i, item, split, mode))
+
+    totals = price_trips([split for _, _, split, _ in priced],
+                         [(item.month, item.day, item.year) for _, item, _, _ in priced],
+                         [item.mpg for _, item, _, _ in priced],
+                         [item.miles_per_day for _, item, _, _ in priced])
+    for (i, _, _, mode), total in zip(priced, totals):
+        if total is None:
             detail = 'At least one coordinate lays outside the contiguous USA'
-            raise HTTPException(status_code = 422, detail = detail)
-        total += (miles / mpg) * regional_rate
+            results[i] = {'error': {'status_code': 422, 'detail': detail}}
+        else:
+            results[i] = {'total': round(total, 2), 'mode': mode}
 
-    resp['total'] = round(total, 2)
+    return {'results': results}
+
+@router.post('/predict/trip', tags = ['Predictions'])
+async def predict_trip(item: TripItem):
+    '''
+    Predicts the total cost of a road trip, gas and lodging, with an
+    itemized breakdown per leg and per stop.
+
+    ### Request Body
+    Everything `/predict/gas` takes, with the year, month and day the trip
+    starts on, and
+    - `nights`: a list of integers with the nights spent at each stop, in
+    order. The first is usually 0, the starting point
+
+    ### Response
+    - `total`: a float with the cost of the whole trip
+    - `gas` and `lodging`: floats with the cost of each
+    - `mode`: the mode the legs were routed with, like `/predict/gas`'s
+    - `legs`: one object per leg, with the `from` and `to` stop indexes, the
+    `date` it leaves, its `miles` and its `gas` cost. A leg leaves once the
+    nights at the stop it starts from are over. With `miles_per_day`, a leg
+    takes as many days as its miles need, and later stops are reached that
+    much later
+    - `stops`: one object per stop, with its `nights`, `check_in` date and
+    `lodging` cost, priced like `/predict/airbnb`
+
+    The route is split and the stays are priced at the same time, so the trip
+    takes about as long as the slower of the two.
+    '''
+    stops = item.coords
+    nights = np.asarray(item.nights, dtype = int)
+    start = datetime.date(item.year, item.month, item.day)
+    # days into the trip that each stop is reached and left
+    arrivals = np.concatenate([[0], np.cumsum(nights)[:-1]])
+    departures = np.cumsum(nights)
+
+    # the model takes whole degrees, like /predict/airbnb
+    staying = np.flatnonzero(nights > 0)
+    X = np.column_stack([stops[staying, 1].astype(int), stops[staying, 0].astype(int),
+                         nights[staying]])
+
+    async def lodging():
+        if not len(X):
+            return []
+        # run beside the route, in a thread, keeping the request's timings
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(context.run, airbnb_totals, X))
+
+    routed, stays = await asyncio.gather(route_legs(stops, item.mode), lodging(),
+                                         return_exceptions = True)
+    if isinstance(routed, Exception):
+        raise routed
+    if isinstance(stays, Exception):
+        log.error('Could not price lodging', exc_info = stays)
+        raise HTTPException(status_code = 503, detail = 'Lodging prices are unavailable')
+    legs, mode = routed
+
+    miles = np.array([sum(leg['distances']) for leg in legs]) * METER_TO_MILE
+    # with a pace, a leg longer than a day's driving pushes back every stop
+    # after it by the extra days
+    extra = np.zeros(len(legs), dtype = int)
+    if item.miles_per_day:
+        extra = np.maximum(np.ceil(miles / item.miles_per_day).astype(int) - 1, 0)
+    driving = np.concatenate([[0], np.cumsum(extra)])
+    arrivals = arrivals + driving
+    # the trip ends after the nights at its last stop
+    detail = trip_days_error(start, int(departures[-1] + driving[-1]))
+    if detail is not None:
+        raise HTTPException(status_code = 422, detail = detail)
+
+    dates = [start + datetime.timedelta(days = int(day))
+             for day in departures[:-1] + driving[:-1]]
+    gas = price_trips(legs, [(date.month, date.day, date.year) for date in dates],
+                      [item.mpg] * len(legs), [item.miles_per_day] * len(legs))
+    if None in gas:
+        detail = 'At least one coordinate lays outside the contiguous USA'
+        raise HTTPException(status_code = 422, detail = detail)
+
+    lodging_costs = np.zeros(len(nights))
+    lodging_costs[staying] = stays
+    resp = {
+        'total': round(sum(gas) + float(lodging_costs.sum()), 2),
+        'gas': round(sum(gas), 2),
+        'lodging': round(float(lodging_costs.sum()), 2),
+        'mode': mode,
+        'legs': [{'from': i, 'to': i + 1, 'date': date.isoformat(),
+                  'miles': round(float(leg_miles), 1), 'gas': round(cost, 2)}
+                 for i, (leg_miles, date, cost) in enumerate(zip(miles, dates, gas))],
+        'stops': [{'nights': int(n),
+                   'check_in': (start + datetime.timedelta(days = int(day))).isoformat(),
+                   'lodging': round(float(cost), 2)}
+                  for n, day, cost in zip(nights, arrivals, lodging_costs)],
+    }
     return resp
 
+@router.get('/gas/prices', tags = ['Predictions'])
+async def gas_prices(regions: Optional[str] = Query(None, example = '1a,2,5'),
+                     start: Optional[datetime.date] = Query(None, example = '2021-07-13'),
+                     end: Optional[datetime.date] = Query(None, example = '2021-08-13')):
+    '''
+    The predicted daily price per gallon of gas in PADD regions over a date
+    range, read from the precomputed daily curves.
+
+    ### Query Parameters
+    - `regions`: __optional__ comma separated PADD region keys, ie `1a,5`.
+    Defaults to every region
+    - `start`, `end`: __optional__ dates bounding the range, inclusive.
+    Default to today and 30 days after start. Ranges hold at most
+    MAX_GAS_PRICE_DAYS days
+
+    ### Response
+    - `dates`: a list of the ISO dates in the range
+    - `prices`: an object of region key: a list with its price on each date
+    '''
+    curves = GAS_CURVES.current()
+    keys = curves.table.regions
+    if regions is not None:
+        keys = []
+        for region in regions.split(','):
+            region = region.strip().lower()
+            if region not in curves.table.regions:
+                raise HTTPException(status_code = 404, detail = f'PADD region {region} not found')
+            if region not in keys:
+                keys.append(region)
+    start = start or datetime.date.today()
+    if end is None:
+        # 30 days on, stopping at the last date there is
+        end = start + datetime.timedelta(days = min(30, (datetime.date.max - start).days))
+    if start > end:
+        raise HTTPException(status_code = 422, detail = 'start must be on or before end')
+    if (end - start).days >= MAX_GAS_PRICE_DAYS:
+        raise HTTPException(status_code = 422, detail = f'Gas price ranges are limited to {MAX_GAS_PRICE_DAYS} days')
+
+    # a row per region, so each is a contiguous array the response encodes
+    # without copying
+    prices = np.ascontiguousarray(curves.daily(keys, start, end).T)
+    days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)
+    return FastJSONResponse({'dates': np.datetime_as_string(days).tolist(),
+                             'prices': dict(zip(keys, prices))})
+
+@router.get('/stats/cache', tags = ['Ops'])
+async def cache_stats():
+    '''
+    Hit, miss and eviction counters for the route and geocoding caches, per
+    tier.
+    '''
+    return {'routes': ROUTE_CACHE.stats(), 'geocodes': GEOCODE_CACHE.stats()}
+
+@router.get('/stats/models', tags = ['Ops'])
+async def model_stats():
+    '''
+    The versions of the models in use, whether the airbnb model is loaded,
+    the daily gas price curves and the road circuity factors fast trips are
+    estimated with.
+    '''
+    return dict(REGISTRY.info(), gas_curves = GAS_CURVES.stats(),
+                road_factors = ROAD_FACTORS.stats())
+
+@router.get('/health', tags = ['Ops'])
+async def health():
+    '''
+    Whether this worker can answer predictions: its event loop is responding
+    and the gas models are loaded. Answers 503 otherwise, for load balancer
+    and container health checks.
+    '''
+    if not REGISTRY.loaded:
+        raise HTTPException(status_code = 503, detail = 'Models are not loaded')
+    return {'status': 'ok', 'pid': os.getpid(),
+            'gas': REGISTRY.info()['gas']['version']}
+
 @router.post('/predict/airbnb', tags = ['Predictions'])
 async def predict_airbnb(item: AirbnbItem):
     """
@@ -231,60 +562,56 @@ async def predict_airbnb(item: AirbnbItem):
     long = item.Airbnb_long
     nights = item.Airbnb_nights
     
-    result = AIRBNB_MODEL.predict([[lat, long, nights]])[0]
+    model = REGISTRY.airbnb_model
+    with timed('predict', PREDICT_SECONDS, model = 'airbnb'):
+        result = model.predict([[lat, long, nights]])[0]
     return (result * nights)
 
-class RateLimiter():
-    '''
-    A helper class for respecting api rate limits and taking into account 
-    runtime. Best practice to create a new instance for each endpoint you are
-    querying.
+@router.post('/predict/airbnb/batch', tags = ['Predictions'])
+async def predict_airbnb_batch(batch: AirbnbBatchItem):
+    """
+    Predicts the total airbnb cost of many stays with a single model call,
+    like every overnight stop of a multi-destination trip.
 
-    ### Params
-    - `rate`: an integer representing the number of calls allowed per minute
-    - `endpoint`: a string containing the endpoint name. I recommend putting 
-    the endpoint url here for clarity. But basically anything to help you 
-    remember.
-
-    ### Usage
-    Instantiate the RateLimiter in global space, then globally declare them in
-    your functions where api calls are made, and run .call() just before making
-    a call to the api.
-    '''
-    def __init__(self, rate, endpoint = 'RateLimiter'):
-        self._calls = 0
-        self._timer = 0
-        self.rate  = rate
-        self.endpoint = endpoint
-
-    def call(self):
-        '''
-        Logs a call to the endpoint and verifies the total calls for the last 
-        minute are under the api's rate limit. Sleeps to respect the ratelimit.
-        '''
+    ### Request Body
+    - `Airbnb_lat`, `Airbnb_long`, `Airbnb_nights`: equal length lists of
+    integers, one entry per stay, same as `/predict/airbnb`'s fields
+    - `stream`: an __optional__ boolean. When true, results are streamed as
+    newline delimited JSON, one `{"start": i, "totals": [...]}` line per
+    chunk of stays, so large batches start arriving before they finish
+
+    ### Response
+    - `totals`: a list of floats with the total cost of each stay, in order
+    """
+    X = np.column_stack([batch.Airbnb_lat, batch.Airbnb_long, batch.Airbnb_nights])
 
-        self._calls += 1
+    if not batch.stream:
+        # returned as a response, so 100,000 totals aren't walked by
+        # FastAPI's encoder first
+        return FastJSONResponse({'totals': airbnb_totals(X)})
 
-        if self._timer == 0:
-            self._timer = time()
+    def chunks():
+        for start in range(0, len(X), AIRBNB_STREAM_CHUNK):
+            totals = airbnb_totals(X[start:start + AIRBNB_STREAM_CHUNK])
+            yield dumps({'start': start, 'totals': totals}) + b'\n'
 
-        if self._calls >= self.rate:
-            elapsed = time() - self._timer
-            if elapsed <= 60.0:
-                remaining = 60.0 - elapsed
-                sleep(remaining)
-            self._calls = 0
-            self._timer = time()
+    return StreamingResponse(chunks(), media_type = 'application/x-ndjson')
 
-######################################Rate Limiters############################
-# TODO: Pop the rate limiter into its own module, and import it maybe? IDK, I'm
-# not a huge fan of globals declared here. Maybe declare under an if statement
-# in the function. But I like to see my globals. IDK think about this.
-GEOCODE_API_LIMITER = RateLimiter(rate = 600, endpoint = 'mapbox geocoding')
-DIRECTIONS_API_LIMITER = RateLimiter(rate = 300, endpoint ='mapbox directions')
-###############################################################################
+def airbnb_totals(X):
+    '''
+    A helper function that prices many stays in one model call.
+
+    ### Params
+    - `X`: an (N, 3) array of [lat, long, nights] rows
 
-def coord_to_state(coord):
+    ### Returns
+    - a list of floats with the total cost of each stay
+    '''
+    model = REGISTRY.airbnb_model
+    with timed('predict', PREDICT_SECONDS, model = 'airbnb'):
+        return (model.predict(X) * X[:, 2]).tolist()
+
+async def coord_to_state(coord):
     '''
     A helper function that converts coordinates into state names using the 
     MapBox api. USA coordinates only.
@@ -295,44 +622,37 @@ def coord_to_state(coord):
 
     ### Returns
     - A string with the name of the state the coordinates are within
+
+    Answers are cached per grid cell, and points in or surrounded by cells
+    known to be in one state skip MapBox, see app/api/geocache.py.
     '''
-    base_url = 'https://api.mapbox.com/geocoding/v5/mapbox.places/'
-    token = os.environ.get('MAPBOX_TOKEN')
-    constructed_url = base_url + str(coord[0]) + ',' + str(coord[1]) + '.json?access_token=' + token
-    
-    global GEOCODE_API_LIMITER
-
-    # 5 tries, with back off, for 500, 502, 503, 504, no custom mapbox errors
-    tries = 5
-    backoff_factor = .3
-    backoff = backoff_factor * (2 ** (tries - 1)) #4.8 seconds
-    wait = 0.0
-    for i in range(tries):
-        GEOCODE_API_LIMITER.call()
-        resp = requests.get(constructed_url)
-
-        if resp.status_code in [500, 502, 503, 504]:
-            print(f'Mapbox geocoding endpoint down retry #{i}')
-            sleep(wait)
-            wait += backoff
-            continue
-        else:
-            resp = resp.json()['features']
-            break
+    state = GEOCODE_CACHE.lookup(coord)
+    if state is not None:
+        return state
+
+    # the client retries 429 and 5xx responses with backoff
+    features = await get_client().reverse_geocode(coord)
 
     # response contains multiple types of features, but the name of the state
     # is only stored as a 'region' place_type.
-    for feature in resp:
+    state = NOT_FOUND
+    for feature in features:
         if 'region' in feature['place_type']:
-            return feature['text']
-    
-    return 'state not found'
+            state = feature['text']
+            break
+
+    GEOCODE_CACHE.store(coord, state)
+    return state
 
-def coord_to_region(coord):
+async def coord_to_region(coord):
     '''
     A helper function that takes a coordinate pair and returns the appropriate
     PADD region identifier key, ie 1a, 3, 1c, etc
 
+    The state is looked up offline first. Only points the local state outlines
+    can't place, like a bridge or ferry over open water, fall back to the
+    MapBox geocoding api.
+
     ### Params
     - `coord`: a tuple of floats representing a (long, lat) pair of 
     geocoordinates
@@ -340,7 +660,9 @@ def coord_to_region(coord):
     ### Returns
     - A string with the PADD region identifier
     '''
-    state = coord_to_state(coord)
+    state = point_to_state(coord)
+    if state is None:
+        state = await coord_to_state(coord)
     for key in PADDS:
         if state in PADDS[key]:
             return key
@@ -362,17 +684,221 @@ def region_gas_predictions(region, month, day, year):
     - a float representing the price per gallon for gasoline in that region on
     that date
     '''
-    return GAS_MODELS[region].predict([[month, day, year]])[0]
+    return regions_gas_predictions([region], month, day, year)[0]
+
+def regions_gas_predictions(regions, month, day, year):
+    '''
+    A helper function that predicts the price per gallon for several PADD
+    regions on one date in a single matrix product. Raises a KeyError for a
+    region without a gas model.
+
+    ### Params
+    - `regions`: a list of PADD codes, repeats allowed
+    - `month`, `day`, `year`: integers with the date
+
+    ### Returns
+    - an array of floats with the price per gallon in each region
+    '''
+    return REGISTRY.gas_prices.predict(regions, month, day, year)
+
+def driving_days(split, miles_per_day):
+    '''
+    A helper function that counts the days it takes to drive a trip at
+    `miles_per_day`, or 1 without a pace.
+    '''
+    if not miles_per_day:
+        return 1
+    miles = sum(split['distances']) * METER_TO_MILE
+    return max(1, int(np.ceil(miles / miles_per_day)))
+
+def trip_days_error(start, last_day):
+    '''
+    A helper function that checks a trip's length before any date math is
+    done with it.
+
+    ### Params
+    - `start`: the date the trip starts
+    - `last_day`: the day of the trip, counted from 0, that it ends on
+
+    ### Returns
+    - a string with the error detail for a 422, or None if the trip is fine
+    '''
+    if last_day >= GAS_CURVE_DAYS:
+        return f'Trips are limited to {GAS_CURVE_DAYS} days'
+    if (datetime.date.max - start).days < last_day:
+        return f'Trips must end by {datetime.date.max.isoformat()}'
+    return None
+
+def price_trips(splits, dates, mpgs, miles_per_day = None):
+    '''
+    A helper function that prices the gas for many trips in one vectorized
+    pass over the precomputed daily gas price curves.
+
+    ### Params
+    - `splits`: a list of `split_by_region` results, one per trip
+    - `dates`: a list of (month, day, year) tuples, one per trip
+    - `mpgs`: a list of floats with each trip's miles per gallon
+    - `miles_per_day`: an __optional__ list with the miles each trip drives
+    a day, or None for trips driven in a day. Trips with a pace are priced
+    on the day they reach each mile, counted from their date
+
+    ### Returns
+    - a list with each trip's total cost, or None for trips that pass through
+    a region without a gas model
+    '''
+    if not splits:
+        return []
+    with timed('predict', PREDICT_SECONDS, model = 'gas'):
+        return _price_trips(GAS_CURVES.current(), splits, dates, mpgs, miles_per_day)
+
+def _price_trips(curves, splits, dates, mpgs, miles_per_day = None):
+    # one row per region segment of every trip
+    owner = np.repeat(np.arange(len(splits)), [len(split['regions']) for split in splits])
+    regions = curves.table.index([r for split in splits for r in split['regions']],
+                                 strict = False)
+    miles = np.array([d for split in splits for d in split['distances']],
+                     dtype = float) * METER_TO_MILE
+    mpgs = np.asarray(mpgs, dtype = float)
+    starts = np.array([datetime.date(year, month, day) for month, day, year in dates],
+                      dtype = 'M8[D]')
+
+    day = np.zeros(len(owner), dtype = int)
+    if miles_per_day is not None and any(pace is not None for pace in miles_per_day):
+        owner, regions, miles, day = spread_by_day(owner, regions, miles, np.array(
+            [np.inf if pace is None else pace for pace in miles_per_day], dtype = float))
+
+    prices = curves.lookup(starts[owner] + day, np.maximum(regions, 0))
+
+    # bincount adds each trip's segments in route order, the same as summing
+    # them one at a time
+    totals = np.bincount(owner, (miles / mpgs[owner]) * prices, minlength = len(splits))
+    missing = np.bincount(owner, regions < 0, minlength = len(splits)) > 0
+    return [None if miss else float(total) for total, miss in zip(totals, missing)]
+
+def spread_by_day(owner, regions, miles, paces):
+    '''
+    A helper function that cuts trips' region segments where each day of
+    driving ends, by cumulative distance.
+
+    ### Params
+    - `owner`: an (N,) array with the trip index of every segment, in route
+    order
+    - `regions`, `miles`: (N,) arrays with every segment's region index and
+    miles
+    - `paces`: an array with the miles each trip drives a day, inf for trips
+    driven in a day
+
+    ### Returns
+    - a tuple of `owner`, `regions`, `miles` and the day of the trip, counted
+    from 0, of every piece. Segments driven within one day are kept whole
+    '''
+    # miles driven before and at the end of every segment, within its trip
+    trip_miles = np.bincount(owner, miles, minlength = len(paces))
+    ends = np.cumsum(miles) - (np.cumsum(trip_miles) - trip_miles)[owner]
+    befores = ends - miles
+    pace = paces[owner]
+
+    first = np.floor(befores / pace).astype(int)
+    # a segment ending exactly at the end of a day is driven that day
+    last = np.maximum(np.ceil(ends / pace).astype(int) - 1, first)
+    pieces = last - first + 1
+
+    piece_of = np.repeat(np.arange(len(owner)), pieces)
+    day = first[piece_of] + np.arange(len(piece_of)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    piece_miles = miles[piece_of]
+    cut = pieces[piece_of] > 1
+    segment, cut_day = piece_of[cut], day[cut]
+    piece_miles[cut] = (np.minimum(ends[segment], (cut_day + 1) * pace[segment]) -
+                        np.maximum(befores[segment], cut_day * pace[segment]))
+    return owner[piece_of], regions[piece_of], piece_miles, day
+
+async def route_split(coords, mode = 'exact'):
+    '''
+    A helper function that splits a trip by PADD region in the requested
+    mode, falling back to an offline estimate when MapBox can't answer in
+    time.
+
+    ### Params
+    - `coords`: an (N, 2) array of (long, lat) stops, or a string with
+    long,latitude pairs separated by semicolons
+    - `mode`: 'exact' for the MapBox route or 'fast' for an estimate
+
+    ### Returns
+    - a tuple of the `split_by_region` style split and the mode it was made
+    with
+    '''
+    started = perf_counter()
+    split, mode = await _route_split(coords, mode)
+    record('route', perf_counter() - started, ROUTE_SECONDS, mode = mode)
+    return split, mode
+
+async def _route_split(coords, mode):
+    if mode == 'fast':
+        return estimate_split(coords), 'fast'
+    return await exact_or_estimate(split_by_region(coords), estimate_split, coords)
+
+async def route_legs(coords, mode = 'exact'):
+    '''
+    A helper function like `route_split`, that splits every leg of a trip
+    by PADD region separately.
+
+    ### Returns
+    - a tuple of a list with one `split_by_region` style split per leg, and
+    the mode they were made with
+    '''
+    started = perf_counter()
+    if mode == 'fast':
+        legs = estimate_legs(coords), 'fast'
+    else:
+        legs = await exact_or_estimate(split_legs(coords), estimate_legs, coords)
+    record('route', perf_counter() - started, ROUTE_SECONDS, mode = legs[1])
+    return legs
+
+async def exact_or_estimate(exact, estimate, coords):
+    '''
+    A helper function that awaits a MapBox split, and estimates it offline
+    instead when MapBox fails or takes longer than ROUTE_LATENCY_BUDGET.
+
+    ### Params
+    - `exact`: the coroutine making the MapBox split
+    - `estimate`: the function estimating it from `coords`
+
+    ### Returns
+    - a tuple of the split and 'exact' or 'fast'
+    '''
+    # shielded, so a route that misses the budget still finishes in the
+    # background and is cached for the next request
+    task = asyncio.ensure_future(exact)
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    try:
+        return await asyncio.wait_for(asyncio.shield(task),
+                                      ROUTE_LATENCY_BUDGET or None), 'exact'
+    except asyncio.TimeoutError:
+        log.warning(f'Directions took over {ROUTE_LATENCY_BUDGET}s, estimating {format_coords(parse_coords(coords))}')
+    except (MapboxError, RateLimitExceeded) as e:
+        log.warning(f'Directions unavailable ({e}), estimating {format_coords(parse_coords(coords))}')
+    return estimate(coords), 'fast'
+
+def estimate_legs(coords):
+    '''
+    A helper function that estimates every leg's split offline, see
+    `estimate_split`.
+    '''
+    stops = parse_coords(coords)
+    return [estimate_split(stops[i:i + 2]) for i in range(len(stops) - 1)]
 
-def split_by_region(coords):
+async def split_by_region(coords, geometry = None):
     '''
     A helper function that takes the entire route, and splits it into sections
     by PADD region. Returns a dictionary of lists with corresponding regions 
     and distance traveled in each region. 
     
     ### Params
-    - `coords`: a string with long,latitude pairs separated by semicolons. 
-    formatted like this:'-122.3321,47.6062;-116.2023,43.6150;-115.1398, 36.1699'
+    - `coords`: an (N, 2) array of (long, lat) stops, or a string with
+    long,latitude pairs separated by semicolons. formatted like
+    this:'-122.3321,47.6062;-116.2023,43.6150;-115.1398, 36.1699'
+    - `geometry`: 'steps' or 'overview', see ROUTE_GEOMETRY. Defaults to
+    ROUTE_GEOMETRY
 
     ### Returns
     - a dictionary containing meters traveled in a region, and the corresponding
@@ -381,51 +907,233 @@ def split_by_region(coords):
     'distances': [12.4, 40.9, 400.4],
     'regions': ['5', '4', '5']
     }
+
+    Splits are cached by rounded coordinates, so popular trips skip MapBox
+    entirely. Splits with regions guessed because geocoding was slow or
+    failing aren't cached, so the next request tries again.
+    '''
+    geometry = geometry or ROUTE_GEOMETRY
+    stops = parse_coords(coords)
+    key = coords_key(stops, ROUTE_CACHE_PRECISION)
+    if geometry != 'steps':
+        key = f'{geometry}:{key}'
+    cached = ROUTE_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    if geometry == 'overview':
+        split, resolved = await split_overview(stops)
+        if resolved:
+            ROUTE_CACHE.set(key, split)
+            ROAD_FACTORS.observe(straight_split(stops), split)
+        return split
+    if geometry != 'steps':
+        raise ValueError(f"Unknown route geometry {geometry!r}, expected 'steps' or 'overview'")
+
+    starts, ends, distances, labels, _, resolved = await route_segments(stops)
+    split = split_segments(starts, ends, distances, labels)
+    if resolved:
+        ROUTE_CACHE.set(key, split)
+        # every real route calibrates the offline estimates
+        ROAD_FACTORS.observe(straight_split(stops), split)
+    return split
+
+async def split_legs(coords):
+    '''
+    A helper function that splits every leg of a route by PADD region, from
+    a single directions call. The whole route's split is cached on the way,
+    so `split_by_region` of the same stops doesn't call MapBox again.
+
+    ### Params
+    - `coords`: an (N, 2) array of (long, lat) stops, or a string with
+    long,latitude pairs separated by semicolons
+
+    ### Returns
+    - a list of N - 1 dictionaries formatted like `split_by_region`'s, one
+    per leg
+    '''
+    stops = parse_coords(coords)
+    key = coords_key(stops, ROUTE_CACHE_PRECISION)
+    cached = ROUTE_CACHE.get(f'legs:{key}')
+    if cached is not None:
+        return cached
+
+    starts, ends, distances, labels, bounds, resolved = await route_segments(stops)
+    legs = [split_segments(starts[lo:hi], ends[lo:hi], distances[lo:hi], labels[lo:hi])
+            for lo, hi in zip(bounds[:-1], bounds[1:])]
+    if not resolved:
+        # guessed regions, like `split_by_region`, aren't cached
+        return legs
+    split = split_segments(starts, ends, distances, labels)
+    ROUTE_CACHE.set(f'legs:{key}', legs)
+    if ROUTE_GEOMETRY == 'steps':
+        ROUTE_CACHE.set(key, split)
+    ROAD_FACTORS.observe(straight_split(stops), split)
+    return legs
+
+async def route_segments(stops):
+    '''
+    A helper function that fetches a route's turn-by-turn steps and labels
+    every segment of them with its PADD region.
+
+    ### Params
+    - `stops`: an (N, 2) array of (long, lat) stops
+
+    ### Returns
+    - a tuple of the segments' (M, 2) start points, (M, 2) end points, (M,)
+    distances in meters and (M,) region labels, an array of the N indexes
+    where each leg's segments start, followed by M, and whether every label
+    is known rather than guessed, see `resolve_unplaced`
+    '''
+    trip = await get_client().directions(format_coords(stops), steps = 'true',
+                                         geometries = 'geojson')
+
+    # a route is made up of multiple legs determined by destinations, and legs
+    # are made up of the steps it takes to travel them. Every step's geometry
+    # is classified in one batch instead of one step at a time.
+    segments = [steps_to_segments([leg]) for leg in trip['routes'][0]['legs']]
+    bounds = np.cumsum([0] + [len(distances) for _, _, distances in segments])
+    starts, ends, distances = (np.concatenate(parts) for parts in zip(*segments))
+    labels = label_segments(starts, ends)
+    resolved = await resolve_unplaced(labels, (starts + ends) / 2)
+    return starts, ends, distances, labels, bounds, resolved
+
+async def split_overview(coords):
+    '''
+    A helper function that splits a route by PADD region using only its
+    overview polyline. The polyline is simplified, its vertices are labeled,
+    and only segments between vertices in different regions are bisected to
+    find where the boundary is crossed.
+
+    ### Params
+    - `coords`: an (N, 2) array of (long, lat) stops, or a string with
+    long,latitude pairs separated by semicolons
+
+    ### Returns
+    - a tuple of a dictionary formatted like `split_by_region`'s, and
+    whether every region is known rather than guessed, see `resolve_unplaced`
+    '''
+    trip = await get_client().directions(format_coords(parse_coords(coords)), overview = 'full',
+                                         geometries = 'geojson')
+    route = trip['routes'][0]
+    points = np.asarray(route['geometry']['coordinates'], dtype = float).reshape(-1, 2)
+    points = points[simplify(points, ROUTE_SIMPLIFY_TOLERANCE)]
+
+    labels = points_to_regions(points)
+    resolved = await resolve_unplaced(labels, points)
+    return split_polyline(points, labels, route.get('distance'), BOUNDARY_PRECISION), resolved
+
+async def resolve_unplaced(labels, midpoints):
+    '''
+    A helper function that fills in the region of segments (or polyline
+    vertices) the local state outlines couldn't place, in place. Each run of
+    unplaced labels is looked up at the middle of the run, runs whose middles
+    share a geocoding cell share a lookup, and lookups run concurrently, at
+    most GEOCODE_CONCURRENCY at a time. The geocoding rate limit still
+    applies to every call.
+
+    Runs not resolved within GEOCODE_DEADLINE seconds, or whose lookup
+    failed, inherit the region of the segments before them, or after them at
+    the start of the route.
+
+    ### Params
+    - `labels`: an (N,) object array of region labels from `label_segments`
+    or `points_to_regions`
+    - `midpoints`: an (N, 2) array of the (long, lat) points the labels were
+    looked up at
+
+    ### Returns
+    - True if every run was geocoded, False if some took their neighbors'
+    region instead. Those guesses shouldn't be cached
+    '''
+    runs = unplaced_runs(labels)
+    if not runs:
+        return True
+
+    # cell: (the point looked up, the runs it answers for)
+    lookups = {}
+    for start, stop in runs:
+        middle = tuple(midpoints[(start + stop - 1) // 2].tolist())
+        cell = cell_of(middle, GEOCODE_CACHE.cell_size)
+        lookups.setdefault(cell, (middle, []))[1].append((start, stop))
+
+    limit = asyncio.Semaphore(GEOCODE_CONCURRENCY)
+
+    async def lookup(coord):
+        async with limit:
+            return await coord_to_region(coord)
+
+    tasks = {cell: asyncio.ensure_future(lookup(coord))
+             for cell, (coord, _) in lookups.items()}
+    done, pending = await asyncio.wait(list(tasks.values()),
+                                       timeout = GEOCODE_DEADLINE or None)
+    for task in pending:
+        task.cancel()
+
+    failed = 0
+    for cell, task in tasks.items():
+        if task in pending:
+            continue
+        if task.exception() is not None:
+            failed += 1
+            log.warning(f'Could not geocode {lookups[cell][0]}', exc_info = task.exception())
+            continue
+        for start, stop in lookups[cell][1]:
+            labels[start:stop] = task.result()
+
+    if pending or failed:
+        log.warning(f'{len(pending)} geocoding lookups missed the {GEOCODE_DEADLINE}s '
+                    f'deadline and {failed} failed, their segments take their neighbors\' region')
+        labels[:] = fill_unplaced(labels)
+        return False
+    return True
+
+def steps_to_segments(legs):
     '''
-    route = {'coordinates': coords,
-            'steps': 'true'}
-
-    token = os.environ.get('MAPBOX_TOKEN')
-    url = 'https://api.mapbox.com/directions/v5/mapbox/driving?access_token='
-    url += token
-
-    # This wouldn't be necessary if we had ratelimits set on our api.
-    global DIRECTIONS_API_LIMITER
-    DIRECTIONS_API_LIMITER.call()
-
-    trip = requests.post(url, data = route)
-
-    distance = 0
-    prev_reg = 0
-    cur_reg = 0
-    reg_dist_map = {'distances': [], 'regions': []}
-
-    # TODO: rethink/optimize this some. It takes 5 seconds to run locally.
-
-    # a route is made up of multiple legs determined by destinations
-    for leg in trip.json()['routes'][0]['legs']:
-        # legs are made up of steps it takes to travel the leg
-        for step in leg['steps']:
-            prev_reg = cur_reg
-            
-            # collect distance traveled
-            distance += step['distance']
-            
-            # check the end location of each step.manuever
-            # TODO is 'intersections' really the appropriate place to look?
-            # explore some more
-            coords = step['intersections'][-1]['location']
-            
-            cur_reg = coord_to_region(coords)
-            
-            if prev_reg == 0:
-                prev_reg = cur_reg
-            elif cur_reg != prev_reg:
-                reg_dist_map['distances'].append(distance)
-                distance = 0
-                reg_dist_map['regions'].append(prev_reg)
-
-    reg_dist_map['distances'].append(distance)
-    reg_dist_map['regions'].append(prev_reg)
-
-    return reg_dist_map
+    A helper function that flattens the steps of a MapBox route into arrays of
+    straight line segments. Each step's reported distance is spread over its
+    segments in proportion to their length, so the segments add up to the
+    route's distance exactly.
+
+    ### Params
+    - `legs`: the list of legs of a MapBox directions route, requested with
+    `steps=true` and `geometries=geojson`
+
+    ### Returns
+    - a tuple of (N, 2) segment start points, (N, 2) segment end points, and
+    (N,) segment distances in meters
+    '''
+    steps = [step for leg in legs for step in leg['steps']]
+    if not steps:
+        return np.zeros((0, 2)), np.zeros((0, 2)), np.zeros(0)
+
+    lines = [np.asarray(step['geometry']['coordinates'], dtype = float).reshape(-1, 2)
+             for step in steps]
+    counts = np.array([len(line) for line in lines])
+    points = np.concatenate(lines)
+    step_distances = np.array([step['distance'] for step in steps], dtype = float)
+
+    # a segment joins two consecutive points of the same step
+    owner = np.repeat(np.arange(len(steps)), counts)
+    pairs = np.flatnonzero(owner[1:] == owner[:-1])
+    owner = owner[pairs]
+    starts = points[pairs]
+    ends = points[pairs + 1]
+    lengths = haversine(starts, ends)
+
+    step_lengths = np.bincount(owner, lengths, minlength = len(steps))
+    scale = np.divide(step_distances, step_lengths,
+                      out = np.zeros(len(steps)), where = step_lengths > 0)
+    distances = lengths * scale[owner]
+
+    # steps with a distance but no geometry length keep their distance on a
+    # zero length segment at their first point
+    flat = np.flatnonzero((step_lengths == 0) & (step_distances > 0))
+    if len(flat):
+        first = points[np.cumsum(counts)[flat] - counts[flat]]
+        order = np.argsort(np.concatenate([owner, flat]), kind = 'stable')
+        starts = np.concatenate([starts, first])[order]
+        ends = np.concatenate([ends, first])[order]
+        distances = np.concatenate([distances, step_distances[flat]])[order]
+
+    return starts, ends, distances
@@ -0,0 +1,303 @@
+'''
+Async rate limiting for the third party apis we call.
+
+Limiters are token buckets that keep their state in a pluggable backend:
+
+- `MemoryBackend`: state lives in this process. Fine for `--workers 1`.
+- `FileBackend`: state lives in a small memory mapped file per limiter, locked
+with flock, so every worker on one host shares the same quota.
+- `RedisBackend`: state lives in Redis, for workers spread over hosts. Anything
+with a redis.asyncio style `eval` works, including the in-process
+`LocalRedis` stand-in.
+
+The backend for the global limiters is picked with the `RATE_LIMIT_BACKEND`
+environment variable: `memory` (default), `file` or `redis`. The production
+server's gunicorn.conf.py defaults it to `file`.
+'''
+import asyncio
+import fcntl
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+from time import monotonic, time
+
+from app.api.metrics import RATE_LIMIT_CALLS, RATE_LIMIT_WAIT_SECONDS, record
+
+
+class RateLimitExceeded(Exception):
+    '''Raised when a call would have to wait longer than allowed for a token'''
+
+
+def _reserve(tokens, updated, now, rate, capacity, max_wait):
+    '''
+    The token bucket math shared by every backend. Tokens refill continuously
+    at `rate` per second up to `capacity`. A caller that finds the bucket
+    empty reserves the next token anyway, leaving the bucket in debt, and is
+    told how long to wait for it. Later callers queue up behind that debt, so
+    waiters are served in order and the long run rate is never exceeded.
+
+    ### Returns
+    - a tuple of the new (tokens, updated) state, and the seconds to wait
+    before using the token. The wait is None, and no token is taken, if it
+    would be longer than `max_wait`.
+    '''
+    tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    wait = max(0.0, (1 - tokens) / rate)
+    if max_wait is not None and wait > max_wait:
+        return (tokens, now), None
+    return (tokens - 1, now), wait
+
+
+class MemoryBackend():
+    '''Keeps bucket state in this process'''
+    def __init__(self, clock = monotonic):
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    async def reserve(self, key, rate, capacity, max_wait = None):
+        with self._lock:
+            now = self.clock()
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            self._buckets[key], wait = _reserve(tokens, updated, now, rate,
+                                                capacity, max_wait)
+        return wait
+
+
+class FileBackend():
+    '''
+    Keeps bucket state in memory mapped files shared by every process on the
+    host. Each limiter key gets its own 16 byte file holding two doubles,
+    (tokens, updated), guarded by an exclusive flock while it is updated.
+
+    ### Params
+    - `directory`: where the state files live. Defaults to the
+    `RATE_LIMIT_DIR` environment variable, or the system temp directory
+    '''
+    _STATE = struct.Struct('dd')
+    # seconds between tries for a lock another process holds, doubling
+    LOCK_RETRY_DELAY = 0.0005
+    LOCK_RETRY_MAX_DELAY = 0.01
+
+    def __init__(self, directory = None, clock = time):
+        self.directory = directory or os.environ.get(
+            'RATE_LIMIT_DIR', os.path.join(tempfile.gettempdir(), 'resfeber-ratelimit'))
+        os.makedirs(self.directory, exist_ok = True)
+        self.clock = clock
+        self._maps = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _open(self, key):
+        # flock locks belong to the open file, which a forked worker shares
+        # with its parent, so every process opens the files for itself
+        if self._pid != os.getpid():
+            self._maps = {}
+            self._pid = os.getpid()
+        if key not in self._maps:
+            name = re.sub(r'[^\w.-]', '_', key) + '.bucket'
+            fd = os.open(os.path.join(self.directory, name), os.O_RDWR | os.O_CREAT, 0o644)
+            # a fresh file reads as all zeros, which is a full bucket below
+            if os.fstat(fd).st_size < self._STATE.size:
+                os.ftruncate(fd, self._STATE.size)
+            self._maps[key] = (fd, mmap.mmap(fd, self._STATE.size))
+        return self._maps[key]
+
+    async def reserve(self, key, rate, capacity, max_wait = None):
+        # another process holding the lock is waited out with asyncio.sleep,
+        # since a blocking flock would stall the whole event loop
+        delay = self.LOCK_RETRY_DELAY
+        while True:
+            try:
+                return self._try_reserve(key, rate, capacity, max_wait)
+            except BlockingIOError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.LOCK_RETRY_MAX_DELAY)
+
+    def _try_reserve(self, key, rate, capacity, max_wait):
+        '''Reserves a token, raising BlockingIOError if the file is locked'''
+        with self._lock:
+            fd, state = self._open(key)
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            try:
+                now = self.clock()
+                tokens, updated = self._STATE.unpack_from(state)
+                if updated == 0:
+                    tokens, updated = capacity, now
+                (tokens, updated), wait = _reserve(tokens, updated, now, rate,
+                                                   capacity, max_wait)
+                self._STATE.pack_into(state, 0, tokens, updated)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        return wait
+
+    def close(self):
+        with self._lock:
+            for fd, state in self._maps.values():
+                state.close()
+                os.close(fd)
+            self._maps = {}
+
+
+# Runs the same math as _reserve atomically inside Redis, with Redis' clock so
+# hosts with skewed clocks agree. Numbers are returned as strings because
+# Redis truncates Lua numbers to integers.
+TOKEN_BUCKET_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = math.max(0, (1 - tokens) / rate)
+if max_wait >= 0 and wait > max_wait then
+    return '-1'
+end
+tokens = tokens - 1
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return tostring(wait)
+'''
+
+
+class RedisBackend():
+    '''
+    Keeps bucket state in Redis so workers on several hosts share a quota.
+
+    ### Params
+    - `client`: a redis.asyncio client, or anything with the same `eval`
+    coroutine, like `LocalRedis`
+    - `prefix`: prepended to every limiter key
+    '''
+    def __init__(self, client, prefix = 'ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+
+    async def reserve(self, key, rate, capacity, max_wait = None):
+        wait = await self.client.eval(TOKEN_BUCKET_SCRIPT, 1, self.prefix + key,
+                                      rate, capacity, -1 if max_wait is None else max_wait)
+        wait = float(wait)
+        return None if wait < 0 else wait
+
+
+class LocalRedis():
+    '''
+    An in-process stand-in for the part of a redis.asyncio client that
+    `RedisBackend` uses, for tests and development without a Redis server.
+    Scripts run as their Python equivalents.
+    '''
+    def __init__(self, clock = time):
+        self.clock = clock
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._scripts = {TOKEN_BUCKET_SCRIPT: self._token_bucket}
+
+    async def eval(self, script, numkeys, *keys_and_args):
+        keys = keys_and_args[:numkeys]
+        args = keys_and_args[numkeys:]
+        with self._lock:
+            return self._scripts[script](keys, args)
+
+    def _token_bucket(self, keys, args):
+        rate, capacity, max_wait = (float(arg) for arg in args)
+        now = self.clock()
+        tokens, updated = self._hashes.get(keys[0], (capacity, now))
+        state, wait = _reserve(tokens, updated, now, rate, capacity,
+                               None if max_wait < 0 else max_wait)
+        if wait is None:
+            return '-1'
+        self._hashes[keys[0]] = state
+        return str(wait)
+
+
+def default_backend():
+    '''
+    Builds the backend named by the `RATE_LIMIT_BACKEND` environment variable.
+    `redis` connects to `REDIS_URL` and needs the redis package installed.
+    '''
+    name = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'file':
+        return FileBackend()
+    if name == 'redis':
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError('RATE_LIMIT_BACKEND=redis needs the redis package installed')
+        url = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+        return RedisBackend(redis.asyncio.from_url(url))
+    raise ValueError(f'Unknown RATE_LIMIT_BACKEND {name!r}')
+
+
+class TokenBucket():
+    '''
+    An async token bucket for respecting api rate limits without blocking the
+    event loop. Tokens refill continuously, so unlike a fixed one minute
+    window it never lets through a burst bigger than `capacity`.
+
+    ### Params
+    - `rate`: an integer representing the number of calls allowed per minute
+    - `endpoint`: a string containing the endpoint name. I recommend putting
+    the endpoint url here for clarity. It also names the bucket in the
+    backend, so limiters with the same endpoint share a quota.
+    - `capacity`: the most calls allowed back to back. Defaults to `rate`
+    - `backend`: where the bucket's state is kept. Defaults to a
+    `MemoryBackend`
+    - `max_wait`: the longest a call may wait for a token, in seconds, before
+    `RateLimitExceeded` is raised. Defaults to waiting as long as it takes
+
+    ### Usage
+    Create one bucket per endpoint in global space, and
+    `await bucket.acquire()` just before making a call to the api.
+    '''
+    def __init__(self, rate, endpoint = 'TokenBucket', capacity = None,
+                 backend = None, max_wait = None):
+        self.rate = rate
+        self.endpoint = endpoint
+        self.capacity = capacity or rate
+        self.backend = backend or MemoryBackend()
+        self.max_wait = max_wait
+        self.key = re.sub(r'\W+', '-', endpoint)
+
+    async def acquire(self, max_wait = None):
+        '''
+        Takes a token, sleeping without blocking the event loop until it is
+        due.
+
+        ### Params
+        - `max_wait`: overrides the bucket's `max_wait` for this call
+
+        ### Returns
+        - a float with the seconds spent waiting
+        '''
+        if max_wait is None:
+            max_wait = self.max_wait
+        wait = await self.backend.reserve(self.key, self.rate / 60.0,
+                                          self.capacity, max_wait)
+        if wait is None:
+            RATE_LIMIT_CALLS.inc(endpoint = self.endpoint, outcome = 'rejected')
+            raise RateLimitExceeded(f'{self.endpoint} is over its rate limit for at least {max_wait}s')
+
+        RATE_LIMIT_WAIT_SECONDS.observe(wait, endpoint = self.endpoint)
+        RATE_LIMIT_CALLS.inc(endpoint = self.endpoint,
+                             outcome = 'delayed' if wait > 0 else 'immediate')
+        if wait > 0:
+            record('ratelimit', wait)
+            await asyncio.sleep(wait)
+        return wait
+
+
+######################################Rate Limiters############################
+BACKEND = default_backend()
+GEOCODE_API_LIMITER = TokenBucket(rate = 600, endpoint = 'mapbox geocoding',
+                                  backend = BACKEND)
+DIRECTIONS_API_LIMITER = TokenBucket(rate = 300, endpoint = 'mapbox directions',
+                                     backend = BACKEND)
+###############################################################################
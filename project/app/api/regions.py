@@ -0,0 +1,547 @@
+'''
+Offline lookup of US states and PADD regions from (long, lat) coordinates.
+
+State outlines come from the Census Bureau's 2016 cartographic boundary file
+(cb_2016_us_state_500k) for the contiguous states and DC, simplified to ~1km
+and bundled in app/geo_data/us_states.json. Lookups use a grid bucket index
+so no network calls are made.
+'''
+from functools import lru_cache
+import json
+import math
+import os
+
+import numpy as np
+
+PADDS = {'1a':
+             ['Maine', 'New Hampshire', 'Vermont', 'Massachusetts',
+             'Connecticut', 'Rhode Island'],
+         '1b':
+             ['New York', 'New Jersey', 'Pennsylvania', 'Delaware', 'Maryland',
+             'District of Columbia'],
+         '1c':
+             ['West Virginia', 'Virginia', 'North Carolina', 'South Carolina',
+             'Georgia', 'Florida'],
+         '2':
+             ['North Dakota', 'South Dakota', 'Nebraska', 'Kansas', 'Oklahoma',
+             'Minnesota', 'Iowa', 'Missouri', 'Wisconsin', 'Illinois',
+             'Tennessee', 'Kentucky', 'Indiana', 'Ohio', 'Michigan'],
+         '3':
+             ['New Mexico', 'Texas', 'Arkansas', 'Louisiana', 'Mississippi',
+             'Alabama'],
+         '4':
+             ['Idaho', 'Utah', 'Montana', 'Wyoming', 'Colorado'],
+         '5':
+             ['Washington', 'Oregon', 'California', 'Nevada', 'Arizona',
+             'Alaska', 'Hawaii']
+        }
+
+PADD_NAMES = {'1a': 'New England', '1b': 'Central Atlantic',
+              '1c': 'Lower Atlantic', '2': 'Midwest', '3': 'Gulf Coast',
+              '4': 'Rocky Mountain', '5': 'West Coast'}
+
+STATE_TO_PADD = {state: key for key, states in PADDS.items() for state in states}
+
+STATES_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                           'geo_data', 'us_states.json')
+
+# Points this close (in degrees, ~2km) to a state outline are still counted as
+# inside it. Covers coastal roads, bridges and the ~1km simplification error.
+BORDER_TOLERANCE = 0.02
+
+# grid bucket size in degrees
+CELL_SIZE = 0.5
+
+
+class StateIndex():
+    '''
+    A grid bucket spatial index over state outlines. Each grid cell holds the
+    states whose (padded) bounding box overlaps it, and each state holds its
+    outline edges bucketed by the grid row they span, so a lookup only ray
+    casts against a handful of edges.
+
+    ### Params
+    - `features`: a list of GeoJSON features with a `name` property and a
+    Polygon or MultiPolygon geometry
+    - `cell_size`: the grid cell size in degrees
+    '''
+    def __init__(self, features, cell_size = CELL_SIZE):
+        self.cell_size = cell_size
+        self.names = []
+        self.postal = []
+        # per state: {row: (x1, y1, x2, y2) edge arrays}
+        self._rows = []
+        self._cells = {}
+
+        for feature in features:
+            geometry = feature['geometry']
+            polygons = geometry['coordinates']
+            if geometry['type'] == 'Polygon':
+                polygons = [polygons]
+
+            rings = [np.asarray(ring, dtype = float)
+                     for polygon in polygons for ring in polygon]
+            # every edge of every ring, holes included. An even-odd crossing
+            # count handles holes and islands without tracking which is which
+            edges = np.vstack([np.hstack([ring[:-1], ring[1:]]) for ring in rings])
+
+            self.names.append(feature['properties']['name'])
+            self.postal.append(feature['properties'].get('postal'))
+            self._rows.append(self._bucket_rows(edges))
+            self._add_to_cells(len(self.names) - 1, edges)
+
+    def _row(self, lat):
+        return int(math.floor(lat / self.cell_size))
+
+    def _col(self, lon):
+        return int(math.floor(lon / self.cell_size))
+
+    def _bucket_rows(self, edges):
+        '''Groups edges by every grid row their latitude span touches'''
+        rows = {}
+        lo = np.floor((np.minimum(edges[:, 1], edges[:, 3]) - BORDER_TOLERANCE)
+                      / self.cell_size).astype(int)
+        hi = np.floor((np.maximum(edges[:, 1], edges[:, 3]) + BORDER_TOLERANCE)
+                      / self.cell_size).astype(int)
+        for row in range(lo.min(), hi.max() + 1):
+            mask = (lo <= row) & (hi >= row)
+            if mask.any():
+                rows[row] = edges[mask]
+        return rows
+
+    def _add_to_cells(self, state, edges):
+        '''Registers the state with every cell its padded bounding box touches'''
+        west = self._col(min(edges[:, 0].min(), edges[:, 2].min()) - BORDER_TOLERANCE)
+        east = self._col(max(edges[:, 0].max(), edges[:, 2].max()) + BORDER_TOLERANCE)
+        south = self._row(min(edges[:, 1].min(), edges[:, 3].min()) - BORDER_TOLERANCE)
+        north = self._row(max(edges[:, 1].max(), edges[:, 3].max()) + BORDER_TOLERANCE)
+        for col in range(west, east + 1):
+            for row in range(south, north + 1):
+                self._cells.setdefault((col, row), []).append(state)
+
+    def candidates(self, lon, lat):
+        '''Returns the indexes of states that may contain the point'''
+        return self._cells.get((self._col(lon), self._row(lat)), [])
+
+    def contains(self, state, lon, lat):
+        '''Even-odd ray cast from the point towards +longitude'''
+        edges = self._rows[state].get(self._row(lat))
+        if edges is None:
+            return False
+        return bool(_crossings(edges, lon, lat) % 2)
+
+    def distance(self, state, lon, lat):
+        '''Planar distance in degrees from the point to the state's outline'''
+        edges = self._rows[state].get(self._row(lat))
+        if edges is None:
+            return math.inf
+        return float(_edge_distances(edges, lon, lat))
+
+    def locate(self, lon, lat, tolerance = BORDER_TOLERANCE):
+        '''
+        Finds the index of the state containing a point.
+
+        ### Params
+        - `lon`, `lat`: floats with the point's coordinates
+        - `tolerance`: points outside every outline, but within this many
+        degrees of one, are assigned to the nearest state
+
+        ### Returns
+        - an integer state index, or None when the point is not in any state
+        '''
+        candidates = self.candidates(lon, lat)
+        for state in candidates:
+            if self.contains(state, lon, lat):
+                return state
+
+        if tolerance > 0 and candidates:
+            distances = [self.distance(state, lon, lat) for state in candidates]
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= tolerance:
+                return candidates[nearest]
+
+        return None
+
+    def locate_many(self, points, tolerance = BORDER_TOLERANCE):
+        '''
+        Vectorized `locate` for many points at once. Points are grouped by grid
+        cell, then each group is ray cast against each candidate state's edges
+        as a single (points x edges) array operation.
+
+        ### Params
+        - `points`: an (N, 2) array of (long, lat) pairs
+        - `tolerance`: same as `locate`
+
+        ### Returns
+        - an (N,) integer array of state indexes, -1 where a point is not in
+        any state
+        '''
+        points = np.asarray(points, dtype = float).reshape(-1, 2)
+        result = np.full(len(points), -1, dtype = int)
+        if not len(points):
+            return result
+
+        cols = np.floor(points[:, 0] / self.cell_size).astype(int)
+        rows = np.floor(points[:, 1] / self.cell_size).astype(int)
+        cells, inverse = np.unique(np.stack([cols, rows], axis = 1), axis = 0,
+                                   return_inverse = True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind = 'stable')
+        groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+
+        for (col, row), members in zip(cells.tolist(), groups):
+            candidates = self._cells.get((col, row))
+            if not candidates:
+                continue
+            lon = points[members, 0][:, None]
+            lat = points[members, 1][:, None]
+
+            for state in candidates:
+                edges = self._rows[state].get(row)
+                if edges is None:
+                    continue
+                open_ = result[members] < 0
+                if not open_.any():
+                    break
+                inside = _crossings(edges, lon[open_], lat[open_]) % 2 == 1
+                result[members[open_][inside]] = state
+
+            open_ = result[members] < 0
+            if tolerance <= 0 or not open_.any():
+                continue
+            distances = np.stack([
+                _edge_distances(self._rows[state][row], lon[open_], lat[open_])
+                if row in self._rows[state] else np.full(open_.sum(), math.inf)
+                for state in candidates], axis = 1)
+            nearest = distances.argmin(axis = 1)
+            close = distances[np.arange(len(nearest)), nearest] <= tolerance
+            result[members[open_][close]] = np.asarray(candidates)[nearest[close]]
+
+        return result
+
+
+def _crossings(edges, lon, lat):
+    '''
+    Counts the edges a ray from each point towards +longitude crosses.
+    `lon` and `lat` are scalars or (M, 1) columns, counts reduce over edges.
+    '''
+    x1, y1, x2, y2 = edges.T
+    spans = (y1 > lat) != (y2 > lat)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        cross = x1 + (lat - y1) * (x2 - x1) / (y2 - y1)
+    return np.count_nonzero(spans & (lon < cross), axis = -1)
+
+
+def _edge_distances(edges, lon, lat):
+    '''
+    Planar distance in degrees from each point to the nearest edge. `lon`
+    and `lat` are scalars or (M, 1) columns.
+    '''
+    x1, y1, x2, y2 = edges.T
+    dx = x2 - x1
+    dy = y2 - y1
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        t = ((lon - x1) * dx + (lat - y1) * dy) / (dx * dx + dy * dy)
+    t = np.clip(np.nan_to_num(t), 0.0, 1.0)
+    return np.hypot(x1 + t * dx - lon, y1 + t * dy - lat).min(axis = -1)
+
+
+@lru_cache(maxsize = None)
+def get_state_index(path = STATES_PATH):
+    '''
+    Builds the state index from the bundled boundary file. The index is built
+    once per process and shared afterwards.
+    '''
+    with open(path) as f:
+        features = json.load(f)['features']
+    return StateIndex(features)
+
+
+def point_to_state(coord, tolerance = BORDER_TOLERANCE):
+    '''
+    Converts coordinates into a state name without any network calls.
+
+    ### Params
+    - `coord`: a tuple of floats representing a (long, lat) pair of
+    geocoordinates
+    - `tolerance`: how far outside a state outline, in degrees, a point may be
+    and still count as in that state
+
+    ### Returns
+    - A string with the name of the state, or None if the point is outside the
+    contiguous USA
+    '''
+    index = get_state_index()
+    state = index.locate(float(coord[0]), float(coord[1]), tolerance)
+    if state is None:
+        return None
+    return index.names[state]
+
+
+def state_to_region(state):
+    '''Returns the PADD region key for a state name, or None'''
+    return STATE_TO_PADD.get(state)
+
+
+def point_to_region(coord, tolerance = BORDER_TOLERANCE):
+    '''
+    Converts coordinates into a PADD region key (1a, 3, 1c, etc.) without any
+    network calls. Returns None if the point is outside the contiguous USA.
+    '''
+    return state_to_region(point_to_state(coord, tolerance))
+
+
+def in_contiguous_usa(coord, tolerance = BORDER_TOLERANCE):
+    '''Checks whether a (long, lat) pair falls within a contiguous US state'''
+    return point_to_state(coord, tolerance) is not None
+
+
+def points_to_regions(points, tolerance = BORDER_TOLERANCE):
+    '''
+    Batch version of `point_to_region`.
+
+    ### Params
+    - `points`: an (N, 2) array of (long, lat) pairs
+
+    ### Returns
+    - an (N,) object array of PADD region keys, None where a point is outside
+    the contiguous USA
+    '''
+    index = get_state_index()
+    states = index.locate_many(points, tolerance)
+    # the trailing None is picked by the -1 of unresolved points
+    regions = np.array([state_to_region(name) for name in index.names] + [None],
+                       dtype = object)
+    return regions[states]
+
+
+# mean earth radius in meters
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(start, end):
+    '''
+    Great circle distance in meters between arrays of (long, lat) points.
+    Shapes broadcast, the last axis holds the (long, lat) pair.
+    '''
+    start = np.radians(np.asarray(start, dtype = float))
+    end = np.radians(np.asarray(end, dtype = float))
+    dlon = end[..., 0] - start[..., 0]
+    dlat = end[..., 1] - start[..., 1]
+    a = (np.sin(dlat / 2) ** 2
+         + np.cos(start[..., 1]) * np.cos(end[..., 1]) * np.sin(dlon / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _run_starts(labels):
+    '''Indexes where a new run of equal labels begins'''
+    return np.concatenate([[0], np.flatnonzero(labels[1:] != labels[:-1]) + 1])
+
+
+def run_lengths(labels, weights):
+    '''
+    Run-length encodes consecutive equal labels, summing the weights of each
+    run.
+
+    ### Params
+    - `labels`: an (N,) array of labels
+    - `weights`: an (N,) array of floats
+
+    ### Returns
+    - a tuple of (list of run labels, (R,) array of summed weights)
+    '''
+    labels = np.asarray(labels, dtype = object)
+    weights = np.asarray(weights, dtype = float)
+    if not len(labels):
+        return [], np.zeros(0)
+    starts = _run_starts(labels)
+    return labels[starts].tolist(), np.add.reduceat(weights, starts)
+
+
+def label_segments(starts, ends):
+    '''
+    Labels straight segments with the PADD region of their midpoint.
+
+    ### Params
+    - `starts`, `ends`: (N, 2) arrays of (long, lat) segment endpoints
+
+    ### Returns
+    - an (N,) object array of region keys, None where the midpoint is outside
+    the local state outlines
+    '''
+    starts = np.asarray(starts, dtype = float).reshape(-1, 2)
+    ends = np.asarray(ends, dtype = float).reshape(-1, 2)
+    return points_to_regions((starts + ends) / 2)
+
+
+def unplaced_runs(labels):
+    '''
+    Finds the runs of consecutive segments with no region label.
+
+    ### Returns
+    - a list of (start, stop) index pairs, stop exclusive
+    '''
+    labels = np.asarray(labels, dtype = object)
+    if not len(labels):
+        return []
+    starts = _run_starts(labels)
+    stops = np.append(starts[1:], len(labels))
+    return [(int(start), int(stop)) for start, stop in zip(starts, stops)
+            if labels[start] is None]
+
+
+def split_segments(starts, ends, distances = None, labels = None):
+    '''
+    Splits a route of straight segments into distance traveled per PADD
+    region in one vectorized pass. Each segment is assigned to the region of
+    its midpoint, so on a detailed route geometry the split is exact to within
+    a segment length instead of a whole step.
+
+    ### Params
+    - `starts`, `ends`: (N, 2) arrays of (long, lat) segment endpoints in
+    route order
+    - `distances`: an optional (N,) array of segment lengths in meters. The
+    haversine length is used when not given.
+    - `labels`: optional (N,) region labels from `label_segments`, for callers
+    that filled in the segments the local outlines couldn't place
+
+    ### Returns
+    - a dictionary of meters traveled per region run, formatted like
+    `split_by_region`'s
+    '''
+    if distances is None:
+        distances = haversine(starts, ends)
+    if labels is None:
+        labels = label_segments(starts, ends)
+
+    regions, totals = run_lengths(labels, distances)
+    return {'distances': totals.tolist(), 'regions': regions}
+
+
+def _point_segment_distances(start, end, points):
+    '''Planar distance in degrees from each of (M, 2) points to one segment'''
+    d = end - start
+    length = float(d @ d)
+    if length == 0:
+        return np.hypot(*(points - start).T)
+    t = np.clip((points - start) @ d / length, 0.0, 1.0)
+    return np.hypot(*(start + t[:, None] * d - points).T)
+
+
+def simplify(points, tolerance):
+    '''
+    Simplifies a polyline with Douglas-Peucker, keeping only the points that
+    pull the line more than `tolerance` away from a straight shortcut.
+
+    ### Params
+    - `points`: an (N, 2) array of (long, lat) pairs
+    - `tolerance`: the largest deviation allowed, in degrees
+
+    ### Returns
+    - an array of the indexes of the kept points, first and last included
+    '''
+    points = np.asarray(points, dtype = float).reshape(-1, 2)
+    n = len(points)
+    if n < 3 or tolerance <= 0:
+        return np.arange(n)
+
+    keep = np.zeros(n, dtype = bool)
+    keep[[0, -1]] = True
+    # an explicit stack instead of recursion, routes have tens of thousands
+    # of points
+    stack = [(0, n - 1)]
+    while stack:
+        lo, hi = stack.pop()
+        if hi - lo < 2:
+            continue
+        distances = _point_segment_distances(points[lo], points[hi], points[lo + 1:hi])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = lo + 1 + farthest
+            keep[split] = True
+            stack.append((lo, split))
+            stack.append((split, hi))
+    return np.flatnonzero(keep)
+
+
+def boundary_fractions(starts, ends, start_labels, precision = 10.0):
+    '''
+    Finds where segments leave the region of their start, by bisection. All
+    segments are bisected together, one batch of point lookups per step.
+
+    ### Params
+    - `starts`, `ends`: (N, 2) arrays of (long, lat) segment endpoints, whose
+    ends are in a different region than their starts
+    - `start_labels`: an (N,) array of the starts' region keys
+    - `precision`: bisect until the boundary is pinned down to this many
+    meters
+
+    ### Returns
+    - an (N,) array of the fraction of each segment before its boundary.
+    A segment that crosses more than one boundary gets the first one found,
+    and a probe outside every state counts as past the boundary.
+    '''
+    starts = np.asarray(starts, dtype = float).reshape(-1, 2)
+    ends = np.asarray(ends, dtype = float).reshape(-1, 2)
+    if not len(starts):
+        return np.zeros(0)
+
+    lengths = haversine(starts, ends)
+    steps = int(np.ceil(np.log2(max(lengths.max() / precision, 1.0))))
+    lo = np.zeros(len(starts))
+    hi = np.ones(len(starts))
+    for _ in range(steps):
+        mid = (lo + hi) / 2
+        probes = starts + mid[:, None] * (ends - starts)
+        inside = points_to_regions(probes) == start_labels
+        lo = np.where(inside, mid, lo)
+        hi = np.where(inside, hi, mid)
+    return (lo + hi) / 2
+
+
+def split_polyline(points, labels, distance = None, precision = 10.0):
+    '''
+    Splits a polyline into distance traveled per PADD region, cutting the
+    segments that cross a region boundary where they cross it. Only those
+    segments are bisected, so the work grows with the number of border
+    crossings instead of the detail of the geometry.
+
+    ### Params
+    - `points`: an (N, 2) array of (long, lat) vertices in route order
+    - `labels`: an (N,) array of the vertices' region keys
+    - `distance`: the route's length in meters. The split is scaled to it,
+    since a simplified line is shorter than the road. Defaults to the
+    haversine length of the line
+    - `precision`: how closely boundaries are located, in meters
+
+    ### Returns
+    - a dictionary of meters traveled per region run, formatted like
+    `split_by_region`'s
+    '''
+    points = np.asarray(points, dtype = float).reshape(-1, 2)
+    labels = np.asarray(labels, dtype = object)
+    if len(points) < 2:
+        return {'distances': [], 'regions': []}
+
+    starts, ends = points[:-1], points[1:]
+    lengths = haversine(starts, ends)
+    before, after = labels[:-1], labels[1:]
+
+    # the fraction of each segment in its start's region
+    fractions = np.ones(len(lengths))
+    crossing = np.flatnonzero(before != after)
+    fractions[crossing] = boundary_fractions(starts[crossing], ends[crossing],
+                                             before[crossing], precision)
+
+    # every segment becomes a piece in its start's region then one in its
+    # end's region, zero length unless it crosses a boundary
+    boundaries = starts + fractions[:, None] * (ends - starts)
+    first = haversine(starts, boundaries)
+    pieces = np.stack([before, after], axis = 1).ravel()
+    weights = np.stack([first, np.maximum(lengths - first, 0.0)], axis = 1).ravel()
+    regions, totals = run_lengths(pieces, weights)
+
+    total = lengths.sum()
+    if distance is not None and total > 0:
+        totals = totals * (distance / total)
+    return {'distances': totals.tolist(), 'regions': regions}
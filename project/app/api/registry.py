@@ -0,0 +1,275 @@
+'''
+Model registry: finds model artifacts through a manifest and loads them.
+
+app/models.json lists each model's format, version and path (relative to the
+manifest). The PADD gas models are tiny linear models, so they ship as a JSON
+file of coefficients that loads in microseconds without scikit-learn. The
+Airbnb pipeline is still a pickle, and is only unpickled the first time it is
+used.
+
+Workers notice a changed manifest on their own, at most every
+MODEL_RELOAD_INTERVAL seconds (default 30, 0 turns it off), and swap in the
+new versions without a restart.
+
+To turn retrained gas model pickles into a new coefficient file:
+
+    python -m app.api.registry export-gas --version 2021.01.05
+'''
+import argparse
+import datetime
+import json
+import logging
+import os
+import pickle
+import threading
+from time import monotonic
+
+from app.api.gasprices import GasPriceTable, date_grid, verify
+
+log = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.dirname(__file__))
+MANIFEST_PATH = os.environ.get('MODEL_MANIFEST', os.path.join(APP_DIR, 'models.json'))
+
+GAS_FORMAT = 'linear-v1'
+GAS_FEATURES = ['month', 'day', 'year']
+
+# the pickles the gas coefficient file was exported from
+GAS_PICKLES = {
+    '1a': 'gas_models/new_england_gas_model.pckl',
+    '1b': 'gas_models/central_atlantic_gas_model.pckl',
+    '1c': 'gas_models/lower_atlantic_gas_model.pckl',
+    '2': 'gas_models/midwest_gas_model.pckl',
+    '3': 'gas_models/gulf_coast_gas_model.pckl',
+    '4': 'gas_models/rocky_mountain_gas_model.pckl',
+    '5': 'gas_models/west_coast_gas_model.pckl',
+}
+
+
+def load_pickle(path):
+    '''Unpickles a file, closing it afterwards'''
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_gas_table(path):
+    '''
+    Loads a `linear-v1` gas coefficient file into a GasPriceTable.
+
+    ### Returns
+    - a tuple of the GasPriceTable and the file's decoded JSON header
+    '''
+    with open(path) as f:
+        spec = json.load(f)
+    if spec.get('format') != GAS_FORMAT:
+        raise ValueError(f"{path} is format {spec.get('format')!r}, expected {GAS_FORMAT!r}")
+    if spec.get('features') != GAS_FEATURES:
+        raise ValueError(f"{path} has features {spec.get('features')}, expected {GAS_FEATURES}")
+
+    models = spec['models']
+    regions = list(models)
+    table = GasPriceTable(regions,
+                          [models[region]['coef'] for region in regions],
+                          [models[region]['intercept'] for region in regions])
+    return table, {key: value for key, value in spec.items() if key != 'models'}
+
+
+def export_gas_models(models, path, version):
+    '''
+    Writes fitted LinearRegression gas models as a `linear-v1` coefficient
+    file, after checking the exported coefficients reproduce every daily
+    prediction of the models over a ten year span bit for bit. JSON floats
+    round-trip exactly, so the file loads back to the same numbers.
+
+    ### Params
+    - `models`: a dictionary of PADD region key: LinearRegression
+    - `path`: where to write the file
+    - `version`: a string naming this version of the models
+    '''
+    table = GasPriceTable.from_models(models)
+    today = datetime.date.today()
+    dates = date_grid(today - datetime.timedelta(days = 5 * 365),
+                      today + datetime.timedelta(days = 5 * 365))
+    mismatches = verify(table, models, dates)
+    if mismatches:
+        raise ValueError(f'Exported coefficients disagree with the models, e.g. {mismatches[0]}')
+
+    spec = {'format': GAS_FORMAT,
+            'version': version,
+            'features': GAS_FEATURES,
+            'models': {region: {'coef': table.coef[i].tolist(),
+                                'intercept': float(table.intercept[i])}
+                       for i, region in enumerate(table.regions)}}
+    with open(path, 'w') as f:
+        json.dump(spec, f, indent = 2)
+        f.write('\n')
+
+
+class ModelRegistry():
+    '''
+    Holds the loaded models, loading them from the manifest on demand.
+
+    ### Params
+    - `manifest_path`: the JSON manifest listing the model artifacts
+    - `check_interval`: seconds between checks for a changed manifest. 0 or
+    None never checks
+
+    ### Usage
+    Call `load()` at startup, then read `registry.gas_prices` and
+    `registry.airbnb_model` wherever a model is needed rather than holding on
+    to them, so reloads are picked up.
+    '''
+    def __init__(self, manifest_path = MANIFEST_PATH, check_interval = None):
+        if check_interval is None:
+            check_interval = float(os.environ.get('MODEL_RELOAD_INTERVAL', 30))
+        self.manifest_path = manifest_path
+        self.check_interval = check_interval
+        self.manifest = None
+        self._gas = None
+        self._gas_info = None
+        self._airbnb = None
+        # what the loaded airbnb model was unpickled from, see `_artifact`
+        self._airbnb_artifact = None
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.RLock()
+
+    def _path(self, entry):
+        return os.path.join(os.path.dirname(self.manifest_path), entry['path'])
+
+    def _artifact(self, entry):
+        '''
+        Identifies a manifest entry's file: its path and version, and the
+        file's size and modification time. None if the file is missing.
+        '''
+        try:
+            stat = os.stat(self._path(entry))
+        except OSError:
+            return None
+        return (entry['path'], entry.get('version'), stat.st_size, stat.st_mtime_ns)
+
+    def load(self, preload = False):
+        '''
+        (Re)loads the manifest and the gas models. The Airbnb model is loaded
+        on first use, unless `preload` is set.
+        '''
+        with self._lock:
+            mtime = os.stat(self.manifest_path).st_mtime
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+
+            gas, gas_info = load_gas_table(self._path(manifest['gas']))
+            self.manifest = manifest
+            self._gas, self._gas_info = gas, gas_info
+            # a reload that didn't touch the airbnb model keeps it, so workers
+            # keep sharing the copy loaded before they were forked
+            if self._airbnb_artifact is None or self._airbnb_artifact != self._artifact(manifest['airbnb']):
+                self._airbnb, self._airbnb_artifact = None, None
+            self._mtime = mtime
+            self._checked = monotonic()
+            log.info(f"Loaded gas models {gas_info['version']}")
+
+            if preload:
+                self.airbnb_model
+        return self
+
+    def maybe_reload(self):
+        '''
+        Reloads if the manifest changed since it was loaded. Checks at most
+        every `check_interval` seconds. A failed reload keeps the models
+        already loaded.
+        '''
+        if not self.check_interval or self.manifest is None:
+            return False
+        if monotonic() - self._checked < self.check_interval:
+            return False
+
+        with self._lock:
+            self._checked = monotonic()
+            try:
+                if os.stat(self.manifest_path).st_mtime == self._mtime:
+                    return False
+                self.load()
+            except Exception:
+                log.exception('Reloading models failed, keeping the loaded ones')
+                return False
+        return True
+
+    @property
+    def gas_prices(self):
+        '''The GasPriceTable for every PADD region'''
+        self.maybe_reload()
+        if self._gas is None:
+            self.load()
+        return self._gas
+
+    @property
+    def loaded(self):
+        '''Whether a manifest has been loaded'''
+        return self.manifest is not None
+
+    @property
+    def modified(self):
+        '''When the loaded manifest last changed, as a unix timestamp'''
+        return self._mtime
+
+    @property
+    def airbnb_model(self):
+        '''The Airbnb price pipeline, unpickled the first time it's asked for'''
+        self.maybe_reload()
+        if self.manifest is None:
+            self.load()
+        model = self._airbnb
+        if model is None:
+            with self._lock:
+                if self._airbnb is None:
+                    entry = self.manifest['airbnb']
+                    self._airbnb_artifact = self._artifact(entry)
+                    self._airbnb = load_pickle(self._path(entry))
+                    log.info(f"Loaded airbnb model {entry['version']}")
+                model = self._airbnb
+        return model
+
+    def info(self):
+        '''The versions of the models in the manifest, and what's loaded'''
+        if self.manifest is None:
+            return {'loaded': False}
+        return {'loaded': True,
+                'manifest': self.manifest_path,
+                'gas': {'version': self._gas_info['version'],
+                        'regions': self._gas.regions},
+                'airbnb': {'version': self.manifest['airbnb']['version'],
+                           'loaded': self._airbnb is not None}}
+
+
+REGISTRY = ModelRegistry()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    export = commands.add_parser('export-gas', help = 'export the gas model '
+                                 'pickles to a coefficient file and point the manifest at it')
+    export.add_argument('--version', required = True)
+    export.add_argument('--manifest', default = MANIFEST_PATH)
+    args = parser.parse_args(argv)
+
+    app_dir = os.path.dirname(args.manifest)
+    models = {region: load_pickle(os.path.join(app_dir, path))
+              for region, path in GAS_PICKLES.items()}
+    name = f"gas_models/gas_models_{args.version.replace('.', '_')}.json"
+    export_gas_models(models, os.path.join(app_dir, name), args.version)
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    manifest['gas'] = {'format': GAS_FORMAT, 'version': args.version, 'path': name}
+    # written aside and renamed, so a worker reloading never reads half a file
+    with open(args.manifest + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 2)
+        f.write('\n')
+    os.replace(args.manifest + '.tmp', args.manifest)
+    print(f'Wrote {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+'''
+The api's response layer: fast JSON bodies and compression.
+
+`FastJSONResponse` is the app's default response class. It serializes with
+orjson when it's installed, which encodes NumPy arrays and scalars natively,
+and falls back to the standard library otherwise. An endpoint that already
+has its body as JSON text returns it wrapped in `RawJSON`, and it's sent as
+is instead of being encoded as a string a second time. `json_body` does the
+same for bodies built ahead of a response, like the cached figures of
+app/api/viz.py. Endpoints returning a large or NumPy-heavy body can return a
+`FastJSONResponse` themselves, which also skips FastAPI's `jsonable_encoder`
+walk over every value.
+
+`CompressionMiddleware` gzips bodies of at least `GZIP_MINIMUM_SIZE` bytes
+(default 1000) at `GZIP_LEVEL` (default 6) for clients that accept it.
+Responses that are already encoded, like the precompressed figures of
+app/api/figures.py, are passed through untouched.
+'''
+import gzip
+import io
+import json
+import os
+
+import numpy as np
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.responses import JSONResponse
+
+from app.api.metrics import SERIALIZE_SECONDS, timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+GZIP_MINIMUM_SIZE = int(os.environ.get('GZIP_MINIMUM_SIZE', 1000))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+
+
+class RawJSON(str):
+    '''
+    JSON text an endpoint has already serialized, sent as the body without
+    encoding it again. Only a whole response body is passed through; nested
+    in other content it's an ordinary string.
+    '''
+
+
+def default(obj):
+    '''Converts the NumPy values neither encoder handles directly'''
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind == 'f':
+            # NaN isn't valid JSON
+            return np.where(np.isnan(obj), None, obj).tolist()
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def dumps(content):
+    '''
+    Serializes content to compact JSON bytes, with NumPy arrays and scalars
+    as lists and numbers, and NaN as null.
+    '''
+    if orjson is not None:
+        return orjson.dumps(content, default = default,
+                            option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default = default, ensure_ascii = False, allow_nan = False,
+                      separators = (',', ':')).encode('utf-8')
+
+
+def json_body(content):
+    '''
+    A response body of JSON bytes: RawJSON as is, anything else through
+    `dumps`.
+    '''
+    if isinstance(content, RawJSON):
+        return content.encode('utf-8')
+    return dumps(content)
+
+
+class FastJSONResponse(JSONResponse):
+    '''A JSONResponse rendered with `json_body`, timing how long that takes'''
+    def render(self, content):
+        with timed('serialize', SERIALIZE_SECONDS, media_type = self.media_type):
+            return json_body(content)
+
+
+class PassThroughGZipResponder(GZipResponder):
+    '''
+    Starlette's GZipResponder, at a configurable level, that leaves responses
+    with a Content-Encoding alone.
+    '''
+    def __init__(self, app, minimum_size, compresslevel):
+        super().__init__(app, minimum_size)
+        # a new buffer, since the parent's file already wrote its header
+        self.gzip_buffer = io.BytesIO()
+        self.gzip_file = gzip.GzipFile(mode = 'wb', fileobj = self.gzip_buffer,
+                                       compresslevel = compresslevel)
+        self.encoded = False
+
+    async def send_with_gzip(self, message):
+        if message['type'] == 'http.response.start':
+            self.encoded = 'content-encoding' in Headers(raw = message['headers'])
+        if self.encoded:
+            await self.send(message)
+            return
+        await super().send_with_gzip(message)
+
+
+class CompressionMiddleware(GZipMiddleware):
+    '''
+    ASGI middleware gzipping response bodies of at least `minimum_size`
+    bytes for clients that accept gzip.
+
+    ### Params
+    - `minimum_size`: smaller bodies are sent uncompressed
+    - `compresslevel`: the gzip level, 1 (fastest) to 9 (smallest)
+    '''
+    def __init__(self, app, minimum_size = GZIP_MINIMUM_SIZE, compresslevel = GZIP_LEVEL):
+        super().__init__(app, minimum_size)
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and 'gzip' in Headers(scope = scope).get('Accept-Encoding', ''):
+            responder = PassThroughGZipResponder(self.app, self.minimum_size, self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
@@ -1,12 +1,199 @@
-from fastapi import APIRouter, HTTPException
+import asyncio
+import datetime
+import logging
+import os
+import time
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query, Request
+import numpy as np
 import pandas as pd
 import plotly.express as px
 
+from app.api.downsample import downsample
+from app.api.figures import FigureCache, RenderedBody, conditional_response
+from app.api.fred import SeriesStore, refresh_forever, slice_dates
+from app.api.gasprices import date_rows
+from app.api.regions import PADD_NAMES
+from app.api.registry import REGISTRY
+from app.api.responses import RawJSON, dumps, json_body
+
+log = logging.getLogger(__name__)
 router = APIRouter()
 
+STATECODES = {
+    'AL': 'Alabama', 'AK': 'Alaska', 'AZ': 'Arizona', 'AR': 'Arkansas', 
+    'CA': 'California', 'CO': 'Colorado', 'CT': 'Connecticut', 
+    'DE': 'Delaware', 'DC': 'District of Columbia', 'FL': 'Florida', 
+    'GA': 'Georgia', 'HI': 'Hawaii', 'ID': 'Idaho', 'IL': 'Illinois', 
+    'IN': 'Indiana', 'IA': 'Iowa', 'KS': 'Kansas', 'KY': 'Kentucky', 
+    'LA': 'Louisiana', 'ME': 'Maine', 'MD': 'Maryland', 
+    'MA': 'Massachusetts', 'MI': 'Michigan', 'MN': 'Minnesota', 
+    'MS': 'Mississippi', 'MO': 'Missouri', 'MT': 'Montana', 
+    'NE': 'Nebraska', 'NV': 'Nevada', 'NH': 'New Hampshire', 
+    'NJ': 'New Jersey', 'NM': 'New Mexico', 'NY': 'New York', 
+    'NC': 'North Carolina', 'ND': 'North Dakota', 'OH': 'Ohio', 
+    'OK': 'Oklahoma', 'OR': 'Oregon', 'PA': 'Pennsylvania', 
+    'RI': 'Rhode Island', 'SC': 'South Carolina', 'SD': 'South Dakota', 
+    'TN': 'Tennessee', 'TX': 'Texas', 'UT': 'Utah', 'VT': 'Vermont', 
+    'VA': 'Virginia', 'WA': 'Washington', 'WV': 'West Virginia', 
+    'WI': 'Wisconsin', 'WY': 'Wyoming'
+}
+
+# local copies of each state's unemployment rate series, see app/api/fred.py
+STORE = SeriesStore()
+FRED_REFRESH_INTERVAL = float(os.environ.get('FRED_REFRESH_INTERVAL', 6 * 60 * 60))
+_REFRESH_TASK = None
+
+# serialized figures, rebuilt only when their series changes
+FIGURES = FigureCache()
+
+# the most points per series a downsampled chart may ask for
+MAX_POINTS = 5000
+# the longest span of daily gas prices a chart may ask for
+MAX_GAS_DAYS = 20 * 366
+
+
+def series_id(statecode):
+    '''The FRED series id of a state's unemployment rate'''
+    return f'{statecode}UR'
+
+
+@router.on_event('startup')
+async def start_refresh():
+    '''
+    Keeping every state's series up to date in the background, so requests
+    only read local data.
+    '''
+    global _REFRESH_TASK
+    if FRED_REFRESH_INTERVAL > 0:
+        series = [series_id(statecode) for statecode in STATECODES]
+        _REFRESH_TASK = asyncio.ensure_future(
+            refresh_forever(STORE, series, FRED_REFRESH_INTERVAL))
+
+
+@router.on_event('shutdown')
+async def stop_refresh():
+    global _REFRESH_TASK
+    if _REFRESH_TASK is not None:
+        _REFRESH_TASK.cancel()
+    _REFRESH_TASK = None
+
+
+@router.get('/viz/unemployment', tags = ['Visualizations'])
+async def viz_unemployment(request: Request,
+                           states: str = Query(..., example = 'IL,WA,TX'),
+                           start: Optional[datetime.date] = Query(None, example = '2010-01-01'),
+                           end: Optional[datetime.date] = Query(None, example = '2020-12-31'),
+                           points: int = Query(500, ge = 3, le = MAX_POINTS),
+                           method: str = Query('lttb', regex = '^(lttb|minmax)$'),
+                           format: str = Query('figure', regex = '^(figure|object|data)$')):
+    """
+    Compare the unemployment rates of several states over a date range 📈
+
+    ### Query Parameters
+    - `states`: comma separated [USPS 2 letter abbreviations](https://en.wikipedia.org/wiki/List_of_U.S._state_and_territory_abbreviations#Table)
+    (case insensitive)
+    - `start`, `end`: __optional__ dates bounding the range, inclusive.
+    Defaults to the whole history
+    - `points`: the most points per state. Longer series are downsampled
+    - `method`: `lttb` (default) keeps the shape of each line, `minmax` keeps
+    every bucket's high and low
+    - `format`: `figure` (default) for a JSON string to render with
+    [react-plotly.js](https://plotly.com/javascript/react/), like
+    `/viz/{statecode}`, `object` for the same figure as a JSON object, or
+    `data` for the raw series
+
+    ### Response
+    - the figure, or `series`: a list with each state's `name`, `label` and
+    its `x` dates and `y` values
+    """
+    codes = parse_codes(states, STATECODES, 'State code', str.upper)
+    check_range(start, end)
+    ids = [series_id(code) for code in codes]
+    versions = tuple(STORE.version(series) for series in ids)
+    cache_key = ('unemployment', tuple(codes), start, end, points, method, format)
+    rendered = FIGURES.get(cache_key, versions) if all(versions) else None
+    if rendered is not None:
+        return conditional_response(request, rendered)
+
+    try:
+        stored = await asyncio.gather(*(STORE.load(series) for series in ids))
+    except Exception:
+        log.warning(f'No local data for one of {codes} and FRED is unreachable', exc_info=True)
+        raise HTTPException(status_code=503, detail='Unemployment data is unavailable right now, try again later')
+    if not all(versions):
+        versions = tuple(STORE.version(series) or (0, time.time_ns()) for series in ids)
+
+    series = []
+    for code, records in zip(codes, stored):
+        records = slice_dates(records, to_day(start), to_day(end))
+        x, y = downsample(records['date'], records['value'], points, method)
+        series.append({'name': code, 'label': STATECODES[code], 'x': x, 'y': y})
+
+    title = ', '.join(STATECODES[code] for code in codes) + ' Unemployment Rate'
+    rendered = render_series(series, format, title, 'Percent', 'State',
+                             last_modified = max(version[1] for version in versions) / 1e9)
+    FIGURES.set(cache_key, versions, rendered)
+    return conditional_response(request, rendered)
+
+
+@router.get('/viz/gas', tags = ['Visualizations'])
+async def viz_gas(request: Request,
+                  regions: Optional[str] = Query(None, example = '1a,2,5'),
+                  start: Optional[datetime.date] = Query(None, example = '2021-01-01'),
+                  end: Optional[datetime.date] = Query(None, example = '2021-12-31'),
+                  points: int = Query(500, ge = 3, le = MAX_POINTS),
+                  method: str = Query('lttb', regex = '^(lttb|minmax)$'),
+                  format: str = Query('figure', regex = '^(figure|object|data)$')):
+    """
+    Compare the predicted daily gas prices of PADD regions over a date range ⛽
+
+    ### Query Parameters
+    - `regions`: __optional__ comma separated PADD region keys, ie `1a,5`.
+    Defaults to every region
+    - `start`, `end`: __optional__ dates bounding the range, inclusive.
+    Default to a year before and after today
+    - `points`, `method`, `format`: the same as `/viz/unemployment`
+
+    ### Response
+    - the figure, or `series`: a list with each region's `name`, `label` and
+    its `x` dates and `y` prices per gallon
+    """
+    table = REGISTRY.gas_prices
+    keys = table.regions if regions is None else parse_codes(regions, table.regions, 'PADD region', str.lower)
+    today = datetime.date.today()
+    # a year either side of today, within the dates there are
+    start = start or today - datetime.timedelta(days = min(365, (today - datetime.date.min).days))
+    end = end or today + datetime.timedelta(days = min(365, (datetime.date.max - today).days))
+    check_range(start, end)
+    if (end - start).days >= MAX_GAS_DAYS:
+        raise HTTPException(status_code=422, detail=f'Gas price ranges are limited to {MAX_GAS_DAYS} days')
+
+    version = (REGISTRY.info()['gas']['version'], REGISTRY.modified)
+    cache_key = ('gas', tuple(keys), start, end, points, method, format)
+    rendered = FIGURES.get(cache_key, version)
+    if rendered is not None:
+        return conditional_response(request, rendered)
+
+    # every region's price on every day, in one matrix product
+    days = np.arange(to_day(start), to_day(end) + np.timedelta64(1, 'D'))
+    prices = table.all_prices(date_rows(days))
+    series = []
+    for region, column in zip(keys, table.index(keys)):
+        x, y = downsample(days, prices[:, column], points, method)
+        series.append({'name': region, 'label': f'PADD {region} ({PADD_NAMES.get(region, region)})',
+                       'x': x, 'y': y})
+
+    rendered = render_series(series, format, 'Predicted Gas Prices', 'Dollars per Gallon',
+                             'Region', last_modified = version[1])
+    FIGURES.set(cache_key, version, rendered)
+    return conditional_response(request, rendered)
+
 
 @router.get('/viz/{statecode}', tags = ['Visualizations'])
-async def viz(statecode: str):
+async def viz(statecode: str, request: Request,
+              format: str = Query('figure', regex = '^(figure|object)$')):
     """
     Visualize state unemployment rate from [Federal Reserve Economic Data](https://fred.stlouisfed.org/) 📈
     
@@ -14,41 +201,140 @@ async def viz(statecode: str):
     `statecode`: The [USPS 2 letter abbreviation](https://en.wikipedia.org/wiki/List_of_U.S._state_and_territory_abbreviations#Table) 
     (case insensitive) for any of the 50 states or the District of Columbia.
 
+    ### Query Parameter
+    `format`: __optional__ `figure` (default) or `object`, the same figure
+    as a JSON object instead of a string
+
     ### Response
     JSON string to render with [react-plotly.js](https://plotly.com/javascript/react/) 
+
+    Responses carry an ETag and Last-Modified, so dashboards can revalidate
+    with If-None-Match or If-Modified-Since and get a 304 back until the
+    state's data changes. Bodies are sent gzip or brotli compressed when the
+    client accepts it.
     """
 
-    # Validate the state code
-    statecodes = {
-        'AL': 'Alabama', 'AK': 'Alaska', 'AZ': 'Arizona', 'AR': 'Arkansas', 
-        'CA': 'California', 'CO': 'Colorado', 'CT': 'Connecticut', 
-        'DE': 'Delaware', 'DC': 'District of Columbia', 'FL': 'Florida', 
-        'GA': 'Georgia', 'HI': 'Hawaii', 'ID': 'Idaho', 'IL': 'Illinois', 
-        'IN': 'Indiana', 'IA': 'Iowa', 'KS': 'Kansas', 'KY': 'Kentucky', 
-        'LA': 'Louisiana', 'ME': 'Maine', 'MD': 'Maryland', 
-        'MA': 'Massachusetts', 'MI': 'Michigan', 'MN': 'Minnesota', 
-        'MS': 'Mississippi', 'MO': 'Missouri', 'MT': 'Montana', 
-        'NE': 'Nebraska', 'NV': 'Nevada', 'NH': 'New Hampshire', 
-        'NJ': 'New Jersey', 'NM': 'New Mexico', 'NY': 'New York', 
-        'NC': 'North Carolina', 'ND': 'North Dakota', 'OH': 'Ohio', 
-        'OK': 'Oklahoma', 'OR': 'Oregon', 'PA': 'Pennsylvania', 
-        'RI': 'Rhode Island', 'SC': 'South Carolina', 'SD': 'South Dakota', 
-        'TN': 'Tennessee', 'TX': 'Texas', 'UT': 'Utah', 'VT': 'Vermont', 
-        'VA': 'Virginia', 'WA': 'Washington', 'WV': 'West Virginia', 
-        'WI': 'Wisconsin', 'WY': 'Wyoming'
-    }
     statecode = statecode.upper()
-    if statecode not in statecodes:
+    if statecode not in STATECODES:
         raise HTTPException(status_code=404, detail=f'State code {statecode} not found')
 
-    # Get the state's unemployment rate data from FRED
-    url = f'https://fred.stlouisfed.org/graph/fredgraph.csv?id={statecode}UR'
-    df = pd.read_csv(url, parse_dates=['DATE'])
+    # The figure is only rebuilt when the state's series has changed since it
+    # was last served
+    series = series_id(statecode)
+    version = STORE.version(series)
+    rendered = FIGURES.get((statecode, format), version) if version else None
+    if rendered is None:
+        rendered = await render_viz(statecode, version, format)
+
+    return conditional_response(request, rendered)
+
+
+async def render_viz(statecode, version, format = 'figure'):
+    '''
+    Builds and caches a state's unemployment rate figure.
+
+    ### Params
+    - `statecode`: an upper case USPS state code
+    - `version`: the `SeriesStore.version` of the state's series read before
+    its data, or None if nothing was stored
+    - `format`: 'figure' or 'object', see `figure_body`
+
+    ### Returns
+    - a RenderedBody with the figure's JSON
+    '''
+    # Get the state's unemployment rate data from the local copy of FRED.
+    # Only a state nobody has asked for since the data directory was created
+    # waits on a download.
+    series = series_id(statecode)
+    try:
+        df = await STORE.frame(series)
+    except Exception:
+        log.warning(f'No local data for {statecode} and FRED is unreachable', exc_info=True)
+        raise HTTPException(status_code=503, detail='Unemployment data is unavailable right now, try again later')
     df.columns = ['Date', 'Percent']
+    if version is None:
+        version = STORE.version(series) or (0, time.time_ns())
 
     # Make Plotly figure
-    statename = statecodes[statecode]
+    statename = STATECODES[statecode]
     fig = px.line(df, x='Date', y='Percent', title=f'{statename} Unemployment Rate')
 
-    # Return Plotly figure as JSON string
-    return fig.to_json()
+    body = figure_body(fig, format)
+    rendered = RenderedBody(body, last_modified=version[1] / 1e9)
+    FIGURES.set((statecode, format), version, rendered)
+    return rendered
+
+
+def parse_codes(codes, known, kind, normalize):
+    '''
+    Splits a comma separated list of codes, dropping repeats. Unknown codes
+    are a 404, like `/viz/{statecode}`.
+
+    ### Params
+    - `codes`: the comma separated string
+    - `known`: the valid codes
+    - `kind`: what the codes are, for the error message
+    - `normalize`: a function fixing a code's case, ie `str.upper`
+    '''
+    parsed = []
+    for code in codes.split(','):
+        code = normalize(code.strip())
+        if code not in known:
+            raise HTTPException(status_code=404, detail=f'{kind} {code} not found')
+        if code not in parsed:
+            parsed.append(code)
+    return parsed
+
+
+def check_range(start, end):
+    if start is not None and end is not None and start > end:
+        raise HTTPException(status_code=422, detail='start must be on or before end')
+
+
+def to_day(date):
+    '''A date as a numpy datetime64, or None'''
+    return None if date is None else np.datetime64(date, 'D')
+
+
+def render_series(series, format, title, value_label, series_label, last_modified):
+    '''
+    Renders downsampled series as a figure or as raw data.
+
+    ### Params
+    - `series`: a list of dictionaries with each series' `name`, `label`, and
+    `x` datetime64 and `y` arrays
+    - `format`: 'figure', 'object' or 'data'
+    - `title`, `value_label`, `series_label`: the figure's title and the
+    names of its y axis and legend
+    - `last_modified`: a unix timestamp of when the data last changed
+
+    ### Returns
+    - a RenderedBody
+    '''
+    if format == 'data':
+        # NaN values are sent as null
+        body = dumps({'series': [
+            {'name': s['name'], 'label': s['label'],
+             'x': np.datetime_as_string(s['x'].astype('M8[D]')).tolist(),
+             'y': np.asarray(s['y'], dtype = float)}
+            for s in series]})
+        return RenderedBody(body, last_modified)
+
+    df = pd.DataFrame({
+        'Date': np.concatenate([s['x'].astype('M8[D]') for s in series]).astype('M8[ns]'),
+        value_label: np.concatenate([s['y'] for s in series]),
+        series_label: np.repeat([s['label'] for s in series], [len(s['x']) for s in series]),
+    })
+    fig = px.line(df, x='Date', y=value_label, color=series_label, title=title)
+    return RenderedBody(figure_body(fig, format), last_modified)
+
+
+def figure_body(fig, format):
+    '''
+    A figure's response body. `figure` is the figure's JSON string, itself
+    JSON encoded, as it was when FastAPI serialized the string endpoints
+    returned, and `object` is the figure's JSON as is.
+    '''
+    if format == 'object':
+        return json_body(RawJSON(fig.to_json()))
+    return json_body(fig.to_json())
@@ -0,0 +1,393 @@
+'''
+Offline benchmarks of the api's hot paths.
+
+MapBox is replaced by the local stub in app/mapbox_stub.py, answering
+after `--delay` seconds like a real round trip would, and FRED by the CSV
+fixtures in app/tests/fixtures/fred, so runs are repeatable and never touch
+the network or a rate limited account. Routes and geocodes are cached in
+private in-memory caches for the run, so a deployment's persistent caches
+are neither cleared nor filled with the stub's answers. Each scenario drives its target with
+`--concurrency` requests in flight and reports latency percentiles,
+throughput, and the time spent in each stage (MapBox calls, rate limiter
+waits, model predictions, serialization) from the histograms in
+app/api/metrics.py.
+
+Results are saved as JSON, so runs on two commits can be compared:
+
+    python -m app.benchmark --output bench-before.json
+    git checkout my-branch
+    python -m app.benchmark --output bench-after.json --compare bench-before.json
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import httpx
+import numpy as np
+
+from app.api import mapbox, metrics, predict, viz
+from app.api.cache import LRUCache, TieredCache
+from app.api.fred import FixtureSource, SeriesStore
+from app.api.geocache import GeocodeCache
+from app.api.registry import ModelRegistry
+from app.main import app
+from app.mapbox_stub import MapboxStub, straight_route
+
+FRED_FIXTURES = os.path.join(os.path.dirname(__file__), 'tests', 'fixtures', 'fred')
+
+# (long, lat) of cities spread over every PADD region
+CITIES = {
+    'Seattle': (-122.3321, 47.6062),
+    'Portland': (-122.6765, 45.5231),
+    'Boise': (-116.2023, 43.6150),
+    'Las Vegas': (-115.1398, 36.1699),
+    'Denver': (-104.9903, 39.7392),
+    'Albuquerque': (-106.6504, 35.0844),
+    'Dallas': (-96.7970, 32.7767),
+    'Houston': (-95.3698, 29.7604),
+    'Kansas City': (-94.5786, 39.0997),
+    'Chicago': (-87.6298, 41.8781),
+    'Nashville': (-86.7816, 36.1627),
+    'Atlanta': (-84.3880, 33.7490),
+    'Columbus': (-82.9988, 39.9612),
+    'Richmond': (-77.4360, 37.5407),
+    'Philadelphia': (-75.1652, 39.9526),
+    'Boston': (-71.0589, 42.3601),
+}
+
+# the stages of a request, read from the metrics histograms
+STAGES = [
+    ('directions', metrics.UPSTREAM_SECONDS, {'endpoint': 'directions'}),
+    ('geocode', metrics.UPSTREAM_SECONDS, {'endpoint': 'geocoding'}),
+    ('directions_rate_limit', metrics.RATE_LIMIT_WAIT_SECONDS, {'endpoint': 'mapbox directions'}),
+    ('geocode_rate_limit', metrics.RATE_LIMIT_WAIT_SECONDS, {'endpoint': 'mapbox geocoding'}),
+    ('route_exact', metrics.ROUTE_SECONDS, {'mode': 'exact'}),
+    ('route_fast', metrics.ROUTE_SECONDS, {'mode': 'fast'}),
+    ('predict_gas', metrics.PREDICT_SECONDS, {'model': 'gas'}),
+    ('predict_airbnb', metrics.PREDICT_SECONDS, {'model': 'airbnb'}),
+    ('serialize', metrics.SERIALIZE_SECONDS, {'media_type': 'application/json'}),
+]
+
+
+def city_routes(count, stops = 2, seed = 0):
+    '''
+    Makes `count` distinct routes between random cities.
+
+    ### Returns
+    - a list of 'long,lat;long,lat' strings
+    '''
+    if count > math.perm(len(CITIES), stops):
+        raise ValueError(f'There are only {math.perm(len(CITIES), stops)} routes '
+                         f'with {stops} stops between the cities')
+    rng = random.Random(seed)
+    names = sorted(CITIES)
+    routes = []
+    seen = set()
+    while len(routes) < count:
+        trip = tuple(rng.sample(names, stops))
+        if trip in seen:
+            continue
+        seen.add(trip)
+        routes.append(';'.join(f'{CITIES[name][0]},{CITIES[name][1]}' for name in trip))
+    return routes
+
+
+def summarize(latencies, errors, seconds):
+    '''
+    Latency percentiles and throughput of a run.
+
+    ### Params
+    - `latencies`: the seconds each successful call took
+    - `errors`: the number of failed calls
+    - `seconds`: the wall clock time of the whole run
+    '''
+    latencies = np.asarray(latencies, dtype = float) * 1000
+    summary = {'requests': len(latencies) + errors, 'errors': errors,
+               'seconds': round(seconds, 4),
+               'throughput': round(len(latencies) / seconds, 2) if seconds > 0 else None}
+    if len(latencies):
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        summary.update({'mean_ms': round(latencies.mean(), 3), 'p50_ms': round(p50, 3),
+                        'p90_ms': round(p90, 3), 'p99_ms': round(p99, 3),
+                        'max_ms': round(latencies.max(), 3)})
+    return summary
+
+
+def stage_snapshot():
+    return {name: histogram.snapshot(**labels) for name, histogram, labels in STAGES}
+
+
+def stage_delta(before, after):
+    '''The calls to and time spent in each stage between two snapshots'''
+    stages = {}
+    for name, (count, total) in after.items():
+        count -= before[name][0]
+        total -= before[name][1]
+        if count:
+            stages[name] = {'calls': count, 'total_seconds': round(total, 4),
+                            'mean_ms': round(total / count * 1000, 3)}
+    return stages
+
+
+async def run_load(call, requests, concurrency):
+    '''
+    Awaits `call(i)` for i in range(requests), at most `concurrency` at a
+    time. A call fails by raising.
+
+    ### Returns
+    - a summary of the run, with a breakdown of the time spent per stage
+    '''
+    limit = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def one(i):
+        async with limit:
+            started = perf_counter()
+            try:
+                await call(i)
+            except Exception as e:
+                errors.append(repr(e))
+            else:
+                latencies.append(perf_counter() - started)
+
+    before = stage_snapshot()
+    started = perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    summary = summarize(latencies, len(errors), perf_counter() - started)
+    summary['stages'] = stage_delta(before, stage_snapshot())
+    if errors:
+        summary['first_error'] = errors[0]
+    return summary
+
+
+def checked(response):
+    '''Raises for an unexpected status, so it's counted as an error'''
+    if response.status_code not in (200, 304):
+        raise RuntimeError(f'{response.request.url.path} returned {response.status_code}: {response.text[:200]}')
+    return response
+
+
+async def bench_load_models(args, client):
+    '''Cold loads of the model registry, like every worker's startup'''
+    latencies = []
+    started = perf_counter()
+    for _ in range(args.repeat):
+        t = perf_counter()
+        ModelRegistry(check_interval = 0).load()
+        latencies.append(perf_counter() - t)
+    summary = summarize(latencies, 0, perf_counter() - started)
+
+    t = perf_counter()
+    try:
+        ModelRegistry(check_interval = 0).load(preload = True)
+    except Exception as e:
+        summary['airbnb_preload_error'] = repr(e)
+    else:
+        summary['airbnb_preload_seconds'] = round(perf_counter() - t, 4)
+    return summary
+
+
+async def bench_split_by_region(args, client):
+    '''Route splits straight through MapBox, then from the route cache'''
+    routes = city_routes(args.requests, stops = 3, seed = 1)
+    predict.ROUTE_CACHE.clear()
+
+    async def split(i):
+        await predict.split_by_region(routes[i])
+
+    cold = await run_load(split, len(routes), args.concurrency)
+    warm = await run_load(split, len(routes), args.concurrency)
+    return {'cold': cold, 'cached': warm}
+
+
+async def bench_predict_gas(args, client):
+    '''`/predict/gas` end to end, on uncached routes and in fast mode'''
+    routes = city_routes(args.requests, stops = 3, seed = 2)
+    predict.ROUTE_CACHE.clear()
+
+    def trip(mode):
+        async def call(i):
+            checked(await client.post('/predict/gas', json = {
+                'coords': routes[i], 'year': 2021, 'month': 7, 'day': 13, 'mode': mode}))
+        return call
+
+    return {'exact': await run_load(trip('exact'), len(routes), args.concurrency),
+            'fast': await run_load(trip('fast'), len(routes), args.concurrency)}
+
+
+async def bench_predict_airbnb(args, client):
+    '''`/predict/airbnb` end to end, with the pickled model'''
+    try:
+        predict.REGISTRY.airbnb_model
+    except Exception as e:
+        return {'skipped': f'the airbnb model could not be loaded: {e!r}'}
+
+    rng = random.Random(3)
+    stays = [{'Airbnb_lat': rng.randint(30, 47), 'Airbnb_long': rng.randint(-122, -72),
+              'Airbnb_nights': rng.randint(1, 7)} for _ in range(args.requests)]
+
+    async def call(i):
+        checked(await client.post('/predict/airbnb', json = stays[i]))
+
+    return await run_load(call, len(stays), args.concurrency)
+
+
+async def bench_viz(args, client):
+    '''The visualizations, rendered from scratch and then from the figure cache'''
+    paths = ['/viz/IL', '/viz/WA', '/viz/unemployment?states=IL,WA&points=50']
+
+    async def call(i):
+        checked(await client.get(paths[i % len(paths)], headers = {'Accept-Encoding': 'gzip'}))
+
+    results = {}
+    viz.FIGURES.clear()
+    results['render'] = await run_load(call, len(paths), 1)
+    results['cached'] = await run_load(call, args.requests, args.concurrency)
+    return results
+
+
+SCENARIOS = {
+    'load_models': bench_load_models,
+    'split_by_region': bench_split_by_region,
+    'predict_gas': bench_predict_gas,
+    'predict_airbnb': bench_predict_airbnb,
+    'viz': bench_viz,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True,
+                              text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    '''
+    Runs the chosen scenarios against the offline stand-ins.
+
+    ### Returns
+    - a dictionary of the run's settings and each scenario's results
+    '''
+    results = {'commit': git_commit(),
+               'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+               'python': platform.python_version(),
+               'settings': {'requests': args.requests, 'concurrency': args.concurrency,
+                            'delay': args.delay, 'points_per_leg': args.points_per_leg,
+                            'repeat': args.repeat},
+               'scenarios': {}}
+
+    def directions(coords):
+        return straight_route(coords, points_per_leg = args.points_per_leg)
+
+    saved = (os.environ.get('MAPBOX_URL'), os.environ.get('MAPBOX_TOKEN'), viz.STORE,
+             predict.ROUTE_CACHE, predict.GEOCODE_CACHE)
+    with MapboxStub(directions = directions, delay = args.delay) as stub, \
+            tempfile.TemporaryDirectory() as fred_dir:
+        os.environ['MAPBOX_URL'] = stub.url
+        os.environ['MAPBOX_TOKEN'] = 'benchmark'
+        mapbox._CLIENT = None
+        viz.STORE = SeriesStore(fred_dir, FixtureSource(FRED_FIXTURES))
+        routes = predict.ROUTE_CACHE.memory
+        geocodes = predict.GEOCODE_CACHE.cache.memory
+        predict.ROUTE_CACHE = TieredCache(LRUCache(routes.maxsize, routes.ttl))
+        predict.GEOCODE_CACHE = GeocodeCache(TieredCache(LRUCache(geocodes.maxsize, geocodes.ttl)),
+                                             predict.GEOCODE_CACHE.cell_size)
+        await predict.load_models()
+        transport = httpx.ASGITransport(app = app)
+        try:
+            async with httpx.AsyncClient(transport = transport, base_url = 'http://benchmark') as client:
+                for name in args.scenarios:
+                    print(f'Running {name}', file = sys.stderr)
+                    results['scenarios'][name] = await SCENARIOS[name](args, client)
+        finally:
+            await mapbox.close_client()
+            mapbox._CLIENT = None
+            viz.STORE, predict.ROUTE_CACHE, predict.GEOCODE_CACHE = saved[2:]
+            for key, value in zip(['MAPBOX_URL', 'MAPBOX_TOKEN'], saved[:2]):
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+    return results
+
+
+def runs(scenario):
+    '''Flattens a scenario's results into (name, summary) pairs'''
+    if 'requests' in scenario or 'skipped' in scenario:
+        return [('', scenario)]
+    return [(f'.{name}', summary) for name, summary in scenario.items()]
+
+
+def compare(previous, current):
+    '''
+    Lines comparing each run's median latency and throughput with a
+    previous result file's.
+    '''
+    lines = []
+    for name, scenario in current['scenarios'].items():
+        before = dict(runs(previous.get('scenarios', {}).get(name, {})))
+        for suffix, summary in runs(scenario):
+            old = before.get(suffix)
+            if not old or 'p50_ms' not in old or 'p50_ms' not in summary:
+                continue
+            p50 = (summary['p50_ms'] / old['p50_ms'] - 1) * 100 if old['p50_ms'] else 0.0
+            line = f'{name}{suffix}: p50 {old["p50_ms"]:.2f} -> {summary["p50_ms"]:.2f} ms ({p50:+.1f}%)'
+            if old.get('throughput') and summary.get('throughput'):
+                throughput = (summary['throughput'] / old['throughput'] - 1) * 100
+                line += f', throughput {old["throughput"]:.1f} -> {summary["throughput"]:.1f}/s ({throughput:+.1f}%)'
+            lines.append(line)
+    return lines
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('scenarios', nargs = '*', metavar = 'scenario',
+                        help = f'scenarios to run, from {", ".join(SCENARIOS)}. Defaults to all')
+    parser.add_argument('--requests', type = int, default = 100,
+                        help = 'calls per run')
+    parser.add_argument('--concurrency', type = int, default = 16,
+                        help = 'calls in flight at once')
+    parser.add_argument('--delay', type = float, default = 0.05,
+                        help = 'seconds the MapBox stub takes to answer')
+    parser.add_argument('--points-per-leg', type = int, default = 500,
+                        help = 'points in each leg of the stub\'s routes')
+    parser.add_argument('--repeat', type = int, default = 20,
+                        help = 'cold model registry loads')
+    parser.add_argument('--output', help = 'file to save the results to as JSON')
+    parser.add_argument('--compare', help = 'a previous results file to compare with')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios {", ".join(sorted(unknown))}')
+    args.scenarios = args.scenarios or list(SCENARIOS)
+
+    results = asyncio.run(run(args))
+    text = json.dumps(results, indent = 2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print(f'Compared with {previous.get("commit")}:', file = sys.stderr)
+        for line in compare(previous, results):
+            print(line, file = sys.stderr)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,32 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 import uvicorn
 
-from app.api import predict, viz
+from app.api import metrics, predict, responses, viz
 
 app = FastAPI(
     title='Resfeber B DS API',
     description='An api for serving up gas cost predictions, arbnb price price predictions, and visulalizations for both.',
     version='1.0',
     docs_url='/',
+    default_response_class=responses.FastJSONResponse,
 )
 
 app.include_router(predict.router)
 app.include_router(viz.router)
 
+
+@app.get('/metrics', tags=['Ops'], response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """
+    Latency histograms and counters of this worker in the Prometheus text
+    format, for scraping.
+    """
+    return PlainTextResponse(metrics.render_metrics(),
+                             media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=['*'],
@@ -21,6 +34,8 @@ app.add_middleware(
     allow_methods=['*'],
     allow_headers=['*'],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(responses.CompressionMiddleware)
 
 if __name__ == '__main__':
     uvicorn.run(app)
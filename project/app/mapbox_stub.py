@@ -0,0 +1,155 @@
+'''
+A local stand-in for the MapBox directions and geocoding apis, served from a
+background thread so tests and benchmarks never touch the network.
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from app.api.regions import haversine, point_to_state
+
+GEOCODE_PATH = re.compile(r'/geocoding/v5/mapbox.places/([-\d.]+),([-\d.]+)\.json')
+DIRECTIONS_PATH = '/directions/v5/mapbox/driving'
+
+
+def straight_route(coords, points_per_leg = 50):
+    '''
+    Builds a directions response that drives in a straight line between
+    stops, with one step per leg. The overview geometry is every leg's line
+    joined together.
+
+    ### Params
+    - `coords`: a string with long,latitude pairs separated by semicolons
+    - `points_per_leg`: how many points each leg's geometry has
+    '''
+    stops = np.array([[float(n) for n in pair.split(',')]
+                      for pair in coords.split(';')])
+    legs = []
+    lines = []
+    t = np.linspace(0, 1, points_per_leg)[:, None]
+    for start, end in zip(stops[:-1], stops[1:]):
+        line = start * (1 - t) + end * t
+        lines.append(line if not lines else line[1:])
+        distance = float(haversine(line[:-1], line[1:]).sum())
+        legs.append({'distance': distance, 'steps': [
+            {'distance': distance,
+             'geometry': {'type': 'LineString', 'coordinates': line.tolist()},
+             'intersections': [{'location': end.tolist()}]}]})
+    return {'code': 'Ok', 'routes': [{
+        'distance': sum(leg['distance'] for leg in legs),
+        'geometry': {'type': 'LineString',
+                     'coordinates': np.concatenate(lines).tolist()},
+        'legs': legs}]}
+
+
+def geocode_features(coord):
+    '''Builds a geocoding response naming the state at a (long, lat) pair'''
+    state = point_to_state(coord, tolerance = 0.5)
+    if state is None:
+        return {'features': []}
+    return {'features': [{'place_type': ['region'], 'text': state}]}
+
+
+class MapboxStub():
+    '''
+    A MapBox stand-in listening on a local port.
+
+    ### Params
+    - `directions`: a function taking the request's coordinate string and
+    returning a directions response. Defaults to `straight_route`
+    - `geocode`: a function taking a (long, lat) tuple and returning a
+    geocoding response. Defaults to `geocode_features`
+    - `delay`: seconds to wait before answering each request
+
+    ### Usage
+    with MapboxStub() as stub:
+        os.environ['MAPBOX_URL'] = stub.url
+        ...
+    `stub.requests` lists the paths requested, and `stub.fail(n, status)`
+    makes the next n requests fail with that status.
+    '''
+    def __init__(self, directions = straight_route, geocode = geocode_features,
+                 delay = 0.0):
+        self.directions = directions
+        self.geocode = geocode
+        self.delay = delay
+        self.requests = []
+        self._failures = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._thread = threading.Thread(target = self._server.serve_forever,
+                                        daemon = True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def fail(self, times, status = 503):
+        with self._lock:
+            self._failures.extend([status] * times)
+
+    def _next_failure(self):
+        with self._lock:
+            return self._failures.pop(0) if self._failures else None
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _handle(self, form):
+                path = urlparse(self.path).path
+                stub.requests.append(path)
+                if stub.delay:
+                    threading.Event().wait(stub.delay)
+                status = stub._next_failure()
+                if status is not None:
+                    return self._reply(status, {'message': 'stub failure'})
+
+                match = GEOCODE_PATH.fullmatch(path)
+                if match:
+                    coord = (float(match.group(1)), float(match.group(2)))
+                    return self._reply(200, stub.geocode(coord))
+                if path == DIRECTIONS_PATH:
+                    return self._reply(200, stub.directions(form['coordinates'][0]))
+                return self._reply(404, {'message': 'Not Found'})
+
+            def do_GET(self):
+                self._handle(parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self._handle(parse_qs(self.rfile.read(length).decode()))
+
+        return Handler
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,63 @@
+import os
+import pickle
+
+import pytest
+
+from app.api import geocache, mapbox, predict, viz
+from app.api.registry import ModelRegistry
+from app.mapbox_stub import MapboxStub
+
+MODEL_DIR = os.path.join(os.path.dirname(__file__), '..', 'gas_models')
+MODEL_FILES = {
+    '1a': 'new_england_gas_model.pckl',
+    '1b': 'central_atlantic_gas_model.pckl',
+    '1c': 'lower_atlantic_gas_model.pckl',
+    '2': 'midwest_gas_model.pckl',
+    '3': 'gulf_coast_gas_model.pckl',
+    '4': 'rocky_mountain_gas_model.pckl',
+    '5': 'west_coast_gas_model.pckl',
+}
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """A local MapBox stand-in the api is pointed at."""
+    with MapboxStub() as stub:
+        monkeypatch.setenv('MAPBOX_URL', stub.url)
+        monkeypatch.setenv('MAPBOX_TOKEN', 'test-token')
+        # the shared client would still point at the previous test's stub
+        monkeypatch.setattr(mapbox, '_CLIENT', None)
+        predict.ROUTE_CACHE.clear()
+        geocache.GEOCODE_CACHE.clear()
+        yield stub
+    predict.ROUTE_CACHE.clear()
+    geocache.GEOCODE_CACHE.clear()
+
+
+@pytest.fixture(scope = 'session')
+def gas_models():
+    """The pickled PADD gas models, keyed by region."""
+    models = {}
+    for region, name in MODEL_FILES.items():
+        with open(os.path.join(MODEL_DIR, name), 'rb') as f:
+            model = pickle.load(f)
+        # scikit-learn 0.24+ expects this attribute the 0.22 pickles predate
+        if not hasattr(model, 'positive'):
+            model.positive = False
+        models[region] = model
+    return models
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """A fresh model registry for the api, loaded without its startup event."""
+    registry = ModelRegistry(check_interval = 0).load()
+    monkeypatch.setattr(predict, 'REGISTRY', registry)
+    monkeypatch.setattr(viz, 'REGISTRY', registry)
+    return registry
+
+
+@pytest.fixture
+def gas_prices(registry):
+    """The gas price table the api prices trips with."""
+    return registry.gas_prices
@@ -0,0 +1,46 @@
+import json
+
+from app import benchmark
+from app.api import predict
+from app.api.cache import LRUCache, SQLiteCache, TieredCache
+
+
+def test_benchmark_runs_offline(tmp_path, gas_prices):
+    """A small run of every scenario saves its results as JSON."""
+    output = tmp_path / 'bench.json'
+    benchmark.main(['--requests', '4', '--concurrency', '2', '--delay', '0',
+                    '--points-per-leg', '20', '--repeat', '2', '--output', str(output)])
+    results = json.loads(output.read_text())
+    scenarios = results['scenarios']
+    assert set(scenarios) == set(benchmark.SCENARIOS)
+
+    cold = scenarios['split_by_region']['cold']
+    assert cold['requests'] == 4 and cold['errors'] == 0
+    assert cold['stages']['directions']['calls'] == 4
+    # the second pass is served from the route cache
+    assert 'directions' not in scenarios['split_by_region']['cached']['stages']
+    assert scenarios['predict_gas']['exact']['stages']['predict_gas']['calls'] == 4
+    assert scenarios['predict_gas']['fast']['errors'] == 0
+    assert scenarios['viz']['cached']['errors'] == 0
+
+    lines = benchmark.compare(results, results)
+    assert any(line.startswith('predict_gas.fast: p50') for line in lines)
+
+
+def test_city_routes_are_distinct():
+    routes = benchmark.city_routes(50, stops = 2)
+    assert len(set(routes)) == 50
+    assert all(len(route.split(';')) == 2 for route in routes)
+
+
+def test_benchmark_leaves_the_route_cache_alone(tmp_path, gas_prices, monkeypatch):
+    """A run neither clears nor fills a persistent route cache."""
+    cache = TieredCache(LRUCache(16, 60), SQLiteCache(str(tmp_path / 'routes.sqlite'), ttl = 60))
+    cache.set('kept', {'regions': ['5'], 'distances': [1.0]})
+    monkeypatch.setattr(predict, 'ROUTE_CACHE', cache)
+    benchmark.main(['split_by_region', '--requests', '2', '--concurrency', '2', '--delay', '0',
+                    '--points-per-leg', '20', '--output', str(tmp_path / 'bench.json')])
+    assert predict.ROUTE_CACHE is cache
+    assert cache.disk.get('kept') == {'regions': ['5'], 'distances': [1.0]}
+    assert cache.disk.stats()['size'] == 1
+    cache.disk.close()
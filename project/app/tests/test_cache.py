@@ -0,0 +1,100 @@
+import multiprocessing
+
+from app.api.cache import LRUCache, SQLiteCache, TieredCache, coords_key
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_evicts_least_recently_used():
+    """Reading an entry protects it from the next eviction."""
+    cache = LRUCache(maxsize = 2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.stats()['evictions'] == 1
+
+
+def test_lru_expires_entries():
+    """Entries older than the ttl are misses."""
+    clock = FakeClock()
+    cache = LRUCache(ttl = 10, clock = clock)
+    cache.set('a', 1)
+    clock.now += 11
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert stats['expirations'] == 1
+    assert stats['misses'] == 1
+
+
+def test_sqlite_cache_survives_reopening(tmp_path):
+    """The disk tier keeps entries across restarts."""
+    path = str(tmp_path / 'routes.db')
+    cache = SQLiteCache(path)
+    cache.set('trip', {'distances': [1.5], 'regions': ['5']})
+    cache.close()
+    assert SQLiteCache(path).get('trip') == {'distances': [1.5], 'regions': ['5']}
+
+
+def test_sqlite_cache_prunes_to_maxsize(tmp_path):
+    """Rows beyond maxsize are pruned, least recently used first."""
+    clock = FakeClock()
+    cache = SQLiteCache(str(tmp_path / 'routes.db'), maxsize = 10, clock = clock)
+    for i in range(SQLiteCache.PRUNE_EVERY):
+        clock.now += 1
+        cache.set(str(i), i)
+    assert len(cache) == 10
+    assert cache.get('99') == 99
+    assert cache.get('0') is None
+
+
+def _use_inherited_cache(cache, queue):
+    inherited = cache._db
+    found = cache.get('parent')
+    cache.set('child', 2)
+    queue.put((found, cache._db is not inherited))
+
+
+def test_sqlite_cache_reconnects_after_fork(tmp_path):
+    """A forked worker opens its own connection instead of sharing its parent's."""
+    cache = SQLiteCache(str(tmp_path / 'routes.db'))
+    cache.set('parent', 1)
+
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    worker = context.Process(target = _use_inherited_cache, args = (cache, queue))
+    worker.start()
+    found, reconnected = queue.get(timeout = 10)
+    worker.join()
+    assert worker.exitcode == 0
+    assert found == 1
+    assert reconnected
+    # the parent's connection still works, and sees the worker's write
+    assert cache.get('child') == 2
+
+
+def test_tiered_cache_promotes_disk_hits(tmp_path):
+    """A disk hit is copied into memory for the next read."""
+    disk = SQLiteCache(str(tmp_path / 'routes.db'))
+    disk.set('trip', [1, 2])
+    cache = TieredCache(LRUCache(), disk)
+    assert cache.get('trip') == [1, 2]
+    assert cache.get('trip') == [1, 2]
+    stats = cache.stats()
+    assert stats['memory']['hits'] == 1
+    assert stats['disk']['hits'] == 1
+
+
+def test_coords_key_rounds():
+    """Nearby coordinates share a key."""
+    assert (coords_key('-122.33214,47.60621;-116.2023,43.615', 3)
+            == coords_key('-122.3321, 47.6062;-116.20231,43.61498', 3)
+            == '-122.332,47.606;-116.202,43.615')
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from app.api.coordinates import Coordinates, format_coords, parse_coords
+
+SEATTLE_BOISE = '-122.3321,47.6062;-116.2023,43.6150'
+
+
+def test_string_and_list_parse_the_same():
+    """Both request formats become the same (N, 2) array."""
+    from_string = Coordinates.validate(SEATTLE_BOISE)
+    from_list = Coordinates.validate([[-122.3321, 47.6062], [-116.2023, 43.615]])
+    assert from_string.shape == (2, 2) and from_string.dtype == float
+    np.testing.assert_array_equal(from_string, from_list)
+    assert format_coords(from_string) == '-122.3321,47.6062;-116.2023,43.615'
+
+
+def test_validated_coordinates_are_read_only_and_not_rechecked():
+    points = Coordinates.validate(SEATTLE_BOISE)
+    with pytest.raises(ValueError):
+        points[0, 0] = 0.0
+    assert Coordinates.validate(points) is points
+
+
+@pytest.mark.parametrize('coords, message', [
+    ('-122.3321,47.6062', 'Not enough coordinates'),
+    ('-122.3321,47.6062,1;-116.2023,43.6150', 'exactly 2 values'),
+    ([[-122.3321, 47.6062], [-116.2023]], 'exactly 2 values'),
+    ('-122.3321,banjo;-116.2023,43.6150', 'banjo is not numeric'),
+    ('-122.3321,nan;-116.2023,43.6150', 'nan is not numeric'),
+    ('-200,47.6062;-116.2023,43.6150', 'between -180 and 180'),
+    ('-122.3321,47.6062;-75.995,45.424721', 'outside the contiguous United States (-75.995, 45.424721)'),
+    (42, 'must be a string or a list'),
+])
+def test_bad_coordinates_name_the_problem(coords, message):
+    with pytest.raises(ValueError, match = message.replace('(', r'\(').replace(')', r'\)')):
+        Coordinates.validate(coords)
+
+
+def test_parse_coords_passes_arrays_through():
+    points = np.array([[1.0, 2.0], [3.0, 4.0]])
+    assert parse_coords(points) is points
+    np.testing.assert_array_equal(parse_coords(' 1, 2;3 ,4'), points)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from app.api.coordinates import parse_coords
+from app.api.distance import (RoadFactors, densify, estimate_split,
+                              fill_unplaced, straight_split)
+from app.api.regions import haversine
+
+SEATTLE_BOISE_VEGAS = '-122.3321,47.6062;-116.2023,43.6150;-115.1398,36.1699'
+
+
+def test_densify_keeps_stops_and_spacing():
+    stops = parse_coords(SEATTLE_BOISE_VEGAS)
+    points = densify(stops, step = 20000.0)
+    assert points[0].tolist() == stops[0].tolist()
+    assert points[-1].tolist() == stops[-1].tolist()
+    assert any(np.allclose(point, stops[1]) for point in points)
+    # points are evenly spaced in degrees, so only about evenly in meters
+    assert haversine(points[:-1], points[1:]).max() <= 20000.0 * 1.01
+
+
+def test_fill_unplaced():
+    labels = fill_unplaced([None, '2', None, None, '1c', None])
+    assert labels.tolist() == ['2', '2', '2', '2', '1c', '1c']
+    assert fill_unplaced([None, None]).tolist() == [None, None]
+
+
+def test_straight_split_follows_regions():
+    split = straight_split(parse_coords(SEATTLE_BOISE_VEGAS))
+    assert split['regions'] == ['5', '4', '5']
+    stops = parse_coords(SEATTLE_BOISE_VEGAS)
+    assert sum(split['distances']) == pytest.approx(
+        haversine(stops[:-1], stops[1:]).sum(), rel = 1e-3)
+
+
+def test_estimate_applies_road_factors():
+    factors = RoadFactors({'4': 1.5}, default = 1.2)
+    straight = straight_split(parse_coords(SEATTLE_BOISE_VEGAS))
+    estimate = estimate_split(SEATTLE_BOISE_VEGAS, factors)
+    assert estimate['regions'] == straight['regions']
+    assert np.allclose(np.array(estimate['distances']) / straight['distances'],
+                       [1.2, 1.5, 1.2])
+
+
+def test_factors_calibrate_from_real_routes():
+    """Once enough real routes are seen, the measured ratio is used."""
+    factors = RoadFactors(min_meters = 1000000.0)
+    straight = {'distances': [400000.0, 100000.0], 'regions': ['5', '4']}
+    road = {'distances': [520000.0, 110000.0], 'regions': ['5', '4']}
+    factors.observe(straight, road)
+    assert factors.factor('5') == 1.2
+    factors.observe(straight, road)
+    assert factors.factor('5') == pytest.approx(1.3)
+    # region 4 has only seen 220 km
+    assert factors.factor('4') == 1.2
+
+    # routes that cross different regions than the straight line are skipped
+    factors.observe(straight, {'distances': [1e7], 'regions': ['5']})
+    assert factors.factor('5') == pytest.approx(1.3)
+    assert factors.stats()['5']['calibration_meters'] == 1040000.0
+
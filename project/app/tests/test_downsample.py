@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from app.api.downsample import downsample, lttb, minmax
+
+
+@pytest.fixture
+def wave():
+    x = np.arange(2000)
+    y = np.sin(x / 50.0) + np.random.RandomState(0).rand(2000) * 0.1
+    y[1234] = 10.0
+    return x, y
+
+
+@pytest.mark.parametrize('method', [lttb, minmax])
+def test_keeps_ends_in_order_within_budget(wave, method):
+    x, y = wave
+    kept = method(x, y, 100)
+    assert len(kept) <= 100
+    assert kept[0] == 0 and kept[-1] == len(x) - 1
+    assert np.all(np.diff(kept) > 0)
+
+
+@pytest.mark.parametrize('method', [lttb, minmax])
+def test_keeps_spikes(wave, method):
+    x, y = wave
+    assert 1234 in method(x, y, 100)
+
+
+@pytest.mark.parametrize('method', [lttb, minmax])
+def test_short_series_are_untouched(method):
+    assert method(np.arange(5), np.arange(5.0), 10).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_lttb_uses_the_whole_budget(wave):
+    x, y = wave
+    assert len(lttb(x, y, 100)) == 100
+
+
+def test_downsample_dates_and_missing_values():
+    x = np.arange('2000-01', '2020-01', dtype = 'M8[M]').astype('M8[D]')
+    y = np.arange(len(x), dtype = float)
+    y[5] = np.nan
+    kept_x, kept_y = downsample(x, y, 50)
+    assert len(kept_x) == 50
+    assert not np.isnan(kept_y).any()
+    assert kept_x[0] == x[0] and kept_x[-1] == x[-1]
+
+
+def test_downsample_rejects_unknown_methods():
+    with pytest.raises(ValueError):
+        downsample(np.arange(10), np.arange(10.0), 5, 'mean')
@@ -0,0 +1,87 @@
+import asyncio
+
+import numpy as np
+
+from app.api.fred import FixtureSource, SeriesStore, parse_csv
+from app.tests.test_viz import FIXTURE_DIR
+
+CSV = '''observation_date,TESTUR
+2020-01-01,3.5
+2020-02-01,.
+2020-03-01,4.4
+'''
+
+
+class CountingSource(FixtureSource):
+    """A FixtureSource that records every fetch."""
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.fetches = []
+
+    async def fetch(self, series_id, start = None):
+        self.fetches.append((series_id, start))
+        await asyncio.sleep(0.01)
+        return await super().fetch(series_id, start)
+
+
+def test_parse_csv():
+    records = parse_csv(CSV, start = np.datetime64('2020-02-01'))
+    assert records['date'].tolist() == [np.datetime64('2020-02-01').item(),
+                                        np.datetime64('2020-03-01').item()]
+    assert np.isnan(records['value'][0])
+    assert records['value'][1] == 4.4
+
+
+def test_refresh_only_appends_new_observations(tmp_path):
+    source_dir = tmp_path / 'source'
+    source_dir.mkdir()
+    (source_dir / 'TESTUR.csv').write_text(CSV)
+    source = CountingSource(str(source_dir))
+    store = SeriesStore(str(tmp_path / 'data'), source)
+
+    assert asyncio.run(store.refresh('TESTUR')) == 3
+    assert asyncio.run(store.refresh('TESTUR')) == 0
+    (source_dir / 'TESTUR.csv').write_text(CSV + '2020-04-01,17.2\n')
+    assert asyncio.run(store.refresh('TESTUR')) == 1
+
+    # the later fetches only asked for observations after the last stored one
+    assert source.fetches[1:] == [('TESTUR', np.datetime64('2020-03-02')),
+                                  ('TESTUR', np.datetime64('2020-03-02'))]
+    assert store.read('TESTUR')['value'][-1] == 17.2
+    assert len(store.read('TESTUR')) == 4
+
+
+def test_concurrent_refreshes_share_a_fetch(tmp_path):
+    source = CountingSource(FIXTURE_DIR)
+    store = SeriesStore(str(tmp_path), source)
+
+    async def refresh_twice():
+        return await asyncio.gather(store.refresh('ILUR'), store.refresh('ILUR'))
+
+    assert asyncio.run(refresh_twice()) == [24, 24]
+    assert len(source.fetches) == 1
+    assert len(store.read('ILUR')) == 24
+
+
+def test_stores_share_a_directory(tmp_path):
+    """A second worker's store appends nothing the first already stored."""
+    first = SeriesStore(str(tmp_path), FixtureSource(FIXTURE_DIR))
+    second = SeriesStore(str(tmp_path), FixtureSource(FIXTURE_DIR))
+    assert asyncio.run(first.refresh('ILUR')) == 24
+    assert asyncio.run(second.refresh('ILUR')) == 0
+    assert len(second.read('ILUR')) == 24
+
+
+def test_frame_fetches_only_when_empty(tmp_path):
+    source = CountingSource(FIXTURE_DIR)
+    store = SeriesStore(str(tmp_path), source)
+    df = asyncio.run(store.frame('ILUR'))
+    df = asyncio.run(store.frame('ILUR'))
+    assert len(source.fetches) == 1
+    assert list(df.columns) == ['Date', 'Value']
+    assert df['Value'].max() == 17.2
+
+
+def test_refresh_all_logs_failures(tmp_path):
+    store = SeriesStore(str(tmp_path), FixtureSource(FIXTURE_DIR))
+    assert asyncio.run(store.refresh_all(['ILUR', 'ZZUR'])) == {'ILUR': 24, 'ZZUR': None}
@@ -0,0 +1,70 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from app.api.gasprices import (GasCurveStore, GasPriceCurves, GasPriceTable,
+                               date_grid, date_rows, verify)
+
+
+def test_table_is_bit_identical_to_models(gas_models):
+    """Every daily price over several years matches sklearn exactly."""
+    table = GasPriceTable.from_models(gas_models)
+    dates = date_grid('2019-01-01', '2026-01-01')
+    assert len(dates) == 2557
+    assert verify(table, gas_models, dates) == []
+
+
+def test_predict_repeats_and_unknown_regions(gas_models):
+    """Regions can repeat in a trip, and unknown regions raise KeyError."""
+    table = GasPriceTable.from_models(gas_models)
+    regions = list(gas_models)
+    prices = table.predict([regions[1], regions[0], regions[1]], 7, 13, 2021)
+    assert prices[0] == prices[2]
+    assert prices[1] == gas_models[regions[0]].predict([[7, 13, 2021]])[0]
+    with pytest.raises(KeyError):
+        table.predict(['Not in padds'], 7, 13, 2021)
+
+
+def test_date_rows_across_month_and_leap_days():
+    days = np.array(['2019-12-31', '2020-02-29', '2020-03-01'], dtype = 'M8[D]')
+    assert date_rows(days).tolist() == [[12, 31, 2019], [2, 29, 2020], [3, 1, 2020]]
+
+
+def test_curves_match_the_table_inside_and_outside_the_window(gas_models):
+    """Days in the window are read from memory, others are predicted, both exactly."""
+    table = GasPriceTable.from_models(gas_models)
+    curves = GasPriceCurves(table, '2021-07-01', 30)
+    days = np.array(['2021-07-01', '2021-07-30', '2021-06-30', '2021-07-31', '2021-07-13'],
+                    dtype = 'M8[D]')
+    regions = np.array([0, 6, 2, 3, 6])
+    expected = [table.predict([table.regions[r]], *date)[0]
+                for r, date in zip(regions, date_rows(days).tolist())]
+    assert curves.lookup(days, regions).tolist() == expected
+
+    daily = curves.daily(['5', '1a'], '2021-07-29', '2021-08-02')
+    assert daily.shape == (5, 2)
+    assert daily[:, 0].tolist() == table.all_prices(
+        date_grid('2021-07-29', '2021-08-03'))[:, table.index(['5'])[0]].tolist()
+
+
+def test_curve_store_rolls_over_and_follows_reloads(gas_models):
+    tables = [GasPriceTable.from_models(gas_models)]
+    today = [datetime.date(2021, 7, 13)]
+    store = GasCurveStore(lambda: tables[0], days = 10, today = lambda: today[0])
+
+    curves = store.current()
+    assert str(curves.start) == '2021-07-13'
+    assert store.current() is curves
+    assert not store.refresh()
+
+    # a new day is left to the refresh
+    today[0] = datetime.date(2021, 7, 14)
+    assert store.current() is curves
+    assert store.refresh()
+    assert str(store.current().start) == '2021-07-14'
+
+    # reloaded models are picked up right away
+    tables[0] = GasPriceTable.from_models(gas_models)
+    assert store.current().table is tables[0]
+    assert store.stats()['builds'] == 3
@@ -0,0 +1,101 @@
+import asyncio
+
+from app.api import predict
+from app.api.cache import LRUCache, SQLiteCache, TieredCache
+from app.api.geocache import MIXED, NOT_FOUND, GeocodeCache, cell_of, warm
+
+MILWAUKEE = (-87.9065, 43.0389)
+GRAND_RAPIDS = (-85.6681, 42.9634)
+# over Lake Michigan, where the state outlines place nothing
+LAKE = (-87.0, 43.0)
+
+
+def memory_cache(cell_size = 0.01):
+    return GeocodeCache(TieredCache(LRUCache(1000)), cell_size = cell_size)
+
+
+def test_points_in_a_cell_share_its_state():
+    cache = memory_cache()
+    assert cache.lookup(LAKE) is None
+    cache.store(LAKE, 'Michigan')
+    assert cache.lookup((-86.9951, 43.0049)) == 'Michigan'
+    assert cache.lookup((-86.98, 43.0)) is None
+
+
+def test_cells_with_two_states_always_call_out():
+    cache = memory_cache()
+    cache.store(LAKE, 'Michigan')
+    cache.store((-86.995, 43.005), 'Wisconsin')
+    assert cache.cache.get(cache._key(-8700, 4300)) == MIXED
+    assert cache.lookup(LAKE) is None
+    # and stay mixed
+    cache.store(LAKE, 'Michigan')
+    assert cache.lookup(LAKE) is None
+
+
+def test_a_cell_surrounded_by_one_state_is_inferred():
+    cache = memory_cache(cell_size = 1.0)
+    for lon in (-88.5, -87.5, -86.5):
+        for lat in (41.5, 42.5, 43.5):
+            if (lon, lat) != (-87.5, 42.5):
+                cache.store((lon, lat), 'Michigan')
+    assert cache.lookup((-87.5, 42.5)) == 'Michigan'
+    assert cache.stats()['inferred'] == 1
+
+    cache.store((-88.5, 41.5), 'Wisconsin')
+    assert cache.lookup((-87.5, 42.5)) is None
+
+
+def test_misses_are_not_kept_or_spread():
+    """A point MapBox can't place is asked about again, and never inferred."""
+    cache = memory_cache(cell_size = 1.0)
+    cache.store(LAKE, NOT_FOUND)
+    assert cache.lookup(LAKE) is None
+    assert cache.stats()['memory']['size'] == 0
+
+    # as left by a cache persisted when misses were stored
+    for lon in (-88.5, -87.5, -86.5):
+        for lat in (41.5, 42.5, 43.5):
+            if (lon, lat) != (-87.5, 42.5):
+                cache.cache.set(cache._key(*cell_of((lon, lat), 1.0)), NOT_FOUND)
+    assert cache.lookup((-88.5, 41.5)) is None
+    assert cache.lookup((-87.5, 42.5)) is None
+
+
+def test_cells_persist_on_disk(tmp_path):
+    path = str(tmp_path / 'geocode.sqlite')
+    GeocodeCache(TieredCache(LRUCache(10), SQLiteCache(path))).store(LAKE, 'Michigan')
+    restarted = GeocodeCache(TieredCache(LRUCache(10), SQLiteCache(path)))
+    assert restarted.lookup(LAKE) == 'Michigan'
+
+
+def michigan(coord):
+    return {'features': [{'place_type': ['region'], 'text': 'Michigan'}]}
+
+
+def test_coord_to_state_geocodes_a_cell_once(stub):
+    stub.geocode = michigan
+    first = asyncio.run(predict.coord_to_state(LAKE))
+    second = asyncio.run(predict.coord_to_state((-86.9951, 43.0049)))
+    assert first == second
+    assert len([path for path in stub.requests if path.startswith('/geocoding')]) == 1
+
+
+def test_warm_geocodes_each_unplaced_cell(stub):
+    stub.geocode = michigan
+    calls = asyncio.run(warm(predict.coord_to_state,
+                             {'Lake Michigan': [MILWAUKEE, GRAND_RAPIDS]}))
+    geocodes = [path for path in stub.requests if path.startswith('/geocoding')]
+    assert calls['Lake Michigan'] == len(geocodes) > 0
+
+    # a second warm run finds every cell cached
+    stub.requests.clear()
+    assert asyncio.run(warm(predict.coord_to_state,
+                            {'Lake Michigan': [MILWAUKEE, GRAND_RAPIDS]})) == {'Lake Michigan': 0}
+    assert stub.requests == ['/directions/v5/mapbox/driving']
+
+
+def test_warm_stops_at_the_limit(stub):
+    calls = asyncio.run(warm(predict.coord_to_state,
+                             {'Lake Michigan': [MILWAUKEE, GRAND_RAPIDS]}, limit = 2))
+    assert calls == {'Lake Michigan': 2}
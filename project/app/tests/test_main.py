@@ -1,5 +1,9 @@
+import asyncio
+
 from fastapi.testclient import TestClient
 
+from app.api import predict
+from app.api.registry import ModelRegistry
 from app.main import app
 
 client = TestClient(app)
@@ -10,3 +14,23 @@ def test_docs():
     response = client.get('/')
     assert response.status_code == 200
     assert response.headers['content-type'].startswith('text/html')
+
+
+def test_health(registry):
+    """A worker with its models loaded reports healthy."""
+    response = client.get('/health')
+    assert response.status_code == 200
+    assert response.json()['status'] == 'ok'
+
+
+def test_health_without_models(monkeypatch):
+    """A worker that couldn't load its models is taken out of rotation."""
+    monkeypatch.setattr(predict, 'REGISTRY', ModelRegistry(check_interval = 0))
+    assert client.get('/health').status_code == 503
+
+
+def test_startup_keeps_preloaded_models(registry):
+    """Workers forked from a preloaded master don't load their own copies."""
+    gas_prices = registry.gas_prices
+    asyncio.run(predict.load_models())
+    assert registry.gas_prices is gas_prices
@@ -0,0 +1,192 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+from app.api import mapbox, predict
+from app.api.mapbox import MapboxClient, MapboxError
+from app.api.predict import split_by_region
+from app.api.ratelimit import TokenBucket
+from app.mapbox_stub import straight_route
+
+
+def run(coro_fn):
+    """Runs a coroutine function on a fresh loop, closing the shared client."""
+    async def main():
+        try:
+            return await coro_fn()
+        finally:
+            await mapbox.close_client()
+    return asyncio.run(main())
+
+
+def test_directions(stub):
+    """The client posts to the directions endpoint and decodes the route."""
+    async def main():
+        client = MapboxClient(backoff_factor = 0)
+        try:
+            return await client.directions('-122.3321,47.6062;-116.2023,43.6150')
+        finally:
+            await client.aclose()
+    trip = asyncio.run(main())
+    assert trip['code'] == 'Ok'
+    assert stub.requests == ['/directions/v5/mapbox/driving']
+
+
+def test_retries_server_errors(stub):
+    """5xx responses are retried until one succeeds."""
+    stub.fail(2, status = 503)
+    async def main():
+        client = MapboxClient(backoff_factor = 0)
+        try:
+            return await client.reverse_geocode((-87.6298, 41.8781))
+        finally:
+            await client.aclose()
+    features = asyncio.run(main())
+    assert features[0]['text'] == 'Illinois'
+    assert len(stub.requests) == 3
+
+
+def test_gives_up_after_tries(stub):
+    """MapboxError is raised once every try has failed."""
+    stub.fail(3, status = 502)
+    async def main():
+        client = MapboxClient(tries = 3, backoff_factor = 0)
+        try:
+            await client.reverse_geocode((-87.6298, 41.8781))
+        finally:
+            await client.aclose()
+    with pytest.raises(MapboxError):
+        asyncio.run(main())
+
+
+def test_client_errors_are_not_retried(stub):
+    """4xx responses other than 429 fail straight away."""
+    stub.fail(1, status = 401)
+    async def main():
+        client = MapboxClient(backoff_factor = 0)
+        try:
+            await client.directions('-122.3321,47.6062;-116.2023,43.6150')
+        finally:
+            await client.aclose()
+    with pytest.raises(MapboxError):
+        asyncio.run(main())
+    assert len(stub.requests) == 1
+
+
+def test_split_by_region(stub):
+    """split_by_region uses one directions call and no geocoding on land."""
+    split = run(lambda: split_by_region('-122.3321,47.6062;-116.2023,43.6150'))
+    assert split['regions'] == ['5', '4']
+    assert stub.requests == ['/directions/v5/mapbox/driving']
+
+
+def test_split_by_region_overview(stub):
+    """The simplified overview polyline splits like detailed steps do."""
+    stub.directions = lambda coords: straight_route(coords, points_per_leg = 2000)
+    coords = '-122.3321,47.6062;-116.2023,43.6150;-115.1398,36.1699'
+    steps = run(lambda: split_by_region(coords, geometry = 'steps'))
+    overview = run(lambda: split_by_region(coords, geometry = 'overview'))
+    assert overview['regions'] == steps['regions']
+    # the stub's legs are straight, so they simplify to single segments
+    # whose great circle length differs slightly from the drawn line
+    assert overview['distances'] == pytest.approx(steps['distances'], rel = 0.01)
+    assert sum(overview['distances']) == pytest.approx(sum(steps['distances']))
+
+
+def test_token_bucket_does_not_block_the_loop():
+    """Waiting for a token lets other tasks run in the meantime."""
+    bucket = TokenBucket(rate = 600, capacity = 1)
+    ticks = []
+
+    async def ticker():
+        for _ in range(5):
+            ticks.append(1)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await bucket.acquire()
+        waited, _ = await asyncio.gather(bucket.acquire(), ticker())
+        return waited
+
+    waited = asyncio.run(main())
+    # 600 a minute is one token every 0.1 seconds
+    assert waited == pytest.approx(0.1, abs = 0.02)
+    assert len(ticks) == 5
+
+
+def test_split_by_region_is_cached(stub):
+    """A repeated trip is answered from the route cache without MapBox."""
+    coords = '-122.3321,47.6062;-116.2023,43.6150'
+    first = run(lambda: split_by_region(coords))
+    second = run(lambda: split_by_region('-122.33211,47.60619;-116.2023,43.6150'))
+    assert first == second
+    assert stub.requests == ['/directions/v5/mapbox/driving']
+
+
+# unplaced runs over Lake Michigan, each middle in its own geocoding cell
+LAKE_LABELS = ['2', None, '2', None, '2', None, '2', None, '2']
+LAKE_POINTS = [(-87.8, 43.0), (-87.6, 43.0), (-87.4, 43.0), (-87.2, 43.0), (-87.0, 43.0),
+               (-86.8, 43.0), (-86.6, 43.0), (-86.4, 43.0), (-86.2, 43.0)]
+
+
+def resolve(labels = LAKE_LABELS, points = LAKE_POINTS):
+    labels = np.array(labels, dtype = object)
+    run(lambda: predict.resolve_unplaced(labels, np.array(points)))
+    return labels
+
+
+def test_unplaced_runs_are_geocoded_concurrently(stub, monkeypatch):
+    """Four lookups a quarter second each take about a quarter second."""
+    monkeypatch.setattr(predict, 'GEOCODE_CONCURRENCY', 4)
+    stub.delay = 0.25
+    started = time.monotonic()
+    labels = resolve()
+    assert time.monotonic() - started < 0.6
+    assert None not in labels.tolist()
+    assert len(stub.requests) == 4
+
+
+def test_unplaced_runs_in_one_cell_share_a_lookup(stub):
+    points = [(-87.8, 43.0), (-87.001, 43.001), (-87.4, 43.0), (-87.002, 43.002),
+              (-87.0, 43.0)]
+    labels = resolve(['2', None, '2', None, '2'], points)
+    assert labels[1] == labels[3] is not None
+    assert len(stub.requests) == 1
+
+
+def test_unresolved_runs_inherit_at_the_deadline(stub, monkeypatch):
+    """Lookups still out at the deadline are dropped for the neighbors' region."""
+    monkeypatch.setattr(predict, 'GEOCODE_DEADLINE', 0.1)
+    stub.delay = 1.0
+    started = time.monotonic()
+    labels = resolve(['5', None, '4', None, '4'], LAKE_POINTS[:5])
+    assert time.monotonic() - started < 0.9
+    assert labels.tolist() == ['5', '5', '4', '4', '4']
+
+
+def test_failed_lookups_inherit(stub):
+    stub.fail(4, status = 401)
+    labels = resolve([None, None, '4', None, '4'], LAKE_POINTS[:5])
+    assert labels.tolist() == ['4', '4', '4', '4', '4']
+
+
+def test_guessed_splits_are_not_cached(stub, monkeypatch):
+    """A split whose lake crossing missed the geocoding deadline is routed again."""
+    milwaukee_muskegon = '-87.9065,43.0389;-86.2484,43.2342'
+    monkeypatch.setattr(predict, 'GEOCODE_DEADLINE', 0.1)
+    stub.delay = 0.3
+    run(lambda: split_by_region(milwaukee_muskegon))
+    assert stub.requests.count('/directions/v5/mapbox/driving') == 1
+
+    stub.delay = 0.0
+    monkeypatch.setattr(predict, 'GEOCODE_DEADLINE', 5.0)
+    run(lambda: split_by_region(milwaukee_muskegon))
+    assert stub.requests.count('/directions/v5/mapbox/driving') == 2
+    geocoded = len([path for path in stub.requests if path.startswith('/geocoding')])
+    assert geocoded > 0
+
+    # answered in full, so now it's cached
+    run(lambda: split_by_region(milwaukee_muskegon))
+    assert stub.requests.count('/directions/v5/mapbox/driving') == 2
@@ -0,0 +1,78 @@
+import os
+
+from fastapi.testclient import TestClient
+
+from app.api import metrics
+from app.api.metrics import Histogram, RequestProfiler, server_timing, timed
+from app.main import app
+
+client = TestClient(app)
+
+
+def test_histogram_renders_cumulative_buckets():
+    """Buckets count everything at or below their bound, ending with +Inf."""
+    histogram = Histogram('test_seconds', 'A test histogram', ['endpoint'],
+                          buckets = (0.1, 1.0))
+    metrics.METRICS.remove(histogram)
+    for value in [0.05, 0.5, 0.5, 5.0]:
+        histogram.observe(value, endpoint = 'directions')
+    assert histogram.snapshot(endpoint = 'directions') == (4, 6.05)
+
+    samples = {name + labels: value for name, labels, value in histogram.samples()}
+    assert samples['test_seconds_bucket{endpoint="directions",le="0.1"}'] == 1
+    assert samples['test_seconds_bucket{endpoint="directions",le="1.0"}'] == 3
+    assert samples['test_seconds_bucket{endpoint="directions",le="+Inf"}'] == 4
+    assert samples['test_seconds_count{endpoint="directions"}'] == 4
+
+
+def test_metrics_endpoint_reports_requests_by_route():
+    """Requests are labelled by route template, not by raw path."""
+    client.get('/stats/models')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert '# TYPE http_request_seconds histogram' in response.text
+    assert 'http_request_seconds_count{method="GET",route="/stats/models",status="200"}' in response.text
+    assert '# TYPE upstream_request_seconds histogram' in response.text
+
+    client.get('/no/such/page')
+    assert 'route="unmatched",status="404"' in client.get('/metrics').text
+
+
+def test_server_timing_header(monkeypatch):
+    """Spans recorded while handling a request come back in Server-Timing."""
+    monkeypatch.setattr(metrics, 'SERVER_TIMING', True)
+    response = client.get('/stats/models')
+    assert 'total;dur=' in response.headers['server-timing']
+    assert 'serialize;dur=' in response.headers['server-timing']
+
+
+def test_server_timing_adds_up_repeated_spans():
+    header = server_timing([('geocode', 0.01), ('directions', 0.2), ('geocode', 0.02)], 0.5)
+    assert header == 'geocode;dur=30.0;desc="x2", directions;dur=200.0, total;dur=500.0'
+
+
+def test_timed_outside_a_request_only_observes():
+    histogram = Histogram('test_timed_seconds', 'A test histogram')
+    metrics.METRICS.remove(histogram)
+    metrics._SPANS.set(None)
+    with timed('work', histogram):
+        pass
+    assert histogram.snapshot()[0] == 1
+
+
+def test_profiler_saves_slow_requests(tmp_path):
+    """Sampled requests slower than the threshold leave a profile behind."""
+    profiler = RequestProfiler(sample_rate = 1.0, slow_seconds = 0.0,
+                               directory = str(tmp_path))
+    profile = profiler.start()
+    assert profile is not None
+    # only one request is profiled at a time
+    assert profiler.start() is None
+    path = profiler.stop(profile, '/viz/{statecode}', 0.5)
+    assert os.path.dirname(path) == str(tmp_path)
+    assert path.endswith('-viz_statecode.prof')
+
+    fast = RequestProfiler(sample_rate = 1.0, slow_seconds = 10.0, directory = str(tmp_path))
+    assert fast.stop(fast.start(), '/stats/models', 0.5) is None
+    assert len(os.listdir(tmp_path)) == 1
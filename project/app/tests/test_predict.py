@@ -1,36 +1,376 @@
+import json
+import sys
+import threading
+
 from fastapi.testclient import TestClient
+import numpy as np
+import pytest
+import starlette
 
+from app.api import distance, predict
+from app.api.distance import RoadFactors
 from app.main import app
+from app.mapbox_stub import straight_route
 
 client = TestClient(app)
 
 
-def test_valid_input():
+SEATTLE_BOISE = '-122.3321,47.6062;-116.2023,43.6150'
+BOISE_VEGAS = '-116.2023,43.6150;-115.1398,36.1699'
+
+
+def test_valid_input(stub, gas_prices):
     """Return 200 Success when input is valid."""
     response = client.post(
-        '/predict',
+        '/predict/gas',
         json={
-            'x1': 3.14,
-            'x2': -42,
-            'x3': 'banjo'
+            'coords': SEATTLE_BOISE,
+            'year': 2021,
+            'month': 7,
+            'day': 13
         }
     )
     body = response.json()
     assert response.status_code == 200
-    assert body['prediction'] in [True, False]
-    assert 0.50 <= body['probability'] < 1
+    assert body['total'] > 0
+    assert body['mode'] == 'exact'
 
 
 def test_invalid_input():
-    """Return 422 Validation Error when x1 is negative."""
+    """Return 422 Validation Error when the day isn't in the month."""
     response = client.post(
-        '/predict',
+        '/predict/gas',
         json={
-            'x1': -3.14,
-            'x2': -42,
-            'x3': 'banjo'
+            'coords': SEATTLE_BOISE,
+            'year': 2021,
+            'month': 2,
+            'day': 30
         }
     )
     body = response.json()
     assert response.status_code == 422
-    assert 'x1' in body['detail'][0]['loc']
+    assert 'day' in body['detail'][0]['loc']
+
+
+def test_gas_batch_route_with_options(stub, gas_prices):
+    """One route priced on several dates is fetched once."""
+    response = client.post('/predict/gas/batch', json = {
+        'coords': SEATTLE_BOISE,
+        'options': [{'year': 2021, 'month': 7, 'day': 13},
+                    {'year': 2021, 'month': 7, 'day': 20, 'mpg': 35.0},
+                    {'year': 2021, 'month': 2, 'day': 30}]})
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert results[1]['total'] < results[0]['total']
+    assert results[2]['error']['status_code'] == 422
+    assert stub.requests == ['/directions/v5/mapbox/driving']
+
+    single = client.post('/predict/gas', json = {
+        'coords': SEATTLE_BOISE, 'year': 2021, 'month': 7, 'day': 13})
+    assert single.json()['total'] == results[0]['total']
+
+
+def test_gas_batch_items_fail_independently(stub, gas_prices):
+    """A bad entry gets an error without failing the rest of the batch."""
+    response = client.post('/predict/gas/batch', json = {'items': [
+        {'coords': SEATTLE_BOISE, 'year': 2021, 'month': 7, 'day': 13},
+        {'coords': '-122.3321,47.6062;-75.995,45.424721', 'year': 2021,
+         'month': 7, 'day': 13},
+        {'coords': BOISE_VEGAS, 'year': 2021, 'month': 7, 'day': 13},
+        {'coords': SEATTLE_BOISE, 'year': 2022, 'month': 1, 'day': 1}]})
+    results = response.json()['results']
+    assert [('total' in result) for result in results] == [True, False, True, True]
+    assert 'outside the contiguous United States' in results[1]['error']['detail'][0]['msg']
+    assert len(stub.requests) == 2
+
+
+def test_gas_fast_mode_skips_mapbox(stub, gas_prices, monkeypatch):
+    """Fast trips are estimated offline, close to the exact price."""
+    # uncalibrated, other tests' routes would have taught it the stub's 1.0
+    factors = RoadFactors()
+    monkeypatch.setattr(distance, 'ROAD_FACTORS', factors)
+    monkeypatch.setattr(predict, 'ROAD_FACTORS', factors)
+    fast = client.post('/predict/gas', json = {
+        'coords': SEATTLE_BOISE, 'year': 2021, 'month': 7, 'day': 13, 'mode': 'fast'})
+    assert fast.json()['mode'] == 'fast'
+    assert stub.requests == []
+
+    exact = client.post('/predict/gas', json = {
+        'coords': SEATTLE_BOISE, 'year': 2021, 'month': 7, 'day': 13})
+    assert exact.json()['mode'] == 'exact'
+    # the stub drives straight lines, the estimate adds 20% for roads
+    assert fast.json()['total'] == pytest.approx(exact.json()['total'] * 1.2, rel = 0.02)
+
+
+def test_gas_falls_back_when_mapbox_is_slow(stub, gas_prices, monkeypatch):
+    """An exact trip is estimated once MapBox misses the latency budget."""
+    monkeypatch.setattr(predict, 'ROUTE_LATENCY_BUDGET', 0.1)
+    release = threading.Event()
+    answered = []
+
+    def directions(coords):
+        # held until the test has its response
+        release.wait(5)
+        answered.append(coords)
+        return straight_route(coords)
+
+    stub.directions = directions
+    try:
+        response = client.post('/predict/gas', json = {
+            'coords': BOISE_VEGAS, 'year': 2021, 'month': 7, 'day': 13})
+        # answered while the directions call was still out
+        assert answered == []
+    finally:
+        release.set()
+    assert response.status_code == 200
+    assert response.json()['mode'] == 'fast'
+
+
+def test_gas_falls_back_when_mapbox_fails(stub, gas_prices):
+    stub.fail(1, status = 401)
+    response = client.post('/predict/gas/batch', json = {
+        'coords': BOISE_VEGAS, 'options': [{'year': 2021, 'month': 7, 'day': 13}]})
+    assert response.json()['results'][0]['mode'] == 'fast'
+
+
+def test_gas_batch_needs_items_or_route():
+    """A batch is either items or a route with options, not both."""
+    response = client.post('/predict/gas/batch', json = {
+        'items': [], 'coords': SEATTLE_BOISE})
+    assert response.status_code == 422
+
+
+class FakeAirbnbModel():
+    """Prices a stay at $10 a night per degree of latitude, counting calls."""
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, X):
+        self.calls.append(np.asarray(X).shape)
+        return np.asarray(X)[:, 0] * 10.0
+
+
+def test_airbnb_total_is_a_plain_number(registry):
+    """The model's NumPy float is sent as a JSON number."""
+    registry._airbnb = FakeAirbnbModel()
+    response = client.post('/predict/airbnb', json = {
+        'Airbnb_lat': 43, 'Airbnb_long': -116, 'Airbnb_nights': 2})
+    assert response.content == b'860.0'
+
+
+def test_airbnb_batch_uses_one_model_call(registry):
+    """Every stay in a batch is priced by a single predict call."""
+    model = FakeAirbnbModel()
+    registry._airbnb = model
+    response = client.post('/predict/airbnb/batch', json = {
+        'Airbnb_lat': [40, 45, 30], 'Airbnb_long': [-100, -110, -90],
+        'Airbnb_nights': [1, 2, 3]})
+    assert response.status_code == 200
+    assert response.json() == {'totals': [400.0, 900.0, 900.0]}
+    assert model.calls == [(3, 3)]
+
+
+# Starlette 0.13's StreamingResponse hands coroutines to asyncio.wait, which
+# Python 3.11 refuses. The Docker image runs Python 3.8.
+@pytest.mark.skipif(sys.version_info >= (3, 11)
+                    and tuple(map(int, starlette.__version__.split('.')[:2])) < (0, 14),
+                    reason = 'StreamingResponse needs Python < 3.11 on Starlette 0.13')
+def test_airbnb_batch_streams_chunks(registry, monkeypatch):
+    """Streamed batches arrive as one JSON line per chunk of stays."""
+    model = FakeAirbnbModel()
+    registry._airbnb = model
+    monkeypatch.setattr(predict, 'AIRBNB_STREAM_CHUNK', 2)
+    response = client.post('/predict/airbnb/batch', json = {
+        'Airbnb_lat': [40, 45, 30], 'Airbnb_long': [-100, -110, -90],
+        'Airbnb_nights': [1, 2, 3], 'stream': True})
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == [{'start': 0, 'totals': [400.0, 900.0]},
+                     {'start': 2, 'totals': [900.0]}]
+
+
+def test_airbnb_batch_lists_must_pair():
+    """Lists of different lengths are rejected."""
+    response = client.post('/predict/airbnb/batch', json = {
+        'Airbnb_lat': [40, 45], 'Airbnb_long': [-100],
+        'Airbnb_nights': [1, 2]})
+    assert response.status_code == 422
+
+
+def test_gas_accepts_coordinate_lists(stub, gas_prices):
+    """Stops may be sent as [long, lat] pairs instead of a string."""
+    listed = client.post('/predict/gas', json = {
+        'coords': [[-122.3321, 47.6062], [-116.2023, 43.615]],
+        'year': 2021, 'month': 7, 'day': 13})
+    assert listed.status_code == 200
+    joined = client.post('/predict/gas', json = {
+        'coords': SEATTLE_BOISE, 'year': 2021, 'month': 7, 'day': 13})
+    assert listed.json() == joined.json()
+    # both formats share a cached route
+    assert stub.requests == ['/directions/v5/mapbox/driving']
+
+
+def test_gas_batch_shares_a_bad_route_error(gas_prices):
+    """Every option of a route outside the USA fails with the route's error."""
+    response = client.post('/predict/gas/batch', json = {
+        'coords': [[-122.3321, 47.6062], [-75.995, 45.424721]],
+        'options': [{'year': 2021, 'month': 7, 'day': 13},
+                    {'year': 2021, 'month': 7, 'day': 14}]})
+    results = response.json()['results']
+    assert [result['error']['status_code'] for result in results] == [422, 422]
+
+
+SEATTLE_BOISE_VEGAS = '-122.3321,47.6062;-116.2023,43.6150;-115.1398,36.1699'
+
+
+def test_trip_itemizes_gas_and_lodging(stub, registry):
+    """One directions call prices every leg, and every stay is priced at once."""
+    model = FakeAirbnbModel()
+    registry._airbnb = model
+    response = client.post('/predict/trip', json = {
+        'coords': SEATTLE_BOISE_VEGAS, 'nights': [0, 2, 3],
+        'year': 2021, 'month': 7, 'day': 13})
+    assert response.status_code == 200
+    trip = response.json()
+    assert stub.requests == ['/directions/v5/mapbox/driving']
+    assert model.calls == [(2, 3)]
+
+    assert [(leg['from'], leg['to'], leg['date']) for leg in trip['legs']] == [
+        (0, 1, '2021-07-13'), (1, 2, '2021-07-15')]
+    # $10 a night per whole degree of latitude
+    assert trip['stops'] == [
+        {'nights': 0, 'check_in': '2021-07-13', 'lodging': 0.0},
+        {'nights': 2, 'check_in': '2021-07-13', 'lodging': 860.0},
+        {'nights': 3, 'check_in': '2021-07-15', 'lodging': 1080.0}]
+    assert trip['lodging'] == 1940.0
+    assert trip['gas'] == pytest.approx(sum(leg['gas'] for leg in trip['legs']), abs = 0.02)
+    assert trip['total'] == pytest.approx(trip['gas'] + trip['lodging'], abs = 0.01)
+
+    # each leg is priced like a trip of its own on the day it's driven
+    second = client.post('/predict/gas', json = {
+        'coords': BOISE_VEGAS, 'year': 2021, 'month': 7, 'day': 15})
+    assert trip['legs'][1]['gas'] == second.json()['total']
+    # and the whole route was cached on the way
+    whole = client.post('/predict/gas', json = {
+        'coords': SEATTLE_BOISE_VEGAS, 'year': 2021, 'month': 7, 'day': 13})
+    assert whole.json()['mode'] == 'exact'
+    assert stub.requests.count('/directions/v5/mapbox/driving') == 2
+
+
+def test_trip_routes_and_prices_lodging_concurrently(stub, registry):
+    """Lodging is priced while the directions call is still out."""
+    routing, pricing = threading.Event(), threading.Event()
+    overlaps = []
+
+    class WaitingModel(FakeAirbnbModel):
+        def predict(self, X):
+            pricing.set()
+            # run one after the other, each would wait out its timeout
+            overlaps.append(('lodging', routing.wait(5)))
+            return super().predict(X)
+
+    def directions(coords):
+        routing.set()
+        overlaps.append(('route', pricing.wait(5)))
+        return straight_route(coords)
+
+    registry._airbnb = WaitingModel()
+    stub.directions = directions
+    response = client.post('/predict/trip', json = {
+        'coords': SEATTLE_BOISE_VEGAS, 'nights': [0, 1, 1],
+        'year': 2021, 'month': 7, 'day': 13})
+    assert response.status_code == 200
+    assert sorted(overlaps) == [('lodging', True), ('route', True)]
+
+
+def test_trip_rejects_null_mpg():
+    response = client.post('/predict/trip', json = {
+        'coords': SEATTLE_BOISE_VEGAS, 'nights': [0, 1, 1], 'mpg': None,
+        'year': 2021, 'month': 7, 'day': 13})
+    assert response.status_code == 422
+    assert 'mpg' in response.json()['detail'][0]['loc']
+
+
+def test_trip_needs_nights_for_every_stop():
+    response = client.post('/predict/trip', json = {
+        'coords': SEATTLE_BOISE_VEGAS, 'nights': [0, 2],
+        'year': 2021, 'month': 7, 'day': 13})
+    assert response.status_code == 422
+
+
+def test_gas_prices_reads_the_daily_curves(gas_prices):
+    response = client.get('/gas/prices', params = {
+        'regions': '5,1A,5', 'start': '2021-07-13', 'end': '2021-07-15'})
+    assert response.status_code == 200
+    body = response.json()
+    assert body['dates'] == ['2021-07-13', '2021-07-14', '2021-07-15']
+    assert list(body['prices']) == ['5', '1a']
+    assert body['prices']['5'][2] == predict.region_gas_predictions('5', 7, 15, 2021)
+
+    assert client.get('/gas/prices', params = {'regions': '9'}).status_code == 404
+    assert client.get('/gas/prices', params = {
+        'start': '2021-01-01', 'end': '2022-06-01'}).status_code == 422
+
+
+def test_gas_prices_stop_at_the_last_date(gas_prices):
+    """A range near the end of the calendar is cut short instead of overflowing."""
+    response = client.get('/gas/prices', params = {'regions': '5', 'start': '9999-12-30'})
+    assert response.status_code == 200
+    assert response.json()['dates'] == ['9999-12-30', '9999-12-31']
+    assert client.get('/gas/prices', params = {
+        'start': '9999-12-31', 'end': '9999-12-30'}).status_code == 422
+
+
+def test_long_trips_are_priced_day_by_day(gas_prices):
+    """A day's pace splits segments where each day's driving ends."""
+    meters = 1 / predict.METER_TO_MILE
+    split = {'regions': ['5', '4'], 'distances': [300 * meters, 450 * meters]}
+    # 250 miles in 5 on the 13th, 50 in 5 and 200 in 4 on the 14th, 250 in 4
+    # on the 15th
+    expected = sum(miles / 25 * predict.region_gas_predictions(region, 7, day, 2021)
+                   for region, miles, day in [('5', 250, 13), ('5', 50, 14),
+                                              ('4', 200, 14), ('4', 250, 15)])
+    paced, whole = predict.price_trips([split, split], [(7, 13, 2021)] * 2, [25.0, 25.0],
+                                       [250.0, None])
+    assert paced == pytest.approx(expected)
+    assert whole == predict.price_trips([split], [(7, 13, 2021)], [25.0])[0]
+
+
+def test_trip_pace_pushes_back_later_stops(stub, registry):
+    registry._airbnb = FakeAirbnbModel()
+    response = client.post('/predict/trip', json = {
+        'coords': SEATTLE_BOISE_VEGAS, 'nights': [0, 2, 3], 'miles_per_day': 300,
+        'year': 2021, 'month': 7, 'day': 13})
+    trip = response.json()
+    # each leg is between 300 and 600 miles, so two days of driving
+    assert [leg['date'] for leg in trip['legs']] == ['2021-07-13', '2021-07-16']
+    assert [stop['check_in'] for stop in trip['stops']] == [
+        '2021-07-13', '2021-07-14', '2021-07-17']
+
+
+def test_trips_are_limited_to_the_gas_curves(stub, registry):
+    """A crawling pace or a long stay can't run past the daily gas curves."""
+    registry._airbnb = FakeAirbnbModel()
+    crawl = client.post('/predict/gas', json = {
+        'coords': '-122.3321,47.6062;-116.2023,43.6150', 'miles_per_day': 0.01,
+        'year': 2021, 'month': 7, 'day': 13})
+    assert crawl.status_code == 422
+    assert 'miles_per_day' in crawl.json()['detail'][0]['loc']
+
+    stay = client.post('/predict/trip', json = {
+        'coords': SEATTLE_BOISE_VEGAS, 'nights': [0, 1000, 1],
+        'year': 2021, 'month': 7, 'day': 13})
+    assert stay.status_code == 422
+
+    # 730 nights fit, but not with the days driving between them
+    driven = client.post('/predict/trip', json = {
+        'coords': SEATTLE_BOISE_VEGAS, 'nights': [0, 725, 5], 'miles_per_day': 50,
+        'year': 2021, 'month': 7, 'day': 13})
+    assert driven.status_code == 422
+    assert driven.json()['detail'] == f'Trips are limited to {predict.GAS_CURVE_DAYS} days'
+
+    # about ten days of driving from Christmas of the last year there is
+    late = client.post('/predict/gas/batch', json = {'items': [
+        {'coords': '-122.3321,47.6062;-116.2023,43.6150', 'miles_per_day': 50,
+         'year': 9999, 'month': 12, 'day': 25}]})
+    assert late.status_code == 200
+    assert late.json()['results'][0]['error']['detail'] == 'Trips must end by 9999-12-31'
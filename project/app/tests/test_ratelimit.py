@@ -0,0 +1,126 @@
+import asyncio
+import fcntl
+import multiprocessing
+import os
+
+import pytest
+
+from app.api.metrics import RATE_LIMIT_CALLS, RATE_LIMIT_WAIT_SECONDS, render_metrics
+from app.api.ratelimit import (FileBackend, LocalRedis, MemoryBackend,
+                               RateLimitExceeded, RedisBackend, TokenBucket)
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(params = ['memory', 'file', 'redis'])
+def backend_and_clock(request, tmp_path):
+    clock = FakeClock()
+    if request.param == 'memory':
+        return MemoryBackend(clock = clock), clock
+    if request.param == 'file':
+        return FileBackend(str(tmp_path), clock = clock), clock
+    return RedisBackend(LocalRedis(clock = clock)), clock
+
+
+def reserve(backend, **kwargs):
+    # 60 a minute is one token a second
+    return asyncio.run(backend.reserve('test', 1.0, 3, **kwargs))
+
+
+def test_burst_is_capped_at_capacity(backend_and_clock):
+    """A full bucket allows `capacity` calls, then waits queue up in order."""
+    backend, clock = backend_and_clock
+    waits = [reserve(backend) for _ in range(5)]
+    assert waits == [0.0, 0.0, 0.0, 1.0, 2.0]
+
+
+def test_tokens_refill_continuously(backend_and_clock):
+    """Tokens come back at the rate, not all at once at a window edge."""
+    backend, clock = backend_and_clock
+    for _ in range(3):
+        reserve(backend)
+    clock.now += 1.5
+    assert reserve(backend) == 0.0
+    assert reserve(backend) == pytest.approx(0.5)
+
+
+def test_max_wait_rejects_without_taking_a_token(backend_and_clock):
+    """Calls that would wait too long are turned away and cost nothing."""
+    backend, clock = backend_and_clock
+    for _ in range(3):
+        reserve(backend)
+    assert reserve(backend, max_wait = 0.5) is None
+    assert reserve(backend, max_wait = 1.0) == 1.0
+
+
+def test_token_bucket_metrics():
+    """Calls are counted by outcome in /metrics, and waits are observed."""
+    bucket = TokenBucket(rate = 6000, capacity = 1, endpoint = 'metrics test')
+
+    async def main():
+        await bucket.acquire()
+        # the next token is 10ms away
+        with pytest.raises(RateLimitExceeded):
+            await bucket.acquire(max_wait = 0.001)
+        await bucket.acquire()
+
+    asyncio.run(main())
+    calls = {outcome: RATE_LIMIT_CALLS.value(endpoint = 'metrics test', outcome = outcome)
+             for outcome in ['immediate', 'delayed', 'rejected']}
+    assert calls == {'immediate': 1, 'delayed': 1, 'rejected': 1}
+    count, waited = RATE_LIMIT_WAIT_SECONDS.snapshot(endpoint = 'metrics test')
+    assert count == 2
+    assert waited == pytest.approx(0.01, abs = 0.002)
+    assert 'rate_limit_calls_total{endpoint="metrics test",outcome="rejected"} 1.0' in render_metrics()
+
+
+def _take_tokens(directory, count, queue):
+    backend = FileBackend(directory)
+    queue.put([asyncio.run(backend.reserve('shared', 1.0, 4, max_wait = 0))
+               for _ in range(count)])
+
+
+def test_file_backend_is_shared_between_processes(tmp_path):
+    """Two processes drawing from one file backend share one quota."""
+    queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target = _take_tokens,
+                                       args = (str(tmp_path), 3, queue))
+               for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    results = [queue.get(timeout = 10) for _ in workers]
+    for worker in workers:
+        worker.join()
+    granted = [wait for result in results for wait in result if wait is not None]
+    assert len(granted) == 4
+
+
+def test_file_backend_waits_for_the_lock_without_blocking(tmp_path):
+    """A lock held by another process is retried while the event loop runs."""
+    backend = FileBackend(str(tmp_path))
+    asyncio.run(backend.reserve('locked', 1.0, 4))
+    # a second open file description contends like another process would
+    fd = os.open(str(tmp_path / 'locked.bucket'), os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    ticks = []
+
+    async def main():
+        reserving = asyncio.ensure_future(backend.reserve('locked', 1.0, 4))
+        for _ in range(5):
+            ticks.append(reserving.done())
+            await asyncio.sleep(0.005)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        return await reserving
+
+    try:
+        assert asyncio.run(main()) == 0.0
+    finally:
+        os.close(fd)
+        backend.close()
+    assert ticks == [False] * 5
@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+from pydantic import ValidationError
+
+from app.api.predict import GasItem, steps_to_segments
+from app.api.regions import (haversine, label_segments, point_to_region,
+                             point_to_state, points_to_regions, run_lengths,
+                             simplify, split_polyline, split_segments,
+                             unplaced_runs)
+
+
+@pytest.mark.parametrize('coord, state, region', [
+    ((-122.3321, 47.6062), 'Washington', '5'),
+    ((-116.2023, 43.6150), 'Idaho', '4'),
+    ((-87.6298, 41.8781), 'Illinois', '2'),
+    ((-75.5244, 39.1582), 'Delaware', '1b'),
+    ((-77.0369, 38.9072), 'District of Columbia', '1b'),
+    ((-81.7800, 24.5551), 'Florida', '1c'),
+])
+def test_point_in_state(coord, state, region):
+    """Points inside a state resolve to that state and its PADD region."""
+    assert point_to_state(coord) == state
+    assert point_to_region(coord) == region
+
+
+@pytest.mark.parametrize('coord', [
+    (-75.995000, 45.424721),  # Ottawa, Canada
+    (-117.0382, 32.5149),  # Tijuana, Mexico
+    (-70.0, 38.0),  # Atlantic Ocean
+    (-87.0, 43.0),  # Lake Michigan
+])
+def test_point_outside_usa(coord):
+    """Points outside the contiguous USA don't resolve to a state."""
+    assert point_to_state(coord) is None
+    assert point_to_region(coord) is None
+
+
+def test_gas_item_rejects_canada():
+    """GasItem rejects stops outside the USA but inside its bounding box."""
+    with pytest.raises(ValidationError) as e:
+        GasItem(coords = '-122.3321,47.6062;-75.995000,45.424721',
+                year = 2021, month = 7, day = 13)
+    assert 'outside the contiguous United States' in str(e.value)
+
+
+def test_points_to_regions_matches_single_lookups():
+    """The batch classifier agrees with one-at-a-time lookups."""
+    rng = np.random.default_rng(0)
+    points = np.column_stack([rng.uniform(-125, -66, 2000),
+                              rng.uniform(24, 50, 2000)])
+    batch = points_to_regions(points)
+    single = [point_to_region(tuple(p)) for p in points]
+    assert batch.tolist() == single
+
+
+def test_run_lengths():
+    """Consecutive equal labels collapse into one run with summed weights."""
+    regions, totals = run_lengths(['5', '5', '4', None, '4', '4'],
+                                  [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+    assert regions == ['5', '4', None, '4']
+    assert totals.tolist() == [3.0, 3.0, 4.0, 11.0]
+
+
+def test_steps_to_segments_keeps_step_distances():
+    """Step distances are spread over segments without changing the total."""
+    legs = [{'steps': [
+        {'distance': 500.0, 'geometry': {'coordinates': [
+            [-122.33, 47.60], [-122.30, 47.61], [-122.20, 47.62]]}},
+        {'distance': 0.0, 'geometry': {'coordinates': [
+            [-122.20, 47.62], [-122.20, 47.62]]}},
+    ]}, {'steps': [
+        {'distance': 250.0, 'geometry': {'coordinates': [[-122.20, 47.62]]}},
+    ]}]
+    starts, ends, distances = steps_to_segments(legs)
+    assert starts.shape == ends.shape == (4, 2)
+    assert distances.sum() == pytest.approx(750.0)
+    assert distances[-1] == 250.0
+
+
+def test_split_segments_across_border():
+    """A straight drive from Seattle to Boise splits at the Idaho border."""
+    t = np.linspace(0, 1, 1001)[:, None]
+    line = (np.array([-122.3321, 47.6062]) * (1 - t)
+            + np.array([-116.2023, 43.6150]) * t)
+    split = split_segments(line[:-1], line[1:])
+    assert split['regions'] == ['5', '4']
+    assert sum(split['distances']) == pytest.approx(
+        haversine(line[:-1], line[1:]).sum())
+    # the Idaho stretch is the last ~40 km past the border near Lewiston
+    assert 0 < split['distances'][1] < split['distances'][0]
+
+
+def test_unplaced_runs_merge_once_labeled():
+    """Runs over water are found, and merge with neighbors once labeled."""
+    # Chicago, across Lake Michigan, to Grand Rapids
+    line = np.array([[-87.63, 41.88], [-87.0, 42.5], [-86.5, 42.7],
+                     [-85.67, 42.96]])
+    labels = label_segments(line[:-1], line[1:])
+    runs = unplaced_runs(labels)
+    assert runs == [(0, 2)]
+
+    labels[0:2] = '2'
+    split = split_segments(line[:-1], line[1:], labels = labels)
+    assert split['regions'] == ['2']
+
+
+def test_simplify_keeps_corners_only():
+    """Douglas-Peucker drops points on straight stretches but keeps turns."""
+    t = np.linspace(0, 1, 101)[:, None]
+    east = np.array([-100.0, 40.0]) * (1 - t) + np.array([-99.0, 40.0]) * t
+    north = np.array([-99.0, 40.0]) * (1 - t) + np.array([-99.0, 41.0]) * t
+    line = np.concatenate([east, north[1:]])
+    line[50, 1] += 0.0001
+    assert simplify(line, 0.001).tolist() == [0, 100, 200]
+    assert 50 in simplify(line, 0.00005)
+
+
+def test_split_polyline_matches_dense_split():
+    """Bisecting only the border segment agrees with labeling every segment."""
+    t = np.linspace(0, 1, 5001)[:, None]
+    line = (np.array([-122.3321, 47.6062]) * (1 - t)
+            + np.array([-116.2023, 43.6150]) * t)
+    dense = split_segments(line[:-1], line[1:])
+
+    # a vertex every ~14 km, like a simplified road
+    points = line[::100]
+    split = split_polyline(points, points_to_regions(points), precision = 1.0)
+    assert split['regions'] == dense['regions']
+    # within one dense segment, ~140 m
+    assert split['distances'][1] == pytest.approx(dense['distances'][1], abs = 150)
+    assert sum(split['distances']) == pytest.approx(sum(dense['distances']))
+
+
+def test_split_polyline_scales_to_route_distance():
+    points = np.array([[-118.0, 47.0], [-116.0, 47.0]])
+    labels = points_to_regions(points)
+    split = split_polyline(points, labels, distance = 200000.0)
+    assert sum(split['distances']) == pytest.approx(200000.0)
+    # the Washington/Idaho border is at about -117.04
+    assert split['distances'][0] / 200000.0 == pytest.approx(0.48, abs = 0.01)
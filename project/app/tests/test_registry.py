@@ -0,0 +1,106 @@
+import json
+import os
+import pickle
+import shutil
+
+import pytest
+
+from app.api.gasprices import date_grid, verify
+from app.api.registry import ModelRegistry, export_gas_models, load_gas_table
+
+
+def make_manifest(tmp_path, gas_models, version = '1'):
+    """Writes a manifest with exported gas models and a small airbnb pickle."""
+    export_gas_models(gas_models, str(tmp_path / f'gas_{version}.json'), version)
+    with open(tmp_path / 'airbnb.pckl', 'wb') as f:
+        pickle.dump({'kind': 'airbnb'}, f)
+    manifest = {'gas': {'format': 'linear-v1', 'version': version,
+                        'path': f'gas_{version}.json'},
+                'airbnb': {'format': 'pickle', 'version': '1',
+                           'path': 'airbnb.pckl'}}
+    path = tmp_path / 'models.json'
+    path.write_text(json.dumps(manifest))
+    return str(path)
+
+
+def test_shipped_gas_models_match_pickles(gas_models):
+    """The coefficient file in the repo predicts exactly what the pickles do."""
+    registry = ModelRegistry(check_interval = 0).load()
+    table = registry.gas_prices
+    assert table.regions == list(gas_models)
+    dates = date_grid('2019-01-01', '2026-01-01', step = 7)
+    assert verify(table, gas_models, dates) == []
+
+
+def test_load_gas_table_rejects_other_formats(tmp_path):
+    path = tmp_path / 'gas.json'
+    path.write_text(json.dumps({'format': 'linear-v2', 'features': [], 'models': {}}))
+    with pytest.raises(ValueError):
+        load_gas_table(str(path))
+
+
+def test_airbnb_model_loads_lazily(tmp_path, gas_models):
+    registry = ModelRegistry(make_manifest(tmp_path, gas_models), check_interval = 0).load()
+    assert registry.info()['airbnb']['loaded'] is False
+    assert registry.airbnb_model == {'kind': 'airbnb'}
+    assert registry.info()['airbnb']['loaded'] is True
+
+
+def test_hot_reload_on_manifest_change(tmp_path, gas_models):
+    manifest = make_manifest(tmp_path, gas_models)
+    registry = ModelRegistry(manifest, check_interval = 1e-9).load()
+    first = registry.gas_prices
+
+    # a retrained model, doubled, pointed at by a new manifest
+    shutil.copy(tmp_path / 'gas_1.json', tmp_path / 'gas_2.json')
+    spec = json.loads((tmp_path / 'gas_2.json').read_text())
+    spec['version'] = '2'
+    for model in spec['models'].values():
+        model['intercept'] *= 2
+    (tmp_path / 'gas_2.json').write_text(json.dumps(spec))
+    with open(manifest) as f:
+        data = json.load(f)
+    data['gas'] = {'format': 'linear-v1', 'version': '2', 'path': 'gas_2.json'}
+    with open(manifest, 'w') as f:
+        json.dump(data, f)
+    stat = os.stat(manifest)
+    os.utime(manifest, (stat.st_atime, stat.st_mtime + 10))
+
+    assert registry.gas_prices is not first
+    assert registry.info()['gas']['version'] == '2'
+    assert registry.gas_prices.intercept[0] == 2 * first.intercept[0]
+
+
+def test_failed_reload_keeps_loaded_models(tmp_path, gas_models):
+    manifest = make_manifest(tmp_path, gas_models)
+    registry = ModelRegistry(manifest, check_interval = 1e-9).load()
+    first = registry.gas_prices
+
+    with open(manifest, 'w') as f:
+        f.write('{not json')
+    stat = os.stat(manifest)
+    os.utime(manifest, (stat.st_atime, stat.st_mtime + 10))
+
+    assert registry.gas_prices is first
+
+
+def touch(path, seconds = 10):
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + seconds))
+
+
+def test_reload_keeps_an_unchanged_airbnb_model(tmp_path, gas_models):
+    """Only a changed airbnb entry or file is unpickled again."""
+    manifest = make_manifest(tmp_path, gas_models)
+    registry = ModelRegistry(manifest, check_interval = 1e-9).load()
+    model = registry.airbnb_model
+
+    touch(manifest)
+    registry.gas_prices
+    assert registry.info()['airbnb']['loaded'] is True
+    assert registry.airbnb_model is model
+
+    with open(tmp_path / 'airbnb.pckl', 'wb') as f:
+        pickle.dump({'kind': 'airbnb', 'retrained': True}, f)
+    touch(manifest, 20)
+    assert registry.airbnb_model == {'kind': 'airbnb', 'retrained': True}
@@ -0,0 +1,70 @@
+import gzip
+import json
+
+from fastapi.testclient import TestClient
+import numpy as np
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response
+
+from app.api import responses
+from app.api.responses import CompressionMiddleware, FastJSONResponse, RawJSON, dumps, json_body
+from app.main import app
+
+client = TestClient(app)
+
+
+@pytest.mark.parametrize('encoder', ['orjson', 'json'])
+def test_dumps_encodes_numpy(encoder, monkeypatch):
+    """NumPy arrays and scalars encode like lists and numbers, NaN as null."""
+    if encoder == 'json':
+        monkeypatch.setattr(responses, 'orjson', None)
+    elif responses.orjson is None:
+        pytest.skip('orjson is not installed')
+    content = {'totals': np.array([1.5, np.nan]), 'nights': np.int64(3),
+               'total': np.float64(2.25), 'column': np.arange(6.0).reshape(2, 3)[:, 0]}
+    assert json.loads(dumps(content)) == {'totals': [1.5, None], 'nights': 3,
+                                          'total': 2.25, 'column': [0.0, 3.0]}
+
+
+def test_raw_json_is_not_encoded_twice():
+    assert FastJSONResponse(RawJSON('{"a":1}')).body == b'{"a":1}'
+    assert FastJSONResponse('{"a":1}').body == b'"{\\"a\\":1}"'
+    assert json_body(RawJSON('{"a":1}')) == b'{"a":1}'
+
+
+def compressed_app():
+    app = Starlette()
+
+    @app.route('/text')
+    async def text(request):
+        return PlainTextResponse('gas ' * int(request.query_params['words']))
+
+    @app.route('/encoded')
+    async def encoded(request):
+        body = gzip.compress(b'gas ' * 1000)
+        return Response(body, headers = {'Content-Encoding': 'gzip'})
+
+    return CompressionMiddleware(app, minimum_size = 500, compresslevel = 1)
+
+
+def test_compression_threshold_and_encoded_bodies():
+    """Large bodies are gzipped, small and already encoded ones are left alone."""
+    compressed = TestClient(compressed_app())
+    large = compressed.get('/text', params = {'words': 1000}, stream = True)
+    assert large.headers['Content-Encoding'] == 'gzip'
+    assert int(large.headers['Content-Length']) < 4000
+    assert large.content == b'gas ' * 1000
+
+    small = compressed.get('/text', params = {'words': 10})
+    assert 'Content-Encoding' not in small.headers
+    # a gzip body gzipped again would decode to gzip bytes
+    assert compressed.get('/encoded').content == b'gas ' * 1000
+
+
+def test_large_api_responses_are_compressed(gas_prices):
+    response = client.get('/gas/prices', params = {'start': '2021-01-01', 'end': '2021-12-31'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert len(response.json()['prices']['5']) == 365
+    assert 'Content-Encoding' not in client.get('/gas/prices', headers = {
+        'Accept-Encoding': 'identity'}).headers
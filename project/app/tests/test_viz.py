@@ -1,9 +1,30 @@
+import asyncio
+import json
+import os
+import shutil
+
 from fastapi.testclient import TestClient
+import pytest
 
+from app.api import viz
+from app.api import figures
+from app.api.fred import FixtureSource, SeriesStore
 from app.main import app
 
 client = TestClient(app)
 
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'fred')
+
+
+@pytest.fixture(autouse = True)
+def fred_fixtures(tmp_path, monkeypatch):
+    """Serves FRED series from the CSVs in fixtures/fred instead of FRED."""
+    store = SeriesStore(str(tmp_path), FixtureSource(FIXTURE_DIR))
+    monkeypatch.setattr(viz, 'STORE', store)
+    viz.FIGURES.clear()
+    yield store
+    viz.FIGURES.clear()
+
 
 def test_valid_input():
     """Return 200 Success for valid 2 character US state postal code."""
@@ -18,3 +39,138 @@ def test_invalid_input():
     body = response.json()
     assert response.status_code == 404
     assert body['detail'] == 'State code ZZ not found'
+
+
+def test_unreachable_source():
+    """Return 503 when a state has no local data and FRED can't be reached."""
+    response = client.get('/viz/WY')
+    assert response.status_code == 503
+
+
+def test_repeat_loads_are_not_modified():
+    """Return 304 for a client that already has the current figure."""
+    first = client.get('/viz/IL')
+    etag = first.headers['ETag']
+    assert first.headers['Last-Modified']
+
+    response = client.get('/viz/IL', headers = {'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.content == b''
+    response = client.get('/viz/IL', headers = {
+        'If-Modified-Since': first.headers['Last-Modified']})
+    assert response.status_code == 304
+
+
+def test_figure_is_served_precompressed():
+    """The gzip body decodes to the same figure JSON string as before."""
+    plain = client.get('/viz/IL', headers = {'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in plain.headers
+    figure = json.loads(json.loads(plain.content))
+    assert figure['layout']['title']['text'] == 'Illinois Unemployment Rate'
+
+    # the test client decodes the body for us
+    response = client.get('/viz/IL', headers = {'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.content == plain.content
+
+
+def test_figure_object_is_not_encoded_twice():
+    """format=object sends the figure's own JSON, cached apart from the string."""
+    string = json.loads(client.get('/viz/IL').json())
+    figure = client.get('/viz/IL', params = {'format': 'object'}).json()
+    assert isinstance(figure, dict)
+    assert figure == string
+
+
+def test_figure_is_rebuilt_when_series_updates(fred_fixtures, tmp_path):
+    """A refresh that appends observations changes the figure and its ETag."""
+    source = tmp_path / 'source'
+    shutil.copytree(FIXTURE_DIR, source)
+    fred_fixtures.source = FixtureSource(str(source))
+    first = client.get('/viz/IL')
+
+    with open(source / 'ILUR.csv', 'a') as f:
+        f.write('2021-01-01,7.7\n')
+    assert asyncio.run(fred_fixtures.refresh('ILUR')) == 1
+
+    response = client.get('/viz/IL', headers = {'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != first.headers['ETag']
+    assert '2021-01-01' in json.loads(response.content)
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('gzip, deflate, br', 'br'),
+    ('gzip;q=0, br;q=0', 'identity'),
+    ('*', 'br'),
+    ('identity', 'identity'),
+    ('', 'identity'),
+])
+def test_accepted_encoding(header, expected):
+    assert figures.accepted_encoding(header, {'identity', 'gzip', 'br'}) == expected
+    if expected == 'br':
+        assert figures.accepted_encoding(header, {'identity', 'gzip'}) == 'gzip'
+
+
+def test_unemployment_compares_states_in_range():
+    """Several states come back as raw series, sliced to the date range."""
+    response = client.get('/viz/unemployment', params = {
+        'states': 'il,WA,IL', 'start': '2020-01-01', 'end': '2020-06-30',
+        'format': 'data'})
+    assert response.status_code == 200
+    series = response.json()['series']
+    assert [s['name'] for s in series] == ['IL', 'WA']
+    assert series[0]['x'] == ['2020-01-01', '2020-02-01', '2020-03-01',
+                              '2020-04-01', '2020-05-01', '2020-06-01']
+    assert series[0]['y'][3] == 17.2
+
+
+def test_unemployment_downsamples_to_budget():
+    response = client.get('/viz/unemployment', params = {
+        'states': 'IL,WA', 'points': 10, 'format': 'data'})
+    for series in response.json()['series']:
+        assert len(series['x']) == 10
+        assert series['x'][0] == '2019-01-01' and series['x'][-1] == '2020-12-01'
+        # the April 2020 spike survives
+        assert '2020-04-01' in series['x']
+
+    response = client.get('/viz/unemployment', params = {'states': 'IL,WA', 'points': 10})
+    figure = json.loads(json.loads(response.content))
+    assert [trace['name'] for trace in figure['data']] == ['Illinois', 'Washington']
+
+
+def test_unemployment_rejects_bad_input():
+    assert client.get('/viz/unemployment', params = {'states': 'IL,ZZ'}).status_code == 404
+    response = client.get('/viz/unemployment', params = {
+        'states': 'IL', 'start': '2020-02-01', 'end': '2020-01-01'})
+    assert response.status_code == 422
+    assert client.get('/viz/unemployment', params = {
+        'states': 'IL', 'points': 1}).status_code == 422
+
+
+def test_gas_series_match_models(registry):
+    """Gas series are the PADD models' daily predictions."""
+    response = client.get('/viz/gas', params = {
+        'regions': '1A,5', 'start': '2021-07-01', 'end': '2021-07-31',
+        'format': 'data'})
+    assert response.status_code == 200
+    series = response.json()['series']
+    assert [s['name'] for s in series] == ['1a', '5']
+    assert len(series[1]['x']) == 31
+    assert series[1]['x'][12] == '2021-07-13'
+    assert series[1]['y'][12] == registry.gas_prices.predict(['5'], 7, 13, 2021)[0]
+
+    response = client.get('/viz/gas', params = {'points': 20, 'format': 'data'})
+    series = response.json()['series']
+    assert len(series) == len(registry.gas_prices.regions)
+    assert all(len(s['x']) == 20 for s in series)
+    assert client.get('/viz/gas', params = {'regions': '9'}).status_code == 404
+
+
+def test_gas_series_reach_the_last_date(registry):
+    """A range ending on the calendar's last day doesn't overflow."""
+    response = client.get('/viz/gas', params = {
+        'regions': '5', 'start': '9999-12-01', 'end': '9999-12-31', 'format': 'data'})
+    assert response.status_code == 200
+    assert response.json()['series'][0]['x'][-1] == '9999-12-31'
+    assert client.get('/viz/gas', params = {'start': '9999-12-31'}).status_code == 422
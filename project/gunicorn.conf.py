@@ -0,0 +1,66 @@
+'''
+Production server settings: gunicorn managing uvicorn workers.
+
+    gunicorn -c gunicorn.conf.py app.main:app
+
+The app and its models are loaded once in the master process before the
+workers are forked (`preload_app`), so every worker shares the gas price
+table and the Airbnb pipeline's memory copy-on-write instead of each
+unpickling its own copy.
+
+Configured with environment variables:
+
+- `WEB_CONCURRENCY`: worker processes, default one per CPU
+- `RATE_LIMIT_BACKEND`: where the MapBox rate limiters keep their state,
+default `file` so every worker on the host draws from one quota. See
+app/api/ratelimit.py
+- `BIND`: the address to listen on, default 0.0.0.0:8000
+- `KEEPALIVE`: seconds an idle keep-alive connection is held open, default 5
+- `WORKER_TIMEOUT`: seconds a worker may go without checking in with the
+master before it's killed and replaced, default 60
+- `GRACEFUL_TIMEOUT`: seconds a worker gets to finish its requests when
+stopping or reloading, default 30
+- `MAX_REQUESTS`: requests after which a worker is replaced, default 0
+(never). A random jitter of up to a tenth is added so workers don't restart
+together
+
+`kill -HUP <master pid>` replaces the workers gracefully: new workers are
+forked from the preloaded app, and old ones finish their requests first.
+Models changed on disk are picked up without one, see app/api/registry.py.
+'''
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'uvicorn.workers.UvicornWorker'
+keepalive = int(os.environ.get('KEEPALIVE', 5))
+timeout = int(os.environ.get('WORKER_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+max_requests = int(os.environ.get('MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+preload_app = True
+accesslog = '-'
+# set before the app is preloaded, since its limiters pick their backend on
+# import. The `memory` backend would give every worker its own quota
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'file')
+
+
+def when_ready(server):
+    '''Loads every model in the master, before any worker is forked'''
+    from app.api.registry import REGISTRY
+
+    if server.cfg.workers > 1 and os.environ['RATE_LIMIT_BACKEND'] == 'memory':
+        server.log.warning(f'RATE_LIMIT_BACKEND=memory gives each of the {server.cfg.workers} '
+                           'workers its own MapBox quota')
+    try:
+        REGISTRY.load(preload = True)
+    except Exception:
+        # workers load whatever is missing themselves
+        server.log.exception('Could not preload the models')
+    else:
+        server.log.info(f'Preloaded models: {REGISTRY.info()}')
+    # objects made so far are never collected, so the garbage collector
+    # doesn't touch, and copy, the pages workers share
+    gc.freeze()